@@ -1,5 +1,4 @@
 
-import pandas as pd
 import numpy as np
 import pyModbusTCP
 from pyModbusTCP.client import ModbusClient
@@ -12,8 +11,30 @@ import datetime
 import copy
 import csv
 import os
+import signal
+import multiprocessing
 import shark_200_meter_settings
-import shark_200_readings_blocks
+from modbus_connection_pool import ModbusConnectionPool, checkPipelineDepth
+from polling_engine import PollingEngine, PollRequest
+from meter_connection_state import MeterConnectionState, UP
+from tick_scheduler import DeadlineScheduler
+from register_decoder import decodeRegisters, FLOAT32
+from register_map import cleanName
+from csv_data_writer import MeterCsvWriter
+from binary_data_store import MeterBinaryWriter, columnType
+from write_behind_buffer import WriteBehindBuffer
+from sharded_acquisition import shardMeters, WorkerSupervisor
+from meter_drivers import buildMeters, SHARK_200, MODELS
+from runtime_metrics import RuntimeMetrics
+from profiling_hooks import ProfilingHooks
+from deadband_filter import DeadbandFilter
+from rollup_aggregator import MeterRollup
+from file_compressor import FileCompressor
+from poll_plan import compilePlan, comparePlans, SettingsWatcher, ReadRequestWatcher
+from modbus_proxy import LatestValueCache, ModbusProxyServer, CachedBlocks, registerBlock
+from sample_publisher import SamplePublisher
+from historical_backfill import Backfiller, backfillStream, PROVENANCE_COLUMN
+import logging_setup
 
 
     
@@ -21,6 +42,10 @@ import shark_200_readings_blocks
 --------------------------------------------------------------------------------------
 Electro Industries/GaugeTech Shark 200 Data Logging Script version 0.9.0
 
+Also polls Shark 100 meters (see METER_MODELS in the settings file), so sites with both models
+only need this one script running. ORCA_shark100_main_script.py runs this same engine with the
+Shark 100 settings file.
+
 Developed for the Alaska Center for Energy and Power ORCA(Onsite Real-time Collection and Acquisition)
 data collection project, summer 2019.
 
@@ -31,17 +56,9 @@ data collection project, summer 2019.
     
     # TODO:
 #--------------------------------------------------------------------------------------
-# - Make sure that the new .csv files are created at the beginning of the hour and aren't held up by connection issues.
-# - Implement a better connection-checking solution so that all some meters can be functional while still waiting for others to
-#...come online
 # - Create a variable for the error message logging format, since it's going to be the same across all loggers and has 3 or 4
 #...hard-coded instances right now.
-# - Create a log message for when connection with a meter has been re-established.
-# - At some point, change the readings section to include more than the 1000-to-1059 range
-# -- When that's done, change the output (to_csv) dataframe to be a seperate main dataframe that the
-#....block-specific dataframes are appended to.
 
-# - In the future, a class-based system for the meters would probably be best
 #--------------------------------------------------------------------------------------    
 
 
@@ -58,15 +75,11 @@ def getModbusData(host, port, unit_id, start_register, end_register):
                                                               
     # This function only returns the data directly taken from the device's Modbus registers.
     
-        # Setting up the client 
-    #----------------------------------------------------
-    client = ModbusClient()     # Creates a Modbus client opject 
-    client.host(host)           # Assigns the specified host (IP) address to the client      
-    client.port(port)           # Assigns the specified port to the client
-
-    client.unit_id(unit_id=unit_id)
+    # The connection itself comes from the module-level 'connection_pool', which keeps one
+    #...socket open per (host, port) across ticks. Meters behind the same gateway only differ
+    #...by unit ID and share that socket. Shark 100s that are addressed directly use the default unit ID.
     
-    start_register -= 2     # The Modbus registers listed in the Shark200 User's manual
+    start_register -= 2     # The Modbus registers listed in the Shark 100 and 200 User's manuals
     end_register -= 2       #...are all offset by 2 from their actual values,
                             #...so we account for that here.
     
@@ -74,28 +87,41 @@ def getModbusData(host, port, unit_id, start_register, end_register):
     # Since the registers are taken as integers, we can take the range between the start and end
     #...registers and add 1 to get the total number of registers to query.
                                                                                                                             
-    #----------------------------------------------------
-        
         # Reading the device's Modbus registers
     #----------------------------------------------------
-    
-
-    
-    client.open()     # Opens the connection
-    
-    response = client.read_holding_registers(start_register, num_of_registers)
+    response = connection_pool.readHoldingRegisters(host, port, unit_id, start_register, num_of_registers)
                 # This function returns a list of values, one for each of the Modbus registers specified.
                 # It works even if some of the registers queried have data stored in different formats,
                 #...so be careful not to automatically treat all data the same.
-    
-    client.close()     # Closes the connection
-    
+                # If the pooled socket has gone stale it is re-opened once before giving up with None.
     #----------------------------------------------------
     
     
     return response
 
 
+def getModbusBatch(reads):
+
+    # Reads a whole tick's worth of register ranges at once, each given as the arguments of
+    #...getModbusData(), and returns a (timestamp, response, duration) for each one. The reads
+    #...to one (host, port) go to the connection pool together, which keeps up to PIPELINE_DEPTH
+    #...of them in flight on the socket (see pipelined_modbus_client.py), so a gateway with many
+    #...meters behind it answers them all in about one round-trip instead of one each.
+
+    results = [None] * len(reads)
+    by_connection = {}     # (host, port) -> indexes of its reads
+    for index, (host, port, unit_id, start_register, end_register) in enumerate(reads):
+        by_connection.setdefault((host, port), []).append(index)
+
+    for (host, port), indexes in by_connection.items():
+        register_reads = [(reads[index][2], reads[index][3] - 2, reads[index][4] - reads[index][3] + 1)   # Same offset of 2
+                          for index in indexes]                                                          #...as getModbusData()
+        for index, result in zip(indexes, connection_pool.readMany(host, port, register_reads)):
+            results[index] = result
+
+    return results
+
+
 
 
 def format32BitFloat(array):
@@ -103,41 +129,27 @@ def format32BitFloat(array):
     # Most of the relevant values for most power/energy related uses are stored across
     #...two Modbus registers as integers with the first register containing the least
     #...significant data and the second containing the most significant.
-    # In order to transform the two integers into one single precision floating-point
-    #...number that is also easily human-readable, we must multiply the second integer
-    #...by 2^16 and add it to the first integer. We can then use the 'struct' python library
-    #...to pack the summed integer as binary data and unpack it as the format we want (i.e. float).
+    # The whole block is handed to register_decoder.decodeRegisters(), which puts every
+    #...register pair back in order and reinterprets them as single precision floats in
+    #...one vectorized pass instead of a 'struct' pack/unpack per value.
     
-    output = []
-    
-    for index, item in enumerate(array):    # Enumerate to keep track of the index
-        if index%2 == 0:                    # We want to begin with every even value
-            
-            packed = struct.pack('I', item + array[index+1]*2**16) 
-            # 'I' indicates the input to be an unsigned integer. This is neccessary for
-            #...dealing with negative numbers and will correctly display them as negative.
-            unpacked = struct.unpack('f', packed) 
-            # 'f' indicates the output to be float
-            output.append(unpacked[0]) # the unpack() function returns a tuple, so we index
-                                       #...the first item out and we have our fully formatted
-                                       #...float value.       
-    return output
-
-
-def checkConnection(host): # A simple function to check if the Modbus connection is open
-                           #...using the pyModbus.ModbusClient.is_open() method.
-    client = ModbusClient()
-    client.host(host)
-    client.open()
-    
-    if client.is_open():
-        status = True
-    else:
-        status = False
-        
-    client.close()
-    
-    return status
+    return decodeRegisters(array, FLOAT32, word_order='little').tolist()     # tolist() gives us plain python floats
+                                                                             #...just like the old struct-based loop
+
+
+def checkConnection(host, port): # A simple function to check if the Modbus connection is open.
+                                 # This looks at the pooled socket for (host, port) instead of opening
+                                 #...a throwaway connection, and re-opens it if it was dropped.
+    return connection_pool.isConnected(host, port)
+
+
+def recordConnect(host, port, seconds, opened, reconnect):
+    # Called by the connection pool after every attempt to open a connection (see runtime_metrics.py)
+    runtime_metrics.observe('orca_connect_seconds', seconds, host=host, port=port)
+    if not opened:
+        runtime_metrics.increment('orca_connect_failures_total', host=host, port=port)
+    elif reconnect:
+        runtime_metrics.increment('orca_reconnects_total', host=host, port=port)
 
 #######################################################################################
 #######################################################################################
@@ -145,74 +157,627 @@ def checkConnection(host): # A simple function to check if the Modbus connection
 
 # Setup logging directory and 'root' logger for script-wide errors
 #--------------------------------------------------------------------------------------
-if 'logs' not in os.listdir('.'):     # Cheching to see if a directory called 'logs' is in the current directory and,
-    os.mkdir('logs')                  #...if not, adding it.
-    
-    
-logging.basicConfig(filename='./logs/All_Logs.log',                   # Setting the parameters for the root logger
-                    format='%(asctime)s-%(levelname)s: %(message)s',
-                    level=logging.INFO)   
-    
-main_logger = logging.getLogger('mainErrors')                                 # Creating a new logger for non-meter-specific errors
-main_handler = logging.handlers.RotatingFileHandler('./logs/mainErrors.log')                   # Creating the file handler and destination file
-main_handler.setLevel(logging.INFO)                                           # Setting the level of message down to INFO
-main_formatter = logging.Formatter('%(asctime)s-%(levelname)s: %(message)s')  # Formatting the error messages
-main_handler.setFormatter(main_formatter)                                     # Adding the new format
-main_logger.addHandler(main_handler)                                          # Adding the handler to the logger                                                                                                                
+# All log files are written by a background thread, see logging_setup.py. run() applies the
+#...LOG_* settings once the settings file is known.
+logging_setup.startLogging('./logs')                     # Creates './logs' and All_Logs.log
+
+main_logger = logging_setup.addLogFile('mainErrors')     # Creating a new logger for non-meter-specific errors
+#--------------------------------------------------------------------------------------
+
+
+# Settings file and the model of the meters it lists, unless METER_MODELS says otherwise.
+#...ORCA_shark100_main_script.py swaps in its own through run().
+#--------------------------------------------------------------------------------------
+meter_settings = shark_200_meter_settings
+default_model = SHARK_200
+#--------------------------------------------------------------------------------------
+
+
+# Settings reloading (see poll_plan.py), set up by main()
+#--------------------------------------------------------------------------------------
+settings_watcher = None
+#--------------------------------------------------------------------------------------
+
+
+# Runtime metrics (see runtime_metrics.py), published every tick if METRICS_FILE or METRICS_PORT is set
+#--------------------------------------------------------------------------------------
+runtime_metrics = RuntimeMetrics()
+metrics_file = None     # Set by main()
+#--------------------------------------------------------------------------------------
+
+
+# On-demand profiling (see profiling_hooks.py), set up by main()
+#--------------------------------------------------------------------------------------
+profiling_hooks = None
+#--------------------------------------------------------------------------------------
+
+
+# Shared Modbus connections, one persistent socket per (host, port)
+#--------------------------------------------------------------------------------------
+connection_pool = ModbusConnectionPool(on_connect=recordConnect)
+#--------------------------------------------------------------------------------------
+
+
+# Data file writers, a list per stream (a meter or one of its rollups). Filled in by main() and closed on exit
+#...so no buffered rows are lost. 'meter_streams' lists the streams that belong to each meter.
+#--------------------------------------------------------------------------------------
+data_writers = {}
+meter_streams = {}
+write_buffer = None     # WriteBehindBuffer, only used with WRITE_BEHIND = True
+file_compressor = None  # FileCompressor, compresses finished days unless COMPRESSION = None
+#--------------------------------------------------------------------------------------
+
+
+# Modbus TCP proxy serving the latest registers of every meter (see modbus_proxy.py), set up by main() if PROXY_PORT is set
+#--------------------------------------------------------------------------------------
+latest_values = None    # LatestValueCache
+modbus_proxy = None     # ModbusProxyServer
+#--------------------------------------------------------------------------------------
+
+
+# Live stream of every row written (see sample_publisher.py), set up by main() if PUBLISH_SOCKET or PUBLISH_MULTICAST is set
+#--------------------------------------------------------------------------------------
+sample_publisher = None
+#--------------------------------------------------------------------------------------
+
+
+# Backfilling gaps in the data from the meters' historical logs (see historical_backfill.py), set up by main() if BACKFILL is on
+#--------------------------------------------------------------------------------------
+backfiller = None
+#--------------------------------------------------------------------------------------
+
+
+# Concurrent polling engine, all meters are read at the same time on each tick
+#--------------------------------------------------------------------------------------
+polling_engine = PollingEngine(getModbusData,
+                               max_in_flight_per_host=1,     # One batch at a time per meter/gateway socket
+                               batch_function=getModbusBatch)
 #--------------------------------------------------------------------------------------
     
 
-def main():  # Primary function that contains the data collection loop
+def setupMeterLoggers(settings):
+
+    # Here we want to create a different logger for each of the meters in the settings file, so that we can read them more easily.
+    # Safe to call more than once (e.g. after the settings were reloaded): a logger that already has its file is left alone.
+
+    meter_names_list = [array[0].strip() for array in settings]                          # Creating a list of meter names from the settings file
+    logger_list = [logging_setup.addLogFile(name) for name in meter_names_list]          # Each meter's messages also go to './logs/<meter name>.log'
+
+    # The files are written by the logging thread, with the format and size limits set in
+    #...logging_setup.py. See https://docs.python.org/3/library/logging.html for more info.
+
+    return logger_list
+
+
+
+
+def compileMeterPlans(settings):
+
+    # One PollPlan per meter (see poll_plan.py), in the order of the settings, using its entry
+    #...in METER_TIMESTEPS if it has one and TIMESTEP otherwise. Everything is checked here, so
+    #...the loop never has to. Raises ValueError if any meter's settings are invalid.
+
+    timestep = meter_settings.TIMESTEP
+    meter_timesteps = getattr(meter_settings, 'METER_TIMESTEPS', {})     # Optional per-meter timesteps
+    block_rates = getattr(meter_settings, 'BLOCK_RATES', {})             # Optional per-block rates
+    loggers = {logger.name: logger for logger in setupMeterLoggers(settings)}
+
+    if not settings:
+        raise ValueError('There are no meters in the settings')
+
+    known_blocks = set(block for driver in MODELS.values() for block in driver.register_map.blocks())
+    unknown_blocks = sorted(set(block_rates) - known_blocks)
+    if unknown_blocks:
+        raise ValueError('Unknown block name(s) in BLOCK_RATES: ' + ', '.join(unknown_blocks))
+
+    plans = {}
+    for meter in settings:
+        if meter.name in plans:
+            raise ValueError('More than one meter is called ' + meter.name)
+        if meter.name not in loggers:     # Most likely caused by an invalid meter name (e.g. spaces around it)
+            raise ValueError('Error when converting meter names to logger names. The meter name '
+                             + repr(meter.name) + ' may be invalid')
+        plans[meter.name] = compilePlan(meter, meter_timesteps.get(meter.name, timestep), loggers[meter.name], block_rates)
+
+    return plans
+
+
+
+
+def buildDeadbandFilters(plans):
+
+    # With REPORT_BY_EXCEPTION on, one DeadbandFilter per meter in 'plans' (see deadband_filter.py)
+    #...so that only the values that moved get written. Returns an empty dict when it's off.
+
+    if not getattr(meter_settings, 'REPORT_BY_EXCEPTION', False):
+        return {}
+
+    deadbands = {cleanName(name): deadband for name, deadband in getattr(meter_settings, 'DEADBANDS', {}).items()}
+    max_silence = getattr(meter_settings, 'MAX_SILENCE', 900)
+    file_rotation = getattr(meter_settings, 'FILE_ROTATION', 'day')
+
+    known_names = set(name for driver in MODELS.values() for name in driver.register_map.registers)
+    unknown_names = sorted(set(deadbands) - known_names)
+    if unknown_names:
+        raise ValueError('Unknown reading name(s) in DEADBANDS: ' + ', '.join(unknown_names))
+
+    deadband_filters = {}
+    for plan in plans.values():
+        if not plan.columns:     # Every reading is in a block with its own rate, which isn't filtered
+            continue
+        deadband_filters[plan.name] = DeadbandFilter(plan.columns, deadbands, max_silence, file_rotation)
+    return deadband_filters
+
+
+
+
+def buildRollups(plans):
+
+    # One MeterRollup per meter in 'plans' (see rollup_aggregator.py) for the intervals in ROLLUP_INTERVALS.
+    #...Returns an empty dict when there are none.
+
+    rollup_intervals = getattr(meter_settings, 'ROLLUP_INTERVALS', ())
+    if not rollup_intervals:
+        return {}
+
+    rollups = {}
+    for plan in plans.values():
+        if not plan.columns:     # Only the readings polled at the meter's own timestep are rolled up
+            continue
+        max_gap = 3 * plan.timestep     # A couple of missed polls is still integrated across
+        rollups[plan.name] = MeterRollup(plan.name, plan.columns, rollup_intervals, max_gap, plan.decimal_places)
+    return rollups
+
+
+
+
+def openMeterWriters(plan):
+
+    # Returns {stream name: [data writers]} for one meter: its own data, the data of each of its
+    #...other polling rates (see poll_plan.py) and each of its rollups.
+    #...Depending on STORAGE_BACKEND a stream gets a .csv writer (csv_data_writer.py), a binary
+    #...writer (binary_data_store.py) or both. Raises ValueError for invalid data file settings.
+
+    file_rotation = getattr(meter_settings, 'FILE_ROTATION', 'day')      # Data file settings, see the settings file
+    flush_interval = getattr(meter_settings, 'FLUSH_INTERVAL', 10)
+    flush_bytes = getattr(meter_settings, 'FLUSH_BYTES', 64 * 1024)
+    fsync = getattr(meter_settings, 'FSYNC', False)
+    storage_backend = getattr(meter_settings, 'STORAGE_BACKEND', 'csv')
+    report_by_exception = getattr(meter_settings, 'REPORT_BY_EXCEPTION', False)
+
+    streams = {}
+    writer_settings = dict(directory='./data', rotation=file_rotation, flush_interval=flush_interval,
+                           flush_bytes=flush_bytes, fsync=fsync, logger=plan.logger)
+    for group in plan.groups:
+        streams[group.stream] = []
+        columns = ['timestamp'] + list(group.columns)
+        if storage_backend in ('csv', 'both'):
+            streams[group.stream].append(MeterCsvWriter(group.stream, columns, **writer_settings))
+        if storage_backend in ('binary', 'both'):
+            column_types = [columnType(plan.register_map.registers[name]) for name in group.columns]
+            if report_by_exception and group.stream == plan.name:     # Carried-forward values are stored as NaN,
+                column_types = [column_type if column_type == '<f4' else '<f8'     #...which integers can't hold
+                                for column_type in column_types]
+            streams[group.stream].append(MeterBinaryWriter(group.stream, columns, column_types, **writer_settings))
+
+    # Rollups are written as streams of their own, one per interval, next to the raw data.
+    #...Always one file per day, since an hourly file would only hold a row or two.
+    rollup = buildRollups({plan.name: plan}).get(plan.name)
+    if rollup is not None:
+        columns = rollup.columns()
+        writer_settings['rotation'] = 'day'
+        for stream_name in rollup.streams():
+            streams[stream_name] = []
+            if storage_backend in ('csv', 'both'):
+                streams[stream_name].append(MeterCsvWriter(stream_name, columns, **writer_settings))
+            if storage_backend in ('binary', 'both'):
+                column_types = ['<u4'] + ['<f8'] * (len(columns) - 2)     # The sample count, then the statistics
+                streams[stream_name].append(MeterBinaryWriter(stream_name, columns, column_types, **writer_settings))
+
+    return streams
+
+
+
+
+def openBackfillWriters(plan):
+
+    # The data writers for the rows backfilled from one meter's historical log: the meter's own
+    #...columns and a provenance column, in '<meter>_backfill' files next to its live ones.
+    #...Opened and closed by the backfill thread for every gap it fills.
+
+    storage_backend = getattr(meter_settings, 'STORAGE_BACKEND', 'csv')
+    writer_settings = dict(directory='./data', rotation=getattr(meter_settings, 'FILE_ROTATION', 'day'),
+                           flush_interval=getattr(meter_settings, 'FLUSH_INTERVAL', 10),
+                           flush_bytes=getattr(meter_settings, 'FLUSH_BYTES', 64 * 1024),
+                           fsync=getattr(meter_settings, 'FSYNC', False), logger=plan.logger)
+
+    stream_name = backfillStream(plan.name)
+    columns = ['timestamp'] + list(plan.columns) + [PROVENANCE_COLUMN]
+    data_writers = []
+    if storage_backend in ('csv', 'both'):
+        data_writers.append(MeterCsvWriter(stream_name, columns, **writer_settings))
+    if storage_backend in ('binary', 'both'):
+        column_types = [columnType(plan.register_map.registers[name]) for name in plan.columns]
+        column_types = [column_type if column_type == '<f4' else '<f8'     # Readings the log doesn't hold are
+                        for column_type in column_types]                   #...stored as NaN, which integers can't hold
+        data_writers.append(MeterBinaryWriter(stream_name, columns, column_types + ['<u1'], **writer_settings))
+    return data_writers
+
+
+
+
+def replaceMeterWriters(meter_name, streams):
+
+    # Closes the data writers of one meter's streams and puts 'streams' (from openMeterWriters(),
+    #...or None to remove the meter) in their place. With the write-behind buffer on, this
+    #...happens on its thread, after the rows it already holds have been written to the old files.
+
+    def replace():
+        for stream_name in meter_streams.pop(meter_name, ()):
+            for data_writer in data_writers.pop(stream_name, ()):
+                data_writer.close()
+        if streams is not None:
+            data_writers.update(streams)
+            meter_streams[meter_name] = list(streams)
+
+    if write_buffer is not None:
+        write_buffer.runAfterQueued(replace)
+    else:
+        replace()
+
+
+
+
+def loadChangedPlans(plans):
+
+    # Checks whether the settings file has been saved since the last call, and if it has,
+    #...returns the new plans of every meter. Returns None if nothing about the meters changed
+    #...or the new settings are invalid, in which case the current ones are kept.
+
+    try:
+        if settings_watcher.poll() is None:
+            return None
+    except Exception:     # E.g. a syntax error while the file is still being edited
+        main_logger.error('Could not load the changed settings file, keeping the current settings', exc_info=True)
+        return None
+
+    try:
+        settings = buildMeters(meter_settings.settings, default_model, getattr(meter_settings, 'METER_MODELS', {}))
+        new_plans = compileMeterPlans(settings)
+        buildDeadbandFilters(new_plans)     # Only to check them
+        buildRollups(new_plans)
+        if latest_values is not None:
+            proxyUnitIds(new_plans)
+    except Exception:
+        main_logger.error('Invalid meter settings in the changed settings file, keeping the current settings',
+                          exc_info=True)
+        return None
+
+    added, changed, removed = comparePlans(plans, new_plans)
+    if not (added or changed or removed):
+        main_logger.info('Settings file reloaded, no changes to the meters')
+        return None
+
+    main_logger.info('Settings file reloaded. Added: {}. Changed: {}. Removed: {}.'.format(
+        ', '.join(added) or 'none', ', '.join(changed) or 'none', ', '.join(removed) or 'none'))
+    return new_plans
+
+
+
+
+def updateWriters(plans, new_plans):
+
+    # Opens the data writers of added meters, closes those of removed ones and starts new files
+    #...for meters whose columns changed. Meters that only got e.g. a new host or timestep keep
+    #...writing to the files they have open.
+
+    added, changed, removed = comparePlans(plans, new_plans)
+
+    for meter_name in removed:
+        replaceMeterWriters(meter_name, None)
+
+    for meter_name in added + changed:
+        plan = new_plans[meter_name]
+        old_plan = plans.get(meter_name)
+        if (meter_name in changed and plan.model == old_plan.model
+                and [(group.stream, group.columns) for group in plan.groups]
+                == [(group.stream, group.columns) for group in old_plan.groups]):
+            continue     # Same streams with the same columns
+        try:
+            replaceMeterWriters(meter_name, openMeterWriters(plan))
+        except ValueError:
+            main_logger.error('Could not open the data files for ' + meter_name + ', its data will not be written',
+                              exc_info=True)
+            replaceMeterWriters(meter_name, None)
+
+
+
+
+def proxyUnitIds(plans):
+
+    # {unit ID: meter name} for the Modbus TCP proxy. The meters in PROXY_UNIT_IDS get the unit
+    #...ID given there, the others the lowest free ones in the order of the settings. Raises
+    #...ValueError for invalid unit IDs.
+
+    fixed_unit_ids = getattr(meter_settings, 'PROXY_UNIT_IDS', {})
+
+    unknown_names = sorted(set(fixed_unit_ids) - set(plans))
+    if unknown_names:
+        raise ValueError('Unknown meter name(s) in PROXY_UNIT_IDS: ' + ', '.join(unknown_names))
+
+    unit_ids = {}
+    for meter_name, unit_id in fixed_unit_ids.items():
+        if not isinstance(unit_id, int) or not 1 <= unit_id <= 247:
+            raise ValueError('The unit ID of {} must be a whole number from 1 to 247, got {}'.format(meter_name, unit_id))
+        if unit_id in unit_ids:
+            raise ValueError('Unit ID {} is given to both {} and {}'.format(unit_id, unit_ids[unit_id], meter_name))
+        unit_ids[unit_id] = meter_name
+
+    free_unit_ids = (unit_id for unit_id in range(1, 248) if unit_id not in unit_ids)
+    for meter_name in plans:
+        if meter_name not in fixed_unit_ids:
+            unit_id = next(free_unit_ids, None)
+            if unit_id is None:
+                raise ValueError('The proxy can only serve 247 meters')
+            unit_ids[unit_id] = meter_name
+    return unit_ids
+
+
+def updateProxy(plans, new_plans):
+    # Gives the proxy the unit IDs of the new plans and drops the registers of every meter that
+    #...changed, since they may no longer be the ones it reads.
+    if latest_values is None:
+        return
+    added, changed, removed = comparePlans(plans, new_plans)
+    for meter_name in changed:
+        latest_values.forget(meter_name)
+    latest_values.setUnitIds(proxyUnitIds(new_plans))
+
+
+
+
+def publishedStreams(plans):
+    # {stream name: (meter name, columns after the timestamp)} of every stream of the meters in 'plans',
+    #...for the sample publisher. The same streams and columns as the data files (see openMeterWriters()).
+    streams = {}
+    for plan in plans.values():
+        for group in plan.groups:
+            streams[group.stream] = (plan.name, group.columns)
+        rollup = buildRollups({plan.name: plan}).get(plan.name)
+        if rollup is not None:
+            for stream_name in rollup.streams():
+                streams[stream_name] = (plan.name, rollup.columns()[1:])
+    return streams
+
+
+
+
+def writeSample(meter_name, row, timestamp):
+    # Hands one finished row to the meter's data writers, or to the write-behind buffer if it's on,
+    #...and to the sample publisher's subscribers. The backfiller looks for gaps in the timestamps.
+    if backfiller is not None:
+        backfiller.observe(meter_name, timestamp)
+    if sample_publisher is not None:
+        sample_publisher.publish(meter_name, row, timestamp)     # Never blocks, sent from the publisher's thread
+    started = time.monotonic()
+    if write_buffer is not None:
+        write_buffer.put(meter_name, row, timestamp)     # Never blocks, written in the background
+    else:
+        for data_writer in data_writers.get(meter_name, ()):     # Buffered, see csv_data_writer.py and binary_data_store.py
+            data_writer.writeRow(row, timestamp)
+    runtime_metrics.observe('orca_write_seconds', time.monotonic() - started, meter=meter_name)
+
+
+def maintainWriters():
+    if write_buffer is None:                      # (The write-behind thread does this itself)
+        for meter_writers in data_writers.values():
+            for data_writer in meter_writers:     # Rotates the files at the day/hour boundary (even for meters that
+                data_writer.maintain()            #...are down) and flushes any rows that have waited long enough
+
+
+def publishMetrics():
+    if metrics_file is not None:     # (The HTTP endpoint, if any, renders the metrics itself on every request)
+        try:
+            runtime_metrics.writeTextFile(metrics_file)
+        except OSError:
+            main_logger.error('Could not write the metrics file ' + metrics_file, exc_info=True)
+
+
+
+
+def acquisitionWorker(shard, sample_queue, heartbeat, stopping):
+
+    # Runs in its own process for one shard of the meters (see sharded_acquisition.py). The
+    #...samples go back to the supervising process, which does all the writing. Returns once
+    #...'stopping' is set.
+
+    global connection_pool, polling_engine, runtime_metrics
+
+    # The SIGTERM handler inherited from run() would raise SystemExit wherever the worker happens
+    #...to be (e.g. halfway through putting a sample on the queue). A SIGTERM (e.g. from systemd,
+    #...which sends it to every process of the service) stops the worker after its current
+    #...pass instead, like the supervisor's own request through 'stopping' does.
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+
+    # Sockets and threads don't carry over into a new process, so the worker gets its own
+    logging_setup.restartAfterFork()
+    connection_pool = ModbusConnectionPool(on_connect=recordConnect, pipeline_depth=connection_pool.pipeline_depth)
+    polling_engine = PollingEngine(getModbusData, max_in_flight_per_host=1, batch_function=getModbusBatch)
+    runtime_metrics = RuntimeMetrics()
+    last_metrics = 0.0
+
+    def emit(meter_name, row, timestamp):
+        sample_queue.put((meter_name, row, timestamp))
+
+    def cacheRegisters(meter_name, blocks, timestamp):
+        sample_queue.put((None, CachedBlocks(meter_name, blocks), timestamp))     # For the proxy in the supervising process
+
+    def afterTick():
+        nonlocal last_metrics
+        heartbeat.value = time.monotonic()     # Lets the supervisor know this worker isn't hung
+        if time.monotonic() - last_metrics >= 1.0:
+            sample_queue.put((None, runtime_metrics.snapshot(), time.time()))     # No meter name: a metrics snapshot
+            last_metrics = time.monotonic()
+
+    try:
+        acquisitionLoop({plan.name: plan for plan in shard}, emit, afterTick,
+                        cache_registers=cacheRegisters if getattr(meter_settings, 'PROXY_PORT', None) is not None else None,
+                        stopping=stopping)
+    except Exception:
+        main_logger.error('Error in worker for ' + ', '.join(plan.name for plan in shard), exc_info=True)
+    finally:
+        if profiling_hooks is not None:
+            profiling_hooks.close()     # Writes out a profile that was still running
+        polling_engine.close()
+        connection_pool.closeAll()
+        logging_setup.stopLogging()
+
+
+
+
+def runSupervisor(plans, worker_processes):
+
+    # Splits the meters over 'worker_processes' worker processes and writes the samples they
+    #...send back. Workers that die or hang are restarted (see sharded_acquisition.py). When the
+    #...settings file changes, the workers are stopped and started again with the new meters.
+
+    def startSupervisor(plans):
+        slowest_timestep = max(plan.timestep for plan in plans.values())
+        heartbeat_timeout = max(60, 5 * slowest_timestep)     # A worker normally finishes a pass every timestep
+
+        logging_setup.shareWithWorkers()     # The workers' messages are written by this process
+
+        # The plans start with (name, host, port) like the settings entries, so they are sharded the same way
+        supervisor = WorkerSupervisor(shardMeters(list(plans.values()), worker_processes), acquisitionWorker,
+                                      heartbeat_timeout=heartbeat_timeout, logger=main_logger)
+        supervisor.start()
+        return supervisor
+
+    def writeSamples(samples):
+        for meter_name, row, timestamp in samples:
+            if meter_name is None and isinstance(row, CachedBlocks):
+                if latest_values is not None:
+                    latest_values.update(row.meter_name, row.blocks, timestamp)     # A meter's registers, for the proxy
+            elif meter_name is None:
+                runtime_metrics.merge(row)     # A worker's metrics snapshot
+            else:
+                writeSample(meter_name, row, timestamp)
+
+    supervisor = startSupervisor(plans)
+
+    try:
+        while True:
+            writeSamples(supervisor.collectSamples(timeout=1.0))
+            maintainWriters()
+            publishMetrics()
+            supervisor.checkWorkers()
+            profiling_hooks.poll()
+
+            new_plans = loadChangedPlans(plans)
+            if new_plans is not None:
+                supervisor.stop()
+                try:     # Writing what the old workers had already sent
+                    samples = supervisor.collectSamples(timeout=0.1)
+                    while samples:
+                        writeSamples(samples)
+                        samples = supervisor.collectSamples(timeout=0.1)
+                except Exception:
+                    main_logger.error('Could not collect the last samples of the stopped workers', exc_info=True)
+                updateWriters(plans, new_plans)
+                updateProxy(plans, new_plans)
+                if sample_publisher is not None:
+                    sample_publisher.setStreams(publishedStreams(new_plans))
+                if backfiller is not None:
+                    backfiller.setPlans(new_plans)
+                plans = new_plans
+                supervisor = startSupervisor(plans)
+    finally:
+        supervisor.stop()
+
+
+
+
+def main():  # Primary function that sets everything up and starts the data collection
 
         # Global Variables
     #---------------------------------------------------------------------------------
     global main_logger
     #---------------------------------------------------------------------------------
-       
+
        # Importing the settings from the settings file
     #---------------------------------------------------------------------------------
-    settings = shark_200_meter_settings.settings
-    
-    timestep = shark_200_meter_settings.TIMESTEP     # Importing the specified timestep
+    storage_backend = getattr(meter_settings, 'STORAGE_BACKEND', 'csv')  # Data file settings, see the settings file
+    compression = getattr(meter_settings, 'COMPRESSION', None)
+
+    write_behind = getattr(meter_settings, 'WRITE_BEHIND', False)        # Write-behind buffer settings
+    buffer_capacity = getattr(meter_settings, 'BUFFER_CAPACITY', 10000)
+    batch_size = getattr(meter_settings, 'BATCH_SIZE', 500)
+    max_batch_delay = getattr(meter_settings, 'MAX_BATCH_DELAY', 30)
+
+    worker_processes = getattr(meter_settings, 'WORKER_PROCESSES', 1)    # Sharded acquisition, see the settings file
+    pipeline_depth = getattr(meter_settings, 'PIPELINE_DEPTH', 1)        # Requests in flight per gateway
+
+    global metrics_file
+    metrics_file = getattr(meter_settings, 'METRICS_FILE', None)                 # Runtime metrics, see the settings file
+    metrics_port = getattr(meter_settings, 'METRICS_PORT', None)
+
+    profiler = getattr(meter_settings, 'PROFILER', 'sampler')                    # On-demand profiling, see the settings file
+    profile_control_file = getattr(meter_settings, 'PROFILE_CONTROL_FILE', './logs/profiling')
+
+    proxy_port = getattr(meter_settings, 'PROXY_PORT', None)                     # Modbus TCP proxy, see the settings file
+    proxy_host = getattr(meter_settings, 'PROXY_HOST', '127.0.0.1')
+    proxy_max_age = getattr(meter_settings, 'PROXY_MAX_AGE', 60)
+
+    publish_socket = getattr(meter_settings, 'PUBLISH_SOCKET', None)             # Live sample stream, see the settings file
+    publish_multicast = getattr(meter_settings, 'PUBLISH_MULTICAST', None)
+    publish_format = getattr(meter_settings, 'PUBLISH_FORMAT', 'json')
+
+    backfill = getattr(meter_settings, 'BACKFILL', False)                        # Historical log backfill, see the settings file
+    backfill_log = getattr(meter_settings, 'BACKFILL_LOG', 1)
+    backfill_min_gap = getattr(meter_settings, 'BACKFILL_MIN_GAP', 300)
+    backfill_max_age = getattr(meter_settings, 'BACKFILL_MAX_AGE', 7 * 24 * 3600)
     #---------------------------------------------------------------------------------
 
         # Setting name of the Pi
     # ---------------------------------------------------------------------------------
     # ---------------------------------------------------------------------------------
 
-    
-        
-        # Making sure the IP address is in a valid format
+
+
+        # Checking the meters, their hosts, timesteps and readings before anything starts
     #---------------------------------------------------------------------------------
-    for meter in settings:
-        
-        if len([char for char in meter[1] if ((char >= '0') & (char <= '9')) | (char == '.')]) != len(meter[1]):
-            main_logger.error('Invalid host name for ' + meter[0] + ': ' + meter[1] + '. Exiting...')
-            exit()
-    #---------------------------------------------------------------------------------       
-    
-           
-        # Logging
-    #---------------------------------------------------------------------------------    
-    # Here we want to create a different logger for each of the meters in the settings file, so that we can read them more easily.
-    
-    meter_names_list = [array[0].strip() for array in settings]                          # Creating a list of meter names from the settings file
-    logger_list = [logging.getLogger(name) for name in meter_names_list]                 # Creating a new logger for each meter in the settings file
-    
-    for logger in logger_list:                                                           # Here we loop through each logger in the list and add some attributes                
-        handler = logging.handlers.RotatingFileHandler('./logs/' + logger.name + '.log')                  # Creates a handler object that will direct logged messages to the 'logs' directory
-        handler.setLevel(logging.INFO)                                                   # Sets the level of message top be logged down to 'info'
-        handler_formatter = logging.Formatter('%(asctime)s-%(levelname)s: %(message)s')  # Creating a new format for the messages (time-level: message)
-        handler.setFormatter(handler_formatter)                                          # Adding the format to the handler
-        logger.addHandler(handler)                                                       # Adding the handler to the logger
-        
-        # See https://docs.python.org/3/library/logging.html for more info in valid LogRecord attributes
-        #...to pass as the format argument
-    #--------------------------------------------------------------------------------- 
-     
+    # Each meter's settings are compiled once into a poll plan (see poll_plan.py). Anything
+    #...invalid (e.g. a bad host or meter name, an unknown reading) stops the script here, so
+    #...that bad and/or nonexistent data isn't being transfered to the .csv files.
+    try:                                      # One driver per meter, see meter_drivers.py
+        settings = buildMeters(meter_settings.settings, default_model, getattr(meter_settings, 'METER_MODELS', {}))
+        plans = compileMeterPlans(settings)
+    except ValueError:
+        main_logger.error('Invalid meter settings. Exiting...', exc_info=True)
+        exit()
+
+    try:
+        buildDeadbandFilters(plans)
+    except ValueError:
+        main_logger.error('Invalid REPORT_BY_EXCEPTION settings. Exiting...', exc_info=True)
+        exit()
+
+    try:
+        buildRollups(plans)
+    except ValueError:
+        main_logger.error('Invalid ROLLUP_INTERVALS setting. Exiting...', exc_info=True)
+        exit()
+
+    try:
+        connection_pool.pipeline_depth = checkPipelineDepth(pipeline_depth)
+    except ValueError:
+        main_logger.error('Invalid PIPELINE_DEPTH setting. Exiting...', exc_info=True)
+        exit()
+    #---------------------------------------------------------------------------------
+
         # Creating the directory to store .csv files
     #---------------------------------------------------------------------------------
-    if 'data' not in os.listdir('.'):                                      # Checking current directory for directory called 'data' 
+    if 'data' not in os.listdir('.'):                                      # Checking current directory for directory called 'data'
         try:
             os.mkdir('data') # Creating it if it doesn't exist.
             print(f"Successfully created data file at {os.path.abspath('./data')}")
@@ -221,125 +786,397 @@ def main():  # Primary function that contains the data collection loop
                                                                                 #...return the stack trace error message.
     #---------------------------------------------------------------------------------
 
+        # Data file writers
+    #---------------------------------------------------------------------------------
+    # Each writer keeps one meter's current data file open, writes the columns in a fixed order
+    #...and only touches the disk every 'flush_interval' seconds (see openMeterWriters()).
+    if storage_backend not in ('csv', 'binary', 'both'):
+        main_logger.error('Invalid STORAGE_BACKEND: ' + str(storage_backend) + '. Exiting...')
+        exit()
+
+    for plan in plans.values():
+        try:
+            streams = openMeterWriters(plan)
+        except ValueError:
+            main_logger.error('Invalid data file settings. Exiting...', exc_info=True)
+            exit()
+        data_writers.update(streams)
+        meter_streams[plan.name] = list(streams)
+    #---------------------------------------------------------------------------------
+
+        # Write-behind buffer
+    #---------------------------------------------------------------------------------
+    # With WRITE_BEHIND on, samples go into an in-memory ring buffer and a background thread
+    #...writes them to the data files in large batches (see write_behind_buffer.py). That
+    #...thread then owns the writers, so the loop below only hands it the rows.
+    global write_buffer
+    if write_behind:
+        write_buffer = WriteBehindBuffer(data_writers, capacity=buffer_capacity, batch_size=batch_size,
+                                         max_delay=max_batch_delay, spool_path='./data/.spool', logger=main_logger)
+        write_buffer.start()     # Also writes out anything left in the spool by a power cut
+    #---------------------------------------------------------------------------------
+
+        # Compressing finished days
+    #---------------------------------------------------------------------------------
+    # Once a day is over, a low-priority background thread compresses its data files and
+    #...removes the originals (see file_compressor.py). The polling loop never waits for it.
+    global file_compressor
+    if compression is not None:
+        try:
+            file_compressor = FileCompressor('./data', compression, logger=main_logger)
+        except ValueError:
+            main_logger.error('Invalid COMPRESSION setting. Exiting...', exc_info=True)
+            exit()
+        file_compressor.start()
+    #---------------------------------------------------------------------------------
+
+        # Profiling hooks
+    #---------------------------------------------------------------------------------
+    # 'kill -USR1' / 'kill -USR2' or the control file switch CPU profiling and memory tracing
+    #...on and off while the logger keeps running. The results go to './logs/'.
+    global profiling_hooks
+    try:
+        profiling_hooks = ProfilingHooks(directory='./logs', control_file=profile_control_file,
+                                         profiler=profiler, logger=main_logger)
+    except ValueError:
+        main_logger.error('Invalid PROFILER setting. Exiting...', exc_info=True)
+        exit()
+    profiling_hooks.install()
+    #---------------------------------------------------------------------------------
+
+        # Runtime metrics endpoint
+    #---------------------------------------------------------------------------------
+    if metrics_port is not None:
+        try:
+            runtime_metrics.serve(metrics_port)     # Only reachable from the Pi itself
+        except OSError:
+            main_logger.error('Could not serve metrics on port ' + str(metrics_port), exc_info=True)
+    #---------------------------------------------------------------------------------
+
+        # Modbus TCP proxy
+    #---------------------------------------------------------------------------------
+    # SCADA, HMI panels and other scripts read the latest registers of every meter from here
+    #...instead of taking up the meters' own connection slots (see modbus_proxy.py).
+    global latest_values, modbus_proxy
+    if proxy_port is not None:
+        latest_values = LatestValueCache(max_age=proxy_max_age)
+        try:
+            latest_values.setUnitIds(proxyUnitIds(plans))
+        except ValueError:
+            main_logger.error('Invalid PROXY_UNIT_IDS setting. Exiting...', exc_info=True)
+            exit()
+        modbus_proxy = ModbusProxyServer(latest_values, proxy_host, proxy_port)
+        try:
+            modbus_proxy.start()
+        except OSError:
+            main_logger.error('Could not serve the Modbus TCP proxy on port ' + str(proxy_port), exc_info=True)
+            latest_values, modbus_proxy = None, None
+    #---------------------------------------------------------------------------------
+
+        # Live sample stream
+    #---------------------------------------------------------------------------------
+    # Every row written to the data files is also pushed to the subscribers of the UNIX socket
+    #...and/or the multicast group as soon as it comes in (see sample_publisher.py).
+    global sample_publisher
+    if publish_socket is not None or publish_multicast is not None:
+        try:
+            sample_publisher = SamplePublisher(publish_socket, publish_multicast, publish_format, logger=main_logger)
+        except ValueError:
+            main_logger.error('Invalid PUBLISH_FORMAT setting. Exiting...', exc_info=True)
+            exit()
+        sample_publisher.setStreams(publishedStreams(plans))
+        try:
+            sample_publisher.start()
+        except OSError:
+            main_logger.error('Could not open PUBLISH_SOCKET or PUBLISH_MULTICAST, no samples will be published',
+                              exc_info=True)
+            sample_publisher.close()
+            sample_publisher = None
+    #---------------------------------------------------------------------------------
+
+        # Backfilling gaps from the meters' historical logs
+    #---------------------------------------------------------------------------------
+    # When a meter's rows stop and start again (e.g. the network was down), a low-priority
+    #...background thread downloads the missing time from the meter's own log over its pooled
+    #...connection and writes it to '<meter>_backfill' files (see historical_backfill.py). With
+    #...worker processes the polling pools live in the workers, so this process's pool opens a
+    #...connection of its own to each meter that has a gap.
+    global backfiller
+    if backfill:
+        quiet_time = getattr(meter_settings, 'MAX_SILENCE', 900) if getattr(meter_settings, 'REPORT_BY_EXCEPTION', False) else 0
+        try:
+            backfiller = Backfiller(openBackfillWriters, connection_pool, './data', getattr(meter_settings, 'FILE_ROTATION', 'day'),
+                                    backfill_log, backfill_min_gap, backfill_max_age, quiet_time,
+                                    hold_files=file_compressor.holding if file_compressor is not None else None,
+                                    logger=main_logger)
+        except ValueError:
+            main_logger.error('Invalid BACKFILL_LOG setting. Exiting...', exc_info=True)
+            exit()
+        backfiller.setPlans(plans)
+        backfiller.start()
+    #---------------------------------------------------------------------------------
+
+        # Settings reloading
+    #---------------------------------------------------------------------------------
+    # Saving the settings file while the script runs adds, changes or removes meters without
+    #...a restart. Only the meters that changed are touched (see the loop below).
+    global settings_watcher
+    settings_watcher = SettingsWatcher(meter_settings)
+    #---------------------------------------------------------------------------------
+
     # A handy message to make sure the script is actually running
     # --------------------------------------------------------------------------------
     print("Setup complete. Beginning data collection")
     # --------------------------------------------------------------------------------
-        
+
+        # Data collection
+    #---------------------------------------------------------------------------------
+    # With WORKER_PROCESSES above 1 the meters are polled by several worker processes and this
+    #...process only writes what they send back. Otherwise everything runs right here.
+    def afterTick():
+        maintainWriters()
+        publishMetrics()
+
+    def reloadPlans(plans):
+        new_plans = loadChangedPlans(plans)
+        if new_plans is not None:
+            updateWriters(plans, new_plans)
+            updateProxy(plans, new_plans)
+            if sample_publisher is not None:
+                sample_publisher.setStreams(publishedStreams(new_plans))
+            if backfiller is not None:
+                backfiller.setPlans(new_plans)
+        return new_plans
+
+    if worker_processes > 1:
+        runSupervisor(plans, worker_processes)
+    else:
+        acquisitionLoop(plans, writeSample, afterTick, reloadPlans,
+                        cache_registers=latest_values.update if latest_values is not None else None)
+    #---------------------------------------------------------------------------------
+
+
+
+
+def acquisitionLoop(plans, emit, after_tick=None, reload_plans=None, cache_registers=None, stopping=None):  # Contains the data collection loop for the meters in 'plans'
+
+    # 'plans' are the meters' PollPlans (see poll_plan.py), by name. Every finished row is passed
+    #...to 'emit(meter_name, row, timestamp)', and 'after_tick()' is called at the end of every
+    #...pass through the loop. After that, 'reload_plans(plans)' may return new plans (the
+    #...settings file changed), and only the meters that were added, changed or removed are
+    #...set up again; the others keep their connection state and schedule. With the Modbus TCP
+    #...proxy on, 'cache_registers(meter_name, blocks, timestamp)' gets the registers of every
+    #...successful poll (see modbus_proxy.py). Returns once 'stopping' (e.g. a threading.Event) is set.
+
+    # Every meter keeps track of its own connection (up, degraded, backing off, down), so one
+    #...unreachable meter no longer stops the data collection for the others. Each of its rate
+    #...groups (see poll_plan.py) also gets its own absolute deadlines on the monotonic clock,
+    #...see tick_scheduler.py, so every block is only read as often as its rate asks for.
+    meter_states = {}
+    scheduler = DeadlineScheduler()
+    stream_meters = {}        # Rate group stream (the scheduler task name) -> meter name
+    deadband_filters = {}     # Empty unless REPORT_BY_EXCEPTION is on, already checked in main()
+    rollups = {}              # Empty unless ROLLUP_INTERVALS is set, already checked in main()
+    read_requests = ReadRequestWatcher(getattr(meter_settings, 'READ_REQUEST_FILE', './logs/read_blocks'))
+
+    def addMeter(plan):
+        meter_states[plan.name] = MeterConnectionState(plan.name, plan.host, plan.logger)
+        for group in plan.groups:
+            stream_meters[group.stream] = plan.name
+            if group.timestep is not None:     # (Blocks read on request only have no schedule)
+                scheduler.addTask(group.stream, group.timestep)
+        deadband_filters.update(buildDeadbandFilters({plan.name: plan}))
+        rollups.update(buildRollups({plan.name: plan}))
+        for counter in ('orca_tick_overruns_total', 'orca_missed_ticks_total', 'orca_decode_errors_total'):
+            runtime_metrics.increment(counter, 0, meter=plan.name)     # Listed at 0 until the first one
+
+    def removeMeter(plan):
+        meter_states.pop(plan.name)
+        for group in plan.groups:
+            stream_meters.pop(group.stream, None)
+            scheduler.removeTask(group.stream)
+        deadband_filters.pop(plan.name, None)
+        rollups.pop(plan.name, None)
+
+    for plan in plans.values():
+        addMeter(plan)
+
     # START PRIMARY DATA COLLECTION LOOP
     ###################################################################################
     ###################################################################################
     while True:     # Data collection loop
 
-        # Time management loop
+        # Time management
         ########################################################
-        while True:
-            if datetime.datetime.now().second % timestep == 0:
-                break
-            else:
-                time.sleep(0.05)
+        due_ticks = scheduler.waitForDueTasks(stopping)     # Sleeps until the next meter deadline comes up (or a
+                                                            #...second, if every block is only read on request)
+        if stopping is not None and stopping.is_set():
+            break
+        tick_started = time.monotonic()
+        
+        for tick in due_ticks:
+            if tick.missed:
+                meter_states[stream_meters[tick.name]].logger.warning('Missed {} tick(s) of {}, the previous pass overran '
+                                                                      'the timestep'.format(tick.missed, tick.name))
+                if tick.name in meter_states:     # The meter's own timestep (not one of its block rates)
+                    runtime_metrics.increment('orca_missed_ticks_total', tick.missed, meter=tick.name)
+        
+        due_streams = set(tick.name for tick in due_ticks)
+        
+        requested = read_requests.poll()     # Meters whose on-request blocks were just asked for (empty: all of them)
+        if requested is not None:
+            due_streams.update(group.stream for plan in plans.values() if not requested or plan.name in requested
+                               for group in plan.groups if group.timestep is None)
         ########################################################
 
 
-        for meter_name, host, port, decimal_places, unit_id, readings in settings:# Looping through each variable in each of the meter tuples
-            
-            try:                                      # Finding the logger that matches the current meter name and indexing it out
-                logger = [logger for logger in logger_list if logger.name == meter_name][0] 
-            except IndexError:      # If none of the meter names match the logs, it is most likely caused by an invalid meter name
-                main_logger.error('Error when converting meter names to logger names.'+
-                                  'One or more meter names may be invalid. Exiting...')
-                exit()     # Exits the program so that the error can be fixed and bad and/or nonexistent data isn't being
-                           #...transfered to the .csv files.
-                
-                
-            while True:     # If the connection to all meters isn't functional, this loop will continue until they are
-                if checkConnection(host) == True:
-                    break
-                else:
-                    print('Could not connect to {} at {}'.format(meter_name, host) + ' Retrying...')
-                    logger.error('Could not connect to {} at {}'.format(meter_name, host) + ' Retrying...')
-                    time.sleep(10)
+            # Reconnecting unreachable meters in the background
+        #-------------------------------------------------------------------------------------
+        # Meters that are backing off are skipped on this tick. Once their backoff delay runs out
+        #...a reconnect attempt is handed to the polling engine's thread pool, so a dead meter
+        #...never holds up the healthy ones.
+        for plan in plans.values():
+            meter_state = meter_states[plan.name]
+            if meter_state.startRetryIfDue():
+                retry = polling_engine.submit(checkConnection, plan.host, plan.port)
+                retry.add_done_callback(lambda future, meter_state=meter_state:
+                                        meter_state.finishRetry(future.exception() is None and future.result()))
         
+        polled_meters = []     # (plan, the rate groups that are due), for the meters polled on this tick
+        for plan in plans.values():
+            due_groups = [group for group in plan.groups if group.stream in due_streams]
+            if due_groups and meter_states[plan.name].shouldPoll():
+                polled_meters.append((plan, due_groups))
+        #-------------------------------------------------------------------------------------
         
+        
+            # Reading every meter at once
+        #-------------------------------------------------------------------------------------
+        # All the reads for this tick go out together through the polling engine, so the last
+        #...meter isn't sampled N round-trips after the first one. Each result carries its own
+        #...timestamp, taken when that meter's request was sent.
+        poll_requests = [PollRequest(plan.name, plan.host, (plan.host, plan.port, plan.unit_id,
+                                                            read.start_register, read.end_register))
+                         for plan, due_groups in polled_meters
+                         for group in due_groups
+                         for read in group.reads]
+        
+        poll_results = polling_engine.pollAll(poll_requests)
+        
+        meter_results = {}     # Meter name -> its PollResults, in the same order as its due groups' reads
+        for poll_result in poll_results:
+            meter_results.setdefault(poll_result.meter_name, []).append(poll_result)
+            runtime_metrics.observe('orca_modbus_round_trip_seconds', poll_result.duration, meter=poll_result.meter_name)
+        #-------------------------------------------------------------------------------------
+
+
+        for plan, due_groups in polled_meters:
             
-                # Timestamp
-            #---------------------------------------------------------------------------------   
-            timestamp = int(round(time.time(), 0))  # Making the timestamp
-            #---------------------------------------------------------------------------------   
-            
-                # Insert timestamp column
-            #---------------------------------------------------------------------------------
-            if readings[0] != 'timestamp':
-                readings.insert(0, 'timestamp') # Makes sure the data has a column for the Unix time stamp
-            #---------------------------------------------------------------------------------
+            meter_name, logger = plan.name, plan.logger
+            meter_state = meter_states[meter_name]
             
-                # Filtering out any unwanted commas and/or spaces from the list of desired columns
-            #---------------------------------------------------------------------------------
-            readings = [name.replace(',', '').strip() for name in readings]
-            #---------------------------------------------------------------------------------    
-                
-                # Creating the .csv file to be written to
-            #---------------------------------------------------------------------------------
-            now = datetime.datetime.now()
+            meter_poll_results = meter_results.get(meter_name)
+            if not meter_poll_results:     # Nothing to read for this meter
+                continue
             
-            file_name = (str(meter_name) + '_{}'*3 + '.csv').format(now.year, now.month, now.day)
-            file_path = './data/' + file_name
-            #---------------------------------------------------------------------------------
-               
-               
-               
-                # Primary readings block -- Pages MM-2 to MM-3 of the shark200 user's manual
+                # Decoding the readings -- see the meter's register map in 'shark_200_readings_blocks.py' or 'shark_100_readings_blocks.py'
             #---------------------------------------------------------------------------------
-            primary_readings_columns = shark_200_readings_blocks.primary_readings_block              # Importing the column names 
-            primary_readings_columns = [name.replace(',', '') for name in primary_readings_columns]  # cleaning column names
-            
-            primary_readings_modbus_data = getModbusData(host,                # The primary readings block goes from
-                                                         port,
-                                                         unit_id,             #...register 1000 to 1059.
-                                                         start_register=1000, # Other readings blocks will have cover different
-                                                         end_register=1059)   #...registers.                   
-                                                                  
+            failed_reads = [result for result in meter_poll_results if result.response is None]
                                                                                                                         
-            if primary_readings_modbus_data == None:           # This sometimes happens, possibly due to connection errors
-                logger.error('Modbus query returned no data')  # Reporting this error via the meter-specific logger
+            if failed_reads:                                   # This sometimes happens, possibly due to connection errors
+                logger.error('Modbus query returned no data',  # Reporting this error via the meter-specific logger
+                             exc_info=failed_reads[0].error)   # Includes the stack trace if the read raised an exception
+                meter_state.recordFailure()                    # Backs the meter off after a few failures in a row
+                runtime_metrics.increment('orca_empty_responses_total', len(failed_reads), meter=meter_name)
+                if meter_name in deadband_filters:
+                    deadband_filters[meter_name].reset()     # The next good row is written in full, so the gap shows
                 continue
             else:
+                due_reads = [read for group in due_groups for read in group.reads]
+                
+                if cache_registers is not None:     # The registers as the meter sent them, for the Modbus TCP proxy
+                    cache_registers(meter_name, [registerBlock(read.start_register - 2, result.response)  # Same offset as
+                                                 for read, result in zip(due_reads, meter_poll_results)], #...getModbusData()
+                                    meter_poll_results[0].timestamp)
+                
+                decode_started = time.monotonic()
                 try:
-                    primary_readings_data = format32BitFloat(primary_readings_modbus_data)  # See this function above for more info
-                except:
-                    logger.error('format32BitFLoat() failed to format data. Exiting...'
-                                   + '\n' + 'Received Data Type: {}'.format(type(primary_readings_modbus_data)), exc_info=True)
-                    exit()
+                    readings_data = {}
+                    for read, result in zip(due_reads, meter_poll_results):
+                        readings_data.update(plan.register_map.decodeRead(read, result.response))
+                except Exception:                   # A malformed reply only fails this meter's poll, the other meters carry on
+                    logger.error('Failed to decode data'
+                                   + '\n' + 'Received Data Types: {}'.format([type(result.response) for result in meter_poll_results]),
+                                 exc_info=True)
+                    meter_state.recordFailure()
+                    runtime_metrics.increment('orca_decode_errors_total', meter=meter_name)
+                    if meter_name in deadband_filters:
+                        deadband_filters[meter_name].reset()
+                    continue
+                meter_state.recordSuccess()
+                runtime_metrics.observe('orca_decode_seconds', time.monotonic() - decode_started, meter=meter_name)
+                runtime_metrics.increment('orca_polls_total', meter=meter_name)
+                runtime_metrics.set('orca_last_poll_timestamp_seconds', meter_poll_results[0].timestamp, meter=meter_name)
                               
             
-            temp_dict = {}     # Dictionary that will take in the new data on each loop and be cleared on each iteration.
-            
-            for index, name in enumerate(primary_readings_columns):     # Here we loop through all the possible columns in 
-                if name == 'timestamp':                                 #...this block and add them to the dictionary                             
-                    temp_dict[name] = [timestamp]
+                # Writing a row per rate group -- in the same column order as the group's writer
+            #---------------------------------------------------------------------------------
+            first_read = 0
+            for group in due_groups:
+                
+                poll_result = meter_poll_results[first_read]          # The group's first read sets its timestamp
+                first_read += len(group.reads)
+                if group.timestep is not None and group.timestep < 1:
+                    timestamp = round(poll_result.timestamp, 3)       # Sub-second timesteps keep the milliseconds
                 else:
-                    temp_dict[name] = [round(primary_readings_data[index - 1], decimal_places)]                                                                                                        
-                                                                # Here we need to reduce the index by 1
-                                                                #...to account for the added timestamp column
-            
-            temp_df = pd.DataFrame(temp_dict)     # Make a pandas.DataFrame from the dictionary                 
-            temp_df = temp_df[readings]           # Filters out all columns that weren't specified in the 'readings' variable
-            
+                    timestamp = int(round(poll_result.timestamp, 0))  # Making the timestamp from the time the request went out
                 
-            
-            if file_name not in os.listdir('./data'):                                # '.' indicates 'current directory'
-                with open(file_path, 'a') as data_file:                              # 'a' indicates 'append' to the file
-                    temp_df[temp_df['timestamp'] == 0].to_csv(data_file, header=True, index=False)  # This is a quick and dirty           
-                if file_name in os.listdir('./data'):                                               #...way to write the column
-                    logger.info('New CSV file: ' + file_name + ' successfully created')             #...column headers to the .csv                                                                                                            
-                                    
-            else:
-                with open(file_path, 'a') as data_file:                      # 'a' indicates 'append' to the file
-                    temp_df.to_csv(data_file, header=False, index=False)     # This will account for every other loop iteration
-                                                                             #...and append the data to the .csv file   
+                row = [timestamp] + [round(readings_data[name], plan.decimal_places) for name in group.columns]
+                
+                if group.stream == meter_name:     # Rollups and report by exception only cover the meter's own timestep
+                    if rollups:     # Before the deadband filter, so the statistics see every sample
+                        for stream_name, rollup_row, rollup_timestamp in rollups[meter_name].update(row, timestamp):
+                            emit(stream_name, rollup_row, rollup_timestamp)
+                    
+                    if deadband_filters:     # Leaving out the values that didn't move beyond their deadband
+                        row = deadband_filters[meter_name].filter(row, timestamp)
+                        if row is None:
+                            runtime_metrics.increment('orca_suppressed_rows_total', meter=meter_name)
+                            continue
+                        runtime_metrics.increment('orca_carried_forward_values_total', row.count(None), meter=meter_name)
+                
+                emit(group.stream, row, timestamp)
             #---------------------------------------------------------------------------------
             
             
+        for rollup in rollups.values():     # Finishing the rollups of meters that have stopped answering
+            for stream_name, rollup_row, rollup_timestamp in rollup.expire(time.time()):
+                emit(stream_name, rollup_row, rollup_timestamp)
+            
+        overrun = scheduler.finishTick([group.stream for plan, due_groups in polled_meters     # Counts any group whose pass
+                                        for group in due_groups])                          #...overran its next deadline
+        for stream in overrun:
+            if stream in meter_states:     # The meter's own timestep (not one of its block rates)
+                runtime_metrics.increment('orca_tick_overruns_total', meter=stream)
+        
+        for meter_name, meter_state in meter_states.items():
+            runtime_metrics.set('orca_meter_up', int(meter_state.state == UP), meter=meter_name)
+        runtime_metrics.observe('orca_tick_seconds', time.monotonic() - tick_started,
+                                process=multiprocessing.current_process().name)
+        
+        profiling_hooks.poll()     # Switches profiling on or off if a signal or the control file asked for it
+        
+        if after_tick is not None:
+            after_tick()     # Rotating/flushing the data files, or the worker heartbeat
+        
+        new_plans = reload_plans(plans) if reload_plans is not None else None
+        if new_plans is not None:     # The settings file changed, see loadChangedPlans()
+            added, changed, removed = comparePlans(plans, new_plans)
+            for meter_name in changed + removed:
+                removeMeter(plans[meter_name])
+            for meter_name in added + changed:
+                addMeter(new_plans[meter_name])
+            plans = new_plans
             
 
 
@@ -352,9 +1189,45 @@ def main():  # Primary function that contains the data collection loop
     ###################################################################################
     
         
-if __name__ == '__main__':
+def run(settings_module, model):
+
+    # Runs the data collection with the given settings file until the script is stopped.
+    #...'model' is the meter model of the entries in 'settings_module' (see meter_drivers.py).
+
+    global meter_settings, default_model
+    meter_settings, default_model = settings_module, model
+
+    logging_setup.startLogging('./logs', max_bytes=getattr(meter_settings, 'LOG_MAX_BYTES', 5 * 1024 * 1024),
+                               backup_count=getattr(meter_settings, 'LOG_BACKUPS', 5),
+                               summary_interval=getattr(meter_settings, 'LOG_REPEAT_SUMMARY', 300))
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: exit())     # Stopping the service (e.g. systemd) exits cleanly,
+                                                                    #...so the buffered rows below still get written
     try:
         main()
-    except:
+    except Exception:
         main_logger.error('Error in main()', exc_info=True)
-        
+    finally:
+        if backfiller is not None:
+            backfiller.close()     # A gap that was being filled is done again next time
+        if file_compressor is not None:
+            file_compressor.close()     # A file that was half done is left uncompressed
+        if write_buffer is not None:
+            write_buffer.close()     # Writes out whatever is still in the ring buffer
+        for meter_writers in data_writers.values():
+            for data_writer in meter_writers:
+                data_writer.close()
+        polling_engine.close()
+        connection_pool.closeAll()     # Closing the pooled sockets so the meters free up their connection slots
+        if modbus_proxy is not None:
+            modbus_proxy.close()
+        if sample_publisher is not None:
+            sample_publisher.close()
+        runtime_metrics.close()
+        if profiling_hooks is not None:
+            profiling_hooks.close()     # Writes out a profile that was still running
+        logging_setup.stopLogging()     # Writes out the queued messages and any repeat summaries
+
+
+if __name__ == '__main__':
+    run(shark_200_meter_settings, SHARK_200)
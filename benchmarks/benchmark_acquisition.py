@@ -0,0 +1,338 @@
+"""
+--------------------------------------------------------------------------------------
+ORCA Acquisition Benchmark
+
+Measures how many meters per second the logger can sustain, and where the time goes,
+against simulated Shark meters on localhost (see simulated_meters.py). For each fleet
+size the meters are started in a separate process and polled back-to-back, with no
+timestep in between, for '--duration' seconds. Each pass does the same steps as one
+tick of the main script's acquisitionLoop(), timed one by one:
+
+    connect    opening each meter's pooled connection (once, before the passes)
+    read       one register read, as seen by the polling engine
+    poll       one whole pollAll() over every meter (the network part of a tick)
+    decode     turning one meter's responses into readings (register_map.decodeRead)
+    write      rounding one meter's row and handing it to its MeterCsvWriter
+
+It also reports polls per second, the CPU time used by the logger (the simulated
+meters run in their own process and are not counted) and its resident memory. A few
+micro-benchmarks that don't touch the network (format32BitFloat(), decodeRead() and
+the CSV writer) are run once per benchmark, since they are the least noisy way to spot
+a regression in those functions.
+
+Everything is written to a JSON file. Passing an earlier file as '--baseline' prints
+the change in every figure and exits with status 1 if anything got worse by more than
+'--tolerance':
+
+    python benchmarks/benchmark_acquisition.py --meters 1 10 100 1000 --output results.json
+    python benchmarks/benchmark_acquisition.py --output new.json --baseline results.json
+
+Linux only: the simulated meters each listen on their own 127.0.x.y address.
+--------------------------------------------------------------------------------------
+"""
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pyModbusTCP
+
+ORCA_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(1, ORCA_DIRECTORY)  # The ORCA modules live one directory up
+from csv_data_writer import MeterCsvWriter
+from meter_drivers import buildMeters, MODELS, SHARK_200
+from modbus_connection_pool import ModbusConnectionPool
+from polling_engine import PollingEngine, PollRequest
+from register_map import cleanName
+from simulated_meters import serveMeters, meterAddress, DEFAULT_PORT
+
+
+DEFAULT_METER_COUNTS = [1, 10, 100, 1000]
+MICRO_ITERATIONS = 20000
+
+
+    # Measurement helpers
+#######################################################################################
+def summarize(samples):
+    # Percentiles of a list of durations in seconds, reported in milliseconds
+    if not samples:
+        return {'count': 0}
+    milliseconds = np.asarray(samples) * 1000.0
+    p50, p90, p99 = np.percentile(milliseconds, [50, 90, 99])
+    return {'count': len(samples), 'mean_ms': float(milliseconds.mean()), 'p50_ms': float(p50),
+            'p90_ms': float(p90), 'p99_ms': float(p99), 'max_ms': float(milliseconds.max())}
+
+
+def residentMemory():
+    # Current resident set size of this process in MB (Linux), and its peak so far
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0     # ru_maxrss is in KB on Linux
+    try:
+        with open('/proc/self/statm') as statm:
+            current = int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2.0 ** 20
+    except (OSError, ValueError):
+        current = None
+    return current, peak
+
+
+def raiseFileLimit():
+    # 1000 meters need a few thousand sockets, more than the usual soft limit of 1024
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = 65536 if hard == resource.RLIM_INFINITY else hard
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+
+def gitRevision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ORCA_DIRECTORY,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+#######################################################################################
+
+
+def runScenario(engine, meter_count, model, duration, port, data_directory):
+
+    # Polls 'meter_count' simulated meters back-to-back for 'duration' seconds and returns
+    #...the results as a dictionary.
+
+    readings = MODELS[model].register_map.names(block='primary')
+
+    ready = multiprocessing.Event()
+    server_process = multiprocessing.Process(target=serveMeters, args=(meter_count, model, port, 0, ready), daemon=True)
+    server_process.start()
+    if not ready.wait(60 + meter_count * 0.1):
+        server_process.terminate()
+        raise RuntimeError('The simulated meters did not start')
+
+    entries = [('Bench_{}'.format(index), meterAddress(index), port, 3, 1, list(readings)) for index in range(meter_count)]
+    meters = buildMeters(entries, model)
+    read_plans = {meter.name: meter.planReads() for meter in meters}
+    columns = ['timestamp'] + [cleanName(name) for name in readings]
+
+    # A fresh pool and polling engine for every fleet size, like acquisitionWorker() does
+    engine.connection_pool = ModbusConnectionPool()
+    engine.polling_engine = PollingEngine(engine.getModbusData, max_in_flight_per_host=1,
+                                          batch_function=engine.getModbusBatch)
+    writers = {meter.name: MeterCsvWriter(meter.name, columns, directory=data_directory) for meter in meters}
+
+    connect_times, read_times, poll_times, decode_times, write_times = [], [], [], [], []
+    polls, failed, passes = 0, 0, 0
+
+    try:
+        for meter in meters:
+            started = time.perf_counter()
+            if not engine.connection_pool.isConnected(meter.host, meter.port):
+                raise RuntimeError('Could not connect to simulated meter {}'.format(meter.host))
+            connect_times.append(time.perf_counter() - started)
+
+        poll_requests = [PollRequest(meter.name, meter.host,
+                                     (meter.host, meter.port, meter.unit_id, read.start_register, read.end_register))
+                         for meter in meters for read in read_plans[meter.name]]
+
+        cpu_before = os.times()
+        wall_started = time.perf_counter()
+
+        while time.perf_counter() - wall_started < duration:
+            started = time.perf_counter()
+            poll_results = engine.polling_engine.pollAll(poll_requests)
+            poll_times.append(time.perf_counter() - started)
+            read_times.extend(result.duration for result in poll_results)
+
+            meter_results = {}
+            for poll_result in poll_results:
+                meter_results.setdefault(poll_result.meter_name, []).append(poll_result)
+
+            for meter in meters:
+                results = meter_results[meter.name]
+                if any(result.response is None for result in results):
+                    failed += 1
+                    continue
+
+                started = time.perf_counter()
+                readings_data = {}
+                for read, result in zip(read_plans[meter.name], results):
+                    readings_data.update(meter.register_map.decodeRead(read, result.response))
+                decode_times.append(time.perf_counter() - started)
+
+                started = time.perf_counter()
+                timestamp = results[0].timestamp
+                row = [int(timestamp)] + [round(readings_data[name], meter.decimal_places) for name in columns[1:]]
+                writers[meter.name].writeRow(row, timestamp)
+                writers[meter.name].maintain()
+                write_times.append(time.perf_counter() - started)
+                polls += 1
+
+            passes += 1
+
+        wall = time.perf_counter() - wall_started
+        cpu_after = os.times()
+
+    finally:
+        for writer in writers.values():
+            writer.close()
+        engine.polling_engine.close()
+        engine.connection_pool.closeAll()
+        server_process.terminate()
+        server_process.join()
+
+    cpu_user = cpu_after.user - cpu_before.user
+    cpu_system = cpu_after.system - cpu_before.system
+    rss_current, rss_peak = residentMemory()
+
+    return {'meters': meter_count,
+            'model': model,
+            'duration_s': wall,
+            'passes': passes,
+            'polls': polls,
+            'failed_polls': failed,
+            'polls_per_second': polls / wall,
+            'phases': {'connect': summarize(connect_times), 'read': summarize(read_times),
+                       'poll': summarize(poll_times), 'decode': summarize(decode_times),
+                       'write': summarize(write_times)},
+            'cpu': {'user_s': cpu_user, 'system_s': cpu_system,
+                    'percent_of_one_core': 100.0 * (cpu_user + cpu_system) / wall},
+            'rss_mb': {'current': rss_current, 'peak': rss_peak}}
+
+
+def runMicroBenchmarks(engine, model, data_directory, iterations=MICRO_ITERATIONS):
+
+    # Times the pure-Python parts of a tick on canned data, without any network traffic
+
+    from simulated_meters import registerContents, REGISTER_OFFSET
+
+    register_map = MODELS[model].register_map
+    readings = register_map.names(block='primary')
+    read = register_map.planReads(readings)[0]
+
+    contents = registerContents(register_map)
+    response = []
+    for address in range(read.start_register - REGISTER_OFFSET, read.end_register - REGISTER_OFFSET + 1):
+        response.extend(contents.get(address, []))
+    response = response[:read.end_register - read.start_register + 1]
+
+    def timed(function):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            function()
+        return (time.perf_counter() - started) / iterations * 1e6     # Microseconds per call
+
+    writer = MeterCsvWriter('Micro', ['timestamp'] + readings, directory=data_directory, flush_interval=3600)
+    row = [1600000000] + [230.123] * len(readings)
+    try:
+        results = {'format32BitFloat_us': timed(lambda: engine.format32BitFloat(response)),
+                   'decodeRead_us': timed(lambda: register_map.decodeRead(read, response)),
+                   'csv_writeRow_us': timed(lambda: writer.writeRow(row, row[0]))}
+    finally:
+        writer.close()
+
+    results['registers'] = len(response)
+    return results
+
+
+    # Comparing against a baseline
+#######################################################################################
+def _figures(results):
+    # Flattens a results file into {name: (value, higher_is_better)}
+    figures = {}
+    for name, value in results.get('micro', {}).items():
+        if name.endswith('_us'):
+            figures['micro ' + name] = (value, False)
+    for scenario in results.get('scenarios', []):
+        prefix = '{} x {} '.format(scenario['meters'], scenario['model'])
+        figures[prefix + 'polls_per_second'] = (scenario['polls_per_second'], True)
+        figures[prefix + 'cpu_percent'] = (scenario['cpu']['percent_of_one_core'], False)
+        for phase, summary in scenario['phases'].items():
+            # Medians only: the tails of sub-millisecond phases are mostly scheduler noise,
+            #...and 'connect' is a single sample per meter
+            if phase != 'connect' and summary.get('count'):
+                figures[prefix + phase + ' p50_ms'] = (summary['p50_ms'], False)
+    return figures
+
+
+def compareResults(results, baseline, tolerance):
+    # Prints every figure next to its baseline. Returns the names of the ones that regressed.
+    current, previous = _figures(results), _figures(baseline)
+    regressions = []
+    print('{:<48} {:>12} {:>12} {:>8}'.format('', 'baseline', 'now', 'change'))
+    for name in sorted(current):
+        if name not in previous or not previous[name][0]:
+            continue
+        value, higher_is_better = current[name]
+        change = value / previous[name][0] - 1.0
+        worse = -change if higher_is_better else change
+        flag = ''
+        if worse > tolerance:
+            regressions.append(name)
+            flag = '  <-- REGRESSION'
+        print('{:<48} {:>12.3f} {:>12.3f} {:>+8.1%}{}'.format(name, previous[name][0], value, change, flag))
+    return regressions
+#######################################################################################
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ORCA against simulated Shark meters')
+    parser.add_argument('--meters', type=int, nargs='+', default=DEFAULT_METER_COUNTS, help='Fleet sizes to run')
+    parser.add_argument('--model', default=SHARK_200, choices=sorted(MODELS))
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds of polling per fleet size')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', help='Earlier results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown before a figure counts as a regression')
+    arguments = parser.parse_args()
+
+    output = os.path.abspath(arguments.output)
+    baseline = None
+    if arguments.baseline:
+        with open(arguments.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    raiseFileLimit()
+
+    with tempfile.TemporaryDirectory(prefix='orca-benchmark-') as work_directory:
+        # The main script sets up './logs' when it is imported, so it is imported from a scratch directory
+        os.chdir(work_directory)
+        os.mkdir('data')
+        import ORCA_shark200_main_script as engine
+
+        results = {'metadata': {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                                'git_revision': gitRevision(),
+                                'python': platform.python_version(),
+                                'platform': platform.platform(),
+                                'cpu_count': os.cpu_count(),
+                                'numpy': np.__version__,
+                                'pyModbusTCP': getattr(pyModbusTCP, '__version__', None),
+                                'duration_s': arguments.duration},
+                   'micro': runMicroBenchmarks(engine, arguments.model, 'data'),
+                   'scenarios': []}
+
+        for meter_count in arguments.meters:
+            print('Benchmarking {} {} meter(s)...'.format(meter_count, arguments.model))
+            scenario = runScenario(engine, meter_count, arguments.model, arguments.duration, arguments.port, 'data')
+            results['scenarios'].append(scenario)
+            print('    {:.1f} polls/s, read p50 {:.2f} ms p99 {:.2f} ms, CPU {:.0f}%, RSS {:.0f} MB'.format(
+                scenario['polls_per_second'], scenario['phases']['read'].get('p50_ms', 0),
+                scenario['phases']['read'].get('p99_ms', 0), scenario['cpu']['percent_of_one_core'],
+                scenario['rss_mb']['peak']))
+
+    with open(output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print('Results written to ' + output)
+
+    if baseline is not None:
+        regressions = compareResults(results, baseline, arguments.tolerance)
+        if regressions:
+            print('{} figure(s) regressed by more than {:.0%}'.format(len(regressions), arguments.tolerance))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""
+--------------------------------------------------------------------------------------
+ORCA Simulated Meters
+
+Starts Modbus TCP servers on localhost that answer like Shark 100/200 meters, for the
+benchmarks. Every server holds a full register map (see the *_readings_blocks.py files)
+filled with plausible values: ~277/480 V, ~120 A, 60 Hz, power factor ~0.95, energy
+counters, demand and so on, each meter slightly different.
+
+Each simulated meter listens on its own loopback address (127.0.0.2, 127.0.0.3, ...,
+all of which reach the local machine on Linux), so, like real meters, they each get
+their own connection and their own per-host request limit in the polling engine.
+
+Can also be run on its own to point a regular ORCA install at some fake meters:
+
+    python benchmarks/simulated_meters.py 10 --model shark200
+--------------------------------------------------------------------------------------
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+import numpy as np
+from pyModbusTCP.server import ModbusServer
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))  # The ORCA modules live one directory up
+from meter_drivers import MODELS, SHARK_200
+from register_decoder import DATA_TYPES
+
+
+DEFAULT_PORT = 5020     # Unprivileged, unlike the usual 502
+REGISTER_OFFSET = 2     # getModbusData() subtracts this from the register numbers in the user's manual
+
+
+def meterAddress(index):
+    # Loopback address of the index'th simulated meter: 127.0.0.2, ..., 127.0.0.254, 127.0.1.1, ...
+    return '127.0.{}.{}'.format(index // 253, index % 253 + 2)
+
+
+def typicalValue(name, rng):
+    # A plausible reading for a register name, with some variation from meter to meter
+    name = name.lower()
+    if 'power factor' in name:
+        return rng.uniform(0.85, 0.99)
+    if 'frequency' in name:
+        return rng.uniform(59.95, 60.05)
+    if 'volts' in name:
+        return rng.uniform(470, 490) if '-n' not in name else rng.uniform(271, 283)
+    if 'neutral' in name:
+        return rng.uniform(0, 5)
+    if 'amps' in name:
+        return rng.uniform(80, 160)
+    if 'watt' in name or 'var' in name or 'va' in name:
+        return rng.uniform(20e3, 120e3)
+    if 'symmetrical' in name:
+        return rng.uniform(0, 300)
+    return rng.uniform(0, 1e6)     # Energy accumulators and anything else
+
+
+def encodeValue(value, data_type, scale=None, word_order='little'):
+    # Inverse of register_decoder.decodeRegisters() for a single value: returns its registers
+    words_per_value, value_dtype = DATA_TYPES[data_type]
+    raw = value / scale if scale else value
+    if value_dtype.kind in 'iu':
+        info = np.iinfo(value_dtype)
+        raw = int(min(max(round(raw), info.min), info.max))
+    words = np.array([raw], dtype=value_dtype).view('>u2').tolist()     # Most significant register first
+    if word_order == 'little':
+        words.reverse()
+    return words
+
+
+def registerContents(register_map, seed=0):
+    # Returns {address: registers} for every block of 'register_map', ready to load into a server
+    rng = random.Random(seed)
+    contents = {}
+    for register in register_map.registers.values():
+        words = encodeValue(typicalValue(register.name, rng), register.data_type, register.scale)
+        contents[register.address - REGISTER_OFFSET] = words
+    return contents
+
+
+def _setHoldingRegisters(server, address, words):
+    # pyModbusTCP 0.2+ gives each server its own data bank, 0.1.x has one shared class-level bank
+    if hasattr(server, 'data_bank'):
+        server.data_bank.set_holding_registers(address, words)
+    else:
+        from pyModbusTCP.server import DataBank
+        DataBank.set_words(address, words)
+
+
+def startMeters(count, model=SHARK_200, port=DEFAULT_PORT, first_index=0):
+
+    # Starts 'count' simulated meters of 'model' in background threads of this process.
+    # Returns the list of (host, port, server) for them.
+
+    register_map = MODELS[model].register_map
+    meters = []
+
+    for index in range(first_index, first_index + count):
+        host = meterAddress(index)
+        server = ModbusServer(host=host, port=port, no_block=True)
+        server.start()
+        for address, words in sorted(registerContents(register_map, seed=index).items()):
+            _setHoldingRegisters(server, address, words)
+        meters.append((host, port, server))
+
+    return meters
+
+
+def stopMeters(meters):
+    for host, port, server in meters:
+        server.stop()
+
+
+def serveMeters(count, model=SHARK_200, port=DEFAULT_PORT, first_index=0, ready=None):
+    # Runs the simulated meters until the process is terminated. Meant as the target of a
+    #...multiprocessing.Process, so the benchmarked logger doesn't share a CPU budget with them.
+    #...'ready' (a multiprocessing.Event) is set once every meter is listening.
+    meters = startMeters(count, model, port, first_index)
+    if ready is not None:
+        ready.set()
+    try:
+        while True:
+            time.sleep(1)
+    finally:
+        stopMeters(meters)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run simulated Shark meters on localhost')
+    parser.add_argument('count', type=int, help='Number of meters')
+    parser.add_argument('--model', default=SHARK_200, choices=sorted(MODELS))
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    arguments = parser.parse_args()
+
+    print('Serving {} {} meters on {} to {}, port {}'.format(arguments.count, arguments.model, meterAddress(0),
+                                                             meterAddress(arguments.count - 1), arguments.port))
+    try:
+        serveMeters(arguments.count, arguments.model, arguments.port)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,301 @@
+"""
+--------------------------------------------------------------------------------------
+ORCA Binary Data Store
+
+Optional storage backend that appends every sample as a fixed-width binary record
+instead of a line of text. Each meter gets one file per day (or hour), named like the
+.csv files but ending in '.orca':
+
+    [ 8 bytes ]  magic 'ORCABIN1'
+    [ 4 bytes ]  length of the JSON header, little-endian uint32
+    [ N bytes ]  JSON header: {"columns": [[name, numpy dtype], ...]}, padded with spaces
+                 so that the records start on a 64-byte boundary
+    [ records ]  one record per sample: 'timestamp' as float64, then one field per reading
+
+Because every record has the same size, a file can be memory-mapped straight into a
+NumPy structured array (openDataFile), a time slice is two binary searches on the
+timestamp column (readTimeSlice), and nothing has to be parsed. exportCsv() converts a
+file back into the regular .csv layout, and can be run from the command line:
+
+    python binary_data_store.py <file.orca> [<file.orca> ...]
+
+With REPORT_BY_EXCEPTION on (see deadband_filter.py), values that were carried forward
+are stored as NaN, and integer readings are stored as float64 so they can be NaN too.
+--------------------------------------------------------------------------------------
+"""
+
+import argparse
+import csv
+import io
+import json
+import os
+import struct
+import time
+import numpy as np
+from csv_data_writer import dataFileName, periodBounds, DAY
+from register_decoder import INT16, UINT16, INT32, UINT32, INT64, UINT64
+from file_compressor import openData, findDataFile, uncompressedPath
+
+
+MAGIC = b'ORCABIN1'
+EXTENSION = '.orca'
+RECORD_ALIGNMENT = 64     # Records start on a multiple of this many bytes
+
+# Register data type -> record field type. Floats (and scaled integers, which end up as
+#...floats) are stored as float32, which is all the precision the meters give us.
+_INTEGER_FIELD_TYPES = {INT16: '<i2', UINT16: '<u2', INT32: '<i4', UINT32: '<u4', INT64: '<i8', UINT64: '<u8'}
+
+
+def columnType(register):
+    # Record field type for a register_map.Register
+    if register.scale is None and register.data_type in _INTEGER_FIELD_TYPES:
+        return _INTEGER_FIELD_TYPES[register.data_type]
+    return '<f4'
+
+
+def _header(columns):
+    # Builds the file header for a list of (name, dtype) columns
+    body = json.dumps({'columns': [list(column) for column in columns]}).encode('utf-8')
+    padding = -(len(MAGIC) + 4 + len(body)) % RECORD_ALIGNMENT
+    body += b' ' * padding
+    return MAGIC + struct.pack('<I', len(body)) + body
+
+
+def _readHeader(data_file):
+    # Returns (list of (name, dtype) columns, offset of the first record)
+    magic = data_file.read(len(MAGIC))
+    if magic != MAGIC:
+        raise ValueError('{} is not an ORCA binary data file'.format(getattr(data_file, 'name', data_file)))
+    length, = struct.unpack('<I', data_file.read(4))
+    header = json.loads(data_file.read(length).decode('utf-8'))
+    return [tuple(column) for column in header['columns']], len(MAGIC) + 4 + length
+
+
+class MeterBinaryWriter:
+
+    # Same interface as csv_data_writer.MeterCsvWriter, so main() can use either or both.
+
+    def __init__(self, meter_name, columns, column_types, directory='./data', rotation=DAY,
+                 flush_interval=10.0, flush_bytes=64 * 1024, fsync=False, logger=None):
+
+        # 'columns' includes 'timestamp' first, like the .csv writer's. 'column_types' has one
+        #...NumPy type per reading, i.e. one fewer than 'columns'.
+        if len(column_types) != len(columns) - 1:
+            raise ValueError('Need one column type per reading for {}'.format(meter_name))
+
+        self.meter_name = meter_name
+        self.columns = [('timestamp', '<f8')] + list(zip(columns[1:], column_types))
+        self.dtype = np.dtype([(name, column_type) for name, column_type in self.columns])
+        self.directory = directory
+        self.rotation = rotation
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.logger = logger
+
+        self.file_path = None
+        self._file = None
+        self._period_start = None
+        self._period_end = None
+        self._buffer = np.zeros(max(1, flush_bytes // self.dtype.itemsize), dtype=self.dtype)   # Preallocated records
+        self._buffered = 0
+        self._last_flush = time.monotonic()
+
+    def _open(self, timestamp):
+        self.close()
+
+        start, self._period_end = periodBounds(timestamp, self.rotation)
+        self._period_start = time.mktime(start.timetuple())
+        base_name = dataFileName(self.meter_name, start, self.rotation, extension='')
+
+        # If today's file was started with different columns (the settings changed), the
+        #...records wouldn't line up, so a new numbered file is started instead.
+        suffix = 0
+        while True:
+            file_name = base_name + ('_{}'.format(suffix) if suffix else '') + EXTENSION
+            self.file_path = os.path.join(self.directory, file_name)
+            if not os.path.exists(self.file_path) or os.path.getsize(self.file_path) == 0:
+                self._file = open(self.file_path, 'wb')
+                self._file.write(_header(self.columns))
+                self._file.flush()
+                if self.logger is not None:
+                    self.logger.info('New binary data file: ' + file_name + ' successfully created')
+                break
+
+            with open(self.file_path, 'rb') as existing:
+                columns, records_offset = _readHeader(existing)
+            if columns == self.columns:
+                self._file = open(self.file_path, 'ab')
+                # Dropping a partial record left behind by a power cut, so everything stays aligned
+                size = os.path.getsize(self.file_path)
+                partial = (size - records_offset) % self.dtype.itemsize
+                if partial:
+                    self._file.truncate(size - partial)
+                break
+            suffix += 1
+
+    def writeRow(self, row, timestamp):
+        if self._file is not None and timestamp < self._period_start:
+            self._writeLate(row, timestamp)     # E.g. a rollup interval that ended just before the rotation
+            return
+        if self._file is None or timestamp >= self._period_end:
+            self._flushBuffer()
+            self._open(timestamp)
+
+        if None in row:     # Values carried forward by the deadband filter are stored as NaN
+            row = [float('nan') if value is None else value for value in row]
+        self._buffer[self._buffered] = tuple(row)
+        self._buffered += 1
+
+        if self._buffered == len(self._buffer):
+            self.flush()
+
+    def _writeLate(self, row, timestamp):
+        # Same as MeterCsvWriter._writeLate(): into the earlier period's file, then back
+        current = self._period_start
+        self._flushBuffer()
+        self._open(timestamp)
+        self.writeRow(row, timestamp)
+        self._flushBuffer()
+        self._open(current)
+
+    def maintain(self, now=None):
+        now = time.time() if now is None else now
+
+        if self._file is not None and now >= self._period_end:
+            self._flushBuffer()
+            self._open(now)
+
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def _flushBuffer(self):
+        if self._file is not None and self._buffered:
+            self._file.write(self._buffer[:self._buffered].tobytes())
+        self._buffered = 0
+
+    def flush(self):
+        self._flushBuffer()
+        if self._file is not None:
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+        self._last_flush = time.monotonic()
+
+    def sync(self):
+        # Flushes and forces the file onto the disk, whatever the 'fsync' setting is
+        self._flushBuffer()
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+
+    # Reader API
+#######################################################################################
+def openDataFile(path):
+    # Memory-maps a binary data file as a read-only NumPy structured array. Nothing is read
+    #...until the returned array is used. A compressed file (see file_compressor.py) is read
+    #...into memory instead.
+    path = uncompressedPath(path)
+    if findDataFile(path) != path:
+        with openData(path, 'rb') as data_file:
+            data = data_file.read()
+        columns, records_offset = _readHeader(io.BytesIO(data))
+        dtype = np.dtype([(str(name), column_type) for name, column_type in columns])
+        record_count = (len(data) - records_offset) // dtype.itemsize
+        return np.frombuffer(data, dtype=dtype, count=record_count, offset=records_offset)
+
+    with open(path, 'rb') as data_file:
+        columns, records_offset = _readHeader(data_file)
+    dtype = np.dtype([(str(name), column_type) for name, column_type in columns])
+
+    record_count = (os.path.getsize(path) - records_offset) // dtype.itemsize
+    if record_count == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=records_offset, shape=(record_count,))
+
+
+def readTimeSlice(meter_name, start, end, directory='./data', rotation=DAY):
+
+    # Returns every record of 'meter_name' with start <= timestamp < end (Unix timestamps),
+    #...across as many daily (or hourly) files as the range covers, as one structured array.
+    #...The backfilled streams are appended one gap at a time (see historical_backfill.py), so
+    #...their files are searched in full and sorted rather than binary searched.
+
+    from historical_backfill import BACKFILL_SUFFIX     # (historical_backfill imports this module)
+    in_order = not meter_name.endswith(BACKFILL_SUFFIX)
+
+    slices = []
+    period_timestamp = start
+    while period_timestamp < end:
+        period_start, period_end = periodBounds(period_timestamp, rotation)
+        base_name = dataFileName(meter_name, period_start, rotation, extension='')
+
+        suffix = 0
+        while True:
+            path = os.path.join(directory, base_name + ('_{}'.format(suffix) if suffix else '') + EXTENSION)
+            if findDataFile(path) is None:
+                break
+            records = openDataFile(path)
+            timestamps = records['timestamp']
+            if in_order:
+                first, last = np.searchsorted(timestamps, start, 'left'), np.searchsorted(timestamps, end, 'left')
+                if last > first:
+                    slices.append(np.array(records[first:last]))     # Copying just the slice out of the memory map
+            else:
+                selected = records[(timestamps >= start) & (timestamps < end)]
+                if len(selected):
+                    slices.append(selected[np.argsort(selected['timestamp'], kind='stable')])
+            suffix += 1
+
+        period_timestamp = period_end
+
+    if not slices:
+        return np.zeros(0, dtype=[('timestamp', '<f8')])
+    if any(piece.dtype != slices[0].dtype for piece in slices):
+        raise ValueError('The columns of {} changed within the requested range'.format(meter_name))
+    return np.concatenate(slices)
+
+
+def exportCsv(path, csv_path=None):
+    # Writes a binary data file out in the regular .csv layout. Returns the .csv path.
+    records = openDataFile(path)
+    csv_path = csv_path or os.path.splitext(uncompressedPath(path))[0] + '.csv'
+
+    # Converting column by column: astype(str) gives the shortest representation of each
+    #...float32 (e.g. '230.321'), just like the rounded values in the .csv files.
+    columns = []
+    for name in records.dtype.names:
+        column = np.asarray(records[name])
+        if name == 'timestamp' and np.all(column == np.round(column)):
+            column = column.astype(np.int64)     # Whole-second timestamps are written without a decimal point
+        text = column.astype(str)
+        if column.dtype.kind == 'f':
+            text[np.isnan(column)] = ''          # Carried forward by the deadband filter, blank like in the .csv files
+        columns.append(text)
+
+    with open(csv_path, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file, lineterminator='\n')
+        writer.writerow(records.dtype.names)
+        writer.writerows(zip(*columns))
+    return csv_path
+#######################################################################################
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export ORCA binary data files to .csv')
+    parser.add_argument('files', nargs='+', help='.orca files to convert')
+    parser.add_argument('--output-dir', help='Directory for the .csv files (default: next to each .orca file)')
+    arguments = parser.parse_args()
+
+    for path in arguments.files:
+        csv_path = None
+        if arguments.output_dir:
+            csv_path = os.path.join(arguments.output_dir, os.path.splitext(os.path.basename(uncompressedPath(path)))[0] + '.csv')
+        print('{} -> {}'.format(path, exportCsv(path, csv_path)))
@@ -0,0 +1,190 @@
+"""
+--------------------------------------------------------------------------------------
+ORCA Buffered CSV Writer
+
+One MeterCsvWriter per meter keeps the current data file open and writes each sample as
+a plain row in a fixed column order, instead of building a one-row pandas DataFrame,
+scanning './data' with os.listdir() and opening and closing the file on every tick.
+
+- Files are named '<meter>_<year>_<month>_<day>.csv' as before, or
+  '<meter>_<year>_<month>_<day>_<hour>.csv' with hourly rotation.
+- Files are rotated exactly at the day (or hour) boundary. maintain() is called every
+  tick for every meter, so the new file is created on time even while a meter is down.
+  A row that still belongs to an earlier period (e.g. a rollup interval that ended just
+  before midnight, written after the rotation) goes into that period's file.
+- Rows are buffered and flushed every 'flush_interval' seconds or once 'flush_bytes'
+  bytes are waiting, whichever comes first. With fsync=True every flush is also forced
+  onto the disk.
+- If the day's file was started with other columns (the settings changed), a new
+  numbered file is started next to it, e.g. '<meter>_<year>_<month>_<day>_1.csv'.
+- Alongside every file a small time index ('<file>.csv.idx', see time_index.py) records
+  where each minute's rows start, so a time range can be read without parsing the
+  whole file. index_interval=None turns it off.
+--------------------------------------------------------------------------------------
+"""
+
+import csv
+import datetime
+import io
+import os
+import time
+from time_index import TimeIndexWriter, DEFAULT_INTERVAL
+
+
+DAY = 'day'
+HOUR = 'hour'
+
+
+def dataFileName(meter_name, start, rotation=DAY, extension='.csv'):
+    # File name for the period starting at the datetime 'start'
+    if rotation == HOUR:
+        return (str(meter_name) + '_{}'*4 + extension).format(start.year, start.month, start.day, start.hour)
+    return (str(meter_name) + '_{}'*3 + extension).format(start.year, start.month, start.day)
+
+
+def periodBounds(timestamp, rotation=DAY):
+    # Start (as a local datetime) and end (as a Unix timestamp) of the day or hour containing 'timestamp'
+    moment = datetime.datetime.fromtimestamp(timestamp)
+    if rotation == HOUR:
+        start = moment.replace(minute=0, second=0, microsecond=0)
+        end = start + datetime.timedelta(hours=1)
+    else:
+        start = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+        end = start + datetime.timedelta(days=1)
+    return start, time.mktime(end.timetuple())
+
+
+class MeterCsvWriter:
+
+    def __init__(self, meter_name, columns, directory='./data', rotation=DAY,
+                 flush_interval=10.0, flush_bytes=64 * 1024, fsync=False, logger=None, index_interval=DEFAULT_INTERVAL):
+        if rotation not in (DAY, HOUR):
+            raise ValueError("Rotation must be '{}' or '{}', got {}".format(DAY, HOUR, rotation))
+
+        self.meter_name = meter_name
+        self.columns = list(columns)     # Column order is fixed for the life of the writer
+        self.directory = directory
+        self.rotation = rotation
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.fsync = fsync
+        self.logger = logger
+        self.index_interval = index_interval
+
+        self.file_path = None
+        self._file = None
+        self._period_start = None        # Unix timestamp at which the current file's period started
+        self._period_end = None          # Unix timestamp at which the current file is rotated
+        self._index = None               # TimeIndexWriter of the current file
+        self._file_size = 0              # Bytes in the current file, not counting the buffered rows
+        self._row_buffer = io.StringIO() # Rows formatted since the last flush
+        self._row_writer = csv.writer(self._row_buffer, lineterminator='\n')
+        self._last_flush = time.monotonic()
+
+    def _open(self, timestamp):
+        # Closes the current file (if any) and opens the one for the period containing 'timestamp'
+        self.close()
+
+        start, self._period_end = periodBounds(timestamp, self.rotation)
+        self._period_start = time.mktime(start.timetuple())
+        base_name = dataFileName(self.meter_name, start, self.rotation, extension='')
+
+        # If today's file was started with different columns (the settings changed), the rows
+        #...wouldn't line up with its headers, so a new numbered file is started instead.
+        suffix = 0
+        while True:
+            self.file_path = os.path.join(self.directory, base_name + ('_{}'.format(suffix) if suffix else '') + '.csv')
+            new_file = not os.path.exists(self.file_path) or os.path.getsize(self.file_path) == 0
+            if new_file:
+                break
+            with open(self.file_path, newline='') as existing:
+                if next(csv.reader([existing.readline()]), None) == self.columns:
+                    break
+            suffix += 1
+
+        self._file = open(self.file_path, 'a', newline='')     # 'a' indicates 'append' to the file
+
+        if new_file:
+            csv.writer(self._file, lineterminator='\n').writerow(self.columns)   # Column headers go first
+            self._file.flush()
+            if self.logger is not None:
+                self.logger.info('New CSV file: ' + os.path.basename(self.file_path) + ' successfully created')
+
+        self._file_size = os.path.getsize(self.file_path)
+        if self.index_interval is not None:
+            self._index = TimeIndexWriter(self.file_path, self.index_interval, new_file)
+
+    def writeRow(self, row, timestamp):
+        # 'row' must be in the same order as 'columns'. 'timestamp' picks the file it goes into.
+        if self._file is not None and timestamp < self._period_start:
+            self._writeLate(row, timestamp)
+            return
+        if self._file is None or timestamp >= self._period_end:
+            self._flushBuffer()
+            self._open(timestamp)
+
+        if self._index is not None:     # The rows are plain ASCII numbers, so characters and bytes line up
+            self._index.add(timestamp, self._file_size + self._row_buffer.tell())
+        self._row_writer.writerow(row)
+
+        if self._row_buffer.tell() >= self.flush_bytes:
+            self.flush()
+
+    def _writeLate(self, row, timestamp):
+        # Appends a row to the file of the earlier period it belongs to, then goes back to the
+        #...current file. Rare (once per period at most for a rollup), so reopening is fine.
+        current = self._period_start
+        self._flushBuffer()
+        self._open(timestamp)
+        self.writeRow(row, timestamp)
+        self._flushBuffer()
+        self._open(current)
+
+    def maintain(self, now=None):
+        # Called once per tick: rotates at the period boundary even if no rows are coming in,
+        #...and flushes rows that have been waiting longer than 'flush_interval'.
+        now = time.time() if now is None else now
+
+        if self._file is not None and now >= self._period_end:
+            self._flushBuffer()
+            self._open(now)
+
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def _flushBuffer(self):
+        # Moves the buffered rows into the open file
+        if self._file is not None and self._row_buffer.tell():
+            self._file.write(self._row_buffer.getvalue())
+            self._file_size += self._row_buffer.tell()
+        self._row_buffer.seek(0)
+        self._row_buffer.truncate()
+
+    def flush(self):
+        self._flushBuffer()
+        if self._file is not None:
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+        if self._index is not None:
+            self._index.flush(self.fsync)     # Only once the rows it points at are in the file
+        self._last_flush = time.monotonic()
+
+    def sync(self):
+        # Flushes and forces the file onto the disk, whatever the 'fsync' setting is
+        self._flushBuffer()
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        if self._index is not None:
+            self._index.flush(fsync=True)
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+        if self._index is not None:
+            self._index.close()
+            self._index = None
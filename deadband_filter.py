@@ -0,0 +1,106 @@
+"""
+--------------------------------------------------------------------------------------
+ORCA Deadband Filter (report by exception)
+
+Most rows in the data files repeat the previous values to within the meter's precision,
+especially for slow quantities like frequency and voltage. With REPORT_BY_EXCEPTION on,
+each meter's rows go through a DeadbandFilter before they are written:
+
+- A value is only written when it has moved beyond its deadband since the last value
+  that was written. The deadband is either absolute (e.g. 0.02 for frequency) or a
+  percentage of the last written value (e.g. '0.5%'). Readings without a deadband are
+  written whenever their rounded value changes at all.
+- Values that didn't move are left blank in the .csv files (NaN in the binary .orca
+  files), meaning "same as the last value written above". A row where nothing moved
+  is not written at all.
+- A full row (a keyframe) is still written at the start of every data file, after a
+  meter comes back from a failed read, and at least every MAX_SILENCE seconds. So every
+  file can be read on its own, and a meter that stopped answering can be told apart
+  from one whose values just didn't change.
+
+fillForward() turns the blanks back into values, for anything that reads the files.
+--------------------------------------------------------------------------------------
+"""
+
+import math
+from csv_data_writer import periodBounds, DAY
+
+
+def parseDeadband(deadband):
+    # Returns (absolute, relative) for a deadband setting: a number, or a string like '0.5%'
+    if isinstance(deadband, str) and deadband.strip().endswith('%'):
+        relative = float(deadband.strip()[:-1]) / 100
+        if relative < 0:
+            raise ValueError('Deadband must not be negative, got {}'.format(deadband))
+        return 0.0, relative
+    if isinstance(deadband, (int, float)) and not isinstance(deadband, bool) and deadband >= 0:
+        return float(deadband), 0.0
+    raise ValueError("Deadband must be a number or a percentage like '0.5%', got {!r}".format(deadband))
+
+
+def isCarriedForward(value):
+    # True for a blank left by the filter: None in a row, '' in a .csv file, NaN in a binary file
+    return value is None or value == '' or (isinstance(value, float) and math.isnan(value))
+
+
+def fillForward(rows):
+    # Yields the rows of a report-by-exception file (timestamp first) with every blank
+    #...replaced by the last value written above it
+    last = None
+    for row in rows:
+        if last is None:
+            last = list(row)
+        else:
+            last = [last[index] if isCarriedForward(value) else value for index, value in enumerate(row)]
+        yield list(last)
+
+
+class DeadbandFilter:
+
+    # One per meter. 'names' are the meter's columns after the timestamp, in row order.
+
+    def __init__(self, names, deadbands=None, max_silence=900, rotation=DAY):
+        if max_silence is not None and max_silence <= 0:
+            raise ValueError('MAX_SILENCE must be positive or None, got {}'.format(max_silence))
+
+        deadbands = deadbands or {}
+        bands = [parseDeadband(deadbands.get(name, 0)) for name in names]
+        self.names = list(names)
+        self.absolute = [band[0] for band in bands]
+        self.relative = [band[1] for band in bands]
+        self.max_silence = max_silence     # Seconds between keyframes, or None for one per file
+        self.rotation = rotation
+
+        self._last = None            # Last value written for each column, None until the first keyframe
+        self._next_keyframe = None   # Timestamp at which the next full row is due
+        self._period_end = None      # End of the current data file's day (or hour)
+
+    def reset(self):
+        # The next row is written in full, e.g. after the meter missed a poll
+        self._last = None
+
+    def filter(self, row, timestamp):
+
+        # Returns the row to write, with None for the values that didn't move beyond their
+        #...deadband, or None if nothing did and no keyframe is due.
+
+        if self._last is None or timestamp >= self._period_end or \
+                (self._next_keyframe is not None and timestamp >= self._next_keyframe):
+            self._period_end = periodBounds(timestamp, self.rotation)[1]
+            self._next_keyframe = timestamp + self.max_silence if self.max_silence is not None else None
+            self._last = list(row[1:])
+            return list(row)
+
+        filtered = [row[0]]
+        moved = False
+        for index, value in enumerate(row[1:]):
+            last = self._last[index]
+            band = self.absolute[index] + self.relative[index] * abs(last)
+            if (abs(value - last) > band) if band else (value != last):
+                self._last[index] = value
+                filtered.append(value)
+                moved = True
+            else:
+                filtered.append(None)
+
+        return filtered if moved else None
@@ -0,0 +1,330 @@
+"""
+--------------------------------------------------------------------------------------
+ORCA File Compressor
+
+Uncompressed data files fill a Pi's SD card within months. A FileCompressor thread
+compresses every data file (.csv and .orca) once the day it belongs to is over:
+
+- Runs in a background thread at the lowest CPU priority (on Linux), in chunks, so the
+  polling loop never waits for it. The codecs release the GIL while they work.
+- Uses zstd if the 'zstandard' package is installed and gzip otherwise ('auto'), or
+  whichever of 'zstd', 'xz' and 'gzip' is asked for. The compressed file is the data
+  file's name plus '.zst', '.xz' or '.gz'.
+- Every compressed file is read back and compared (SHA-256) with the original before
+  it is moved into place (atomically) and the original is removed. A power cut at any
+  point leaves either the original or a verified compressed copy, never neither.
+- If rows for a day that was already compressed turn up later (e.g. from the
+  write-behind spool after a power cut), they are merged into the compressed file.
+- Files of a stream that something else is still writing to (see holding(), used by the
+  backfill thread for days that may already be over) are left until the next scan.
+
+openData() opens a data file whether it has been compressed or not, so anything that
+reads the files (see time_index.py and binary_data_store.py) doesn't have to care:
+
+    with openData('./data/Galena_1_2020_6_1.csv', 'r', newline='') as data_file:
+        rows = list(csv.reader(data_file))
+--------------------------------------------------------------------------------------
+"""
+
+import collections
+import contextlib
+import datetime
+import gzip
+import hashlib
+import io
+import lzma
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+
+try:
+    import zstandard     # Optional, 'pip install zstandard'
+except ImportError:
+    zstandard = None
+
+
+AUTO = 'auto'
+ZSTD = 'zstd'
+XZ = 'xz'
+GZIP = 'gzip'
+
+EXTENSIONS = {ZSTD: '.zst', XZ: '.xz', GZIP: '.gz'}
+CHUNK_SIZE = 1024 * 1024
+
+# '<meter>_<year>_<month>_<day>[_<hour>][_<n>].csv/.orca'
+_DATA_FILE_NAME = re.compile(r'_(\d{4})_(\d{1,2})_(\d{1,2})(?:_\d+)*\.(?:csv|orca)$')
+
+
+def _streamName(path):
+    # The meter (or stream) name at the start of a data file's name
+    file_name = os.path.basename(path)
+    return file_name[:_DATA_FILE_NAME.search(file_name).start()]
+
+
+def _compressor(codec):
+    # A streaming compressor with compress() and flush(), like zlib's
+    if codec == ZSTD:
+        return zstandard.ZstdCompressor(level=10).compressobj()
+    if codec == XZ:
+        return lzma.LZMACompressor(lzma.FORMAT_XZ, preset=6)
+    return zlib.compressobj(6, zlib.DEFLATED, 31)     # 31: with the gzip header, so 'gunzip' can read it
+
+
+def _openCompressed(path, codec=None):
+    # Opens a compressed file for reading the original bytes. The codec comes from the extension if not given.
+    if codec is None:
+        codec = next((name for name, extension in EXTENSIONS.items() if path.endswith(extension)), GZIP)
+    if codec == ZSTD:
+        if zstandard is None:
+            raise ValueError('Reading {} needs the zstandard package'.format(path))
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')), CHUNK_SIZE)
+    if codec == XZ:
+        return lzma.open(path, 'rb')
+    return gzip.open(path, 'rb')
+
+
+def uncompressedPath(path):
+    # The name of a data file without any compression extension
+    for extension in EXTENSIONS.values():
+        if path.endswith(extension):
+            return path[:-len(extension)]
+    return path
+
+
+def findDataFile(path):
+    # The path of a data file as it is on disk now: 'path' itself, or its compressed copy. None if neither exists.
+    if os.path.exists(path):
+        return path
+    for extension in EXTENSIONS.values():
+        if os.path.exists(path + extension):
+            return path + extension
+    return None
+
+
+def openData(path, mode='rb', encoding='utf-8', newline=None):
+
+    # Opens a data file for reading, compressed or not. 'path' can be either name. 'mode' is
+    #...'rb' for bytes or 'r' for text. Compressed files can only seek forwards cheaply
+    #...(seekable() is False for zstd).
+
+    path = uncompressedPath(path)
+    found = findDataFile(path)
+    if found is None:
+        raise FileNotFoundError('No such data file: {}'.format(path))
+    if found == path:
+        return open(path, mode) if 'b' in mode else open(path, mode, encoding=encoding, newline=newline)
+
+    data_file = _openCompressed(found)
+    if 'b' in mode:
+        return data_file
+    return io.TextIOWrapper(data_file, encoding=encoding, newline=newline)
+
+
+def _headerLength(path, data_file):
+    # Length of the column headers at the start of an uncompressed data file
+    if path.endswith('.orca'):
+        magic_and_length = data_file.read(12)     # 'ORCABIN1' and the header length, see binary_data_store.py
+        return 12 + struct.unpack('<I', magic_and_length[8:])[0] if len(magic_and_length) == 12 else 0
+    return len(data_file.readline())
+
+
+def _readChunks(data_file, skip=0):
+    if skip:
+        data_file.read(skip)
+    for chunk in iter(lambda: data_file.read(CHUNK_SIZE), b''):
+        yield chunk
+
+
+class _Stopping(Exception):
+    pass
+
+
+class FileCompressor:
+
+    def __init__(self, directory='./data', codec=AUTO, grace=3600, scan_interval=600, logger=None):
+        if codec == AUTO:
+            codec = ZSTD if zstandard is not None else GZIP
+        if codec not in EXTENSIONS:
+            raise ValueError("Codec must be '{}', '{}', '{}' or '{}', got {}".format(AUTO, ZSTD, XZ, GZIP, codec))
+        if codec == ZSTD and zstandard is None:
+            raise ValueError("Codec 'zstd' needs the zstandard package ('pip install zstandard')")
+
+        self.directory = directory
+        self.codec = codec
+        self.extension = EXTENSIONS[codec]
+        self.grace = grace                      # Seconds after the end of a day before its files are compressed
+        self.scan_interval = scan_interval      # Seconds between looks for newly completed files
+        self.logger = logger
+
+        self._stopping = threading.Event()
+        self._thread = None
+        self._held = collections.Counter()      # Stream name -> writers keeping the compressor off its files
+        self._compressing = None                # Stream of the file being compressed right now
+        self._condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def holding(self, stream):
+        # Keeps the compressor off the files of 'stream' while rows are written to them. Waits
+        #...for a file of the stream that is being compressed right now to be done first.
+        with self._condition:
+            self._condition.wait_for(lambda: self._compressing != stream)
+            self._held[stream] += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._held[stream] -= 1
+                if not self._held[stream]:
+                    del self._held[stream]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='orca-compressor', daemon=True)
+        self._thread.start()
+
+    def close(self, timeout=10.0):
+        # Stops the thread. A file that was half compressed is simply left as it was.
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        # On Linux each thread has its own nice value, so this only slows down the compressor
+        native_id = getattr(threading, 'get_native_id', None)     # Python 3.8+
+        if native_id is not None and hasattr(os, 'setpriority'):
+            try:
+                os.setpriority(os.PRIO_PROCESS, native_id(), 19)
+            except OSError:
+                pass
+
+        while not self._stopping.is_set():
+            try:
+                self.compressCompleted()
+            except _Stopping:
+                break
+            except Exception:
+                if self.logger is not None:
+                    self.logger.error('Error while compressing data files', exc_info=True)
+            self._stopping.wait(self.scan_interval)
+
+    def completedFiles(self, now=None):
+        # The uncompressed data files whose day ended more than 'grace' seconds ago
+        now = time.time() if now is None else now
+        completed = []
+        for file_name in sorted(os.listdir(self.directory)):
+            match = _DATA_FILE_NAME.search(file_name)
+            if match is None:
+                continue
+            year, month, day = (int(group) for group in match.groups())
+            try:
+                day_end = datetime.datetime(year, month, day) + datetime.timedelta(days=1)
+            except ValueError:
+                continue
+            if time.mktime(day_end.timetuple()) + self.grace <= now:
+                completed.append(os.path.join(self.directory, file_name))
+        return completed
+
+    def compressCompleted(self, now=None):
+        # Returns the number of files compressed
+        for file_name in os.listdir(self.directory):     # Leftovers of a compression that was interrupted
+            if file_name.endswith('.tmp') and any(file_name.endswith(extension + '.tmp') for extension in EXTENSIONS.values()):
+                os.remove(os.path.join(self.directory, file_name))
+
+        compressed = 0
+        for path in self.completedFiles(now):
+            if self._stopping.is_set():
+                raise _Stopping()
+            stream = _streamName(path)
+            with self._condition:
+                if self._held[stream]:
+                    continue     # Still being written to, tried again on the next scan
+                self._compressing = stream
+            try:
+                if self.compressFile(path):
+                    compressed += 1
+            finally:
+                with self._condition:
+                    self._compressing = None
+                    self._condition.notify_all()
+        return compressed
+
+    def _sourceChunks(self, path, existing):
+        # The data to compress: what's already compressed for this file (if anything), then the
+        #...uncompressed file without its column headers, which are already in the compressed part.
+        skip = 0
+        if existing is not None:
+            with open(path, 'rb') as data_file:
+                skip = _headerLength(path, data_file)
+                data_file.seek(0)
+                header = data_file.read(skip)
+            with _openCompressed(existing) as existing_file:
+                if existing_file.read(skip) != header:
+                    raise ValueError('The columns of {} differ from those of {}, not merging them'.format(path, existing))
+            with _openCompressed(existing) as existing_file:
+                for chunk in _readChunks(existing_file):
+                    yield chunk
+        with open(path, 'rb') as data_file:
+            for chunk in _readChunks(data_file, skip):
+                yield chunk
+
+    def compressFile(self, path):
+
+        # Compresses one data file next to itself, checks the result and removes the original.
+        #...Returns True if it worked.
+
+        target = path + self.extension
+        existing = next((path + extension for extension in EXTENSIONS.values() if os.path.exists(path + extension)), None)
+        temporary_path = target + '.tmp'
+        original_size = os.path.getsize(path)
+
+        try:
+            digest = hashlib.sha256()
+            compressor = _compressor(self.codec)
+            with open(temporary_path, 'wb') as compressed_file:
+                for chunk in self._sourceChunks(path, existing):
+                    if self._stopping.is_set():
+                        raise _Stopping()
+                    digest.update(chunk)
+                    compressed_file.write(compressor.compress(chunk))
+                compressed_file.write(compressor.flush())
+                compressed_file.flush()
+                os.fsync(compressed_file.fileno())
+
+            check = hashlib.sha256()
+            with _openCompressed(temporary_path, self.codec) as compressed_file:
+                for chunk in _readChunks(compressed_file):
+                    check.update(chunk)
+            if check.digest() != digest.digest():
+                raise ValueError('Compressed copy of {} does not match the original'.format(path))
+
+            os.replace(temporary_path, target)     # Atomic, the compressed file is either all there or not at all
+            directory = os.open(os.path.dirname(os.path.abspath(target)), os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+        except _Stopping:
+            os.remove(temporary_path)
+            raise
+        except (OSError, ValueError, EOFError, lzma.LZMAError, zlib.error):
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            if self.logger is not None:
+                self.logger.error('Could not compress ' + path + ', leaving it uncompressed', exc_info=True)
+            return False
+
+        os.remove(path)
+        if existing is not None and existing != target:
+            os.remove(existing)     # Compressed with a different codec before, now merged into 'target'
+
+        if existing is not None and path.endswith('.csv'):
+            from time_index import buildIndex     # (time_index imports this module)
+            buildIndex(path)                      # The merged rows moved, so the old index no longer fits
+
+        if self.logger is not None:
+            self.logger.info('Compressed {} ({:.1f} -> {:.1f} KiB)'.format(
+                os.path.basename(path), original_size / 1024, os.path.getsize(target) / 1024))
+        return True
@@ -0,0 +1,524 @@
+"""
+--------------------------------------------------------------------------------------
+ORCA Historical Log Backfill
+
+When the network or the Pi goes down, the data files simply have no rows for that time,
+but a Shark 200 keeps recording into its onboard historical logs all along. With
+BACKFILL on, a Backfiller fills the gaps from there:
+
+- Every row of a meter's own stream is passed to observe(). A gap is a jump of more than
+  'min_gap' seconds (and more than three timesteps) between two rows, or between the last
+  row in the data files and the first one after a restart.
+- The gaps still to fill are kept in './data/.backfill', so a gap that can't be filled
+  right away (e.g. the meter dropped off again) is retried, even after a restart. A gap
+  whose records can't be decoded or written is logged and given up on instead.
+- A background thread at the lowest CPU priority downloads the missing records over the
+  meter's pooled connection (see modbus_connection_pool.py), one request at a time, so
+  the meter doesn't need a connection slot of its own for it and the polling never
+  waits for more than one request: the log is moved through with the meter's log
+  retrieval window, one full 125-register read per window, with a short pause between
+  reads so the meter keeps answering the live polls quickly. (With sharded acquisition
+  the meters are polled from the workers' pools, so the supervisor's pool that the
+  backfill gets holds an extra connection to the meter.)
+- A meter whose log isn't available, or holds none of the meter's readings, isn't asked
+  again until the settings are reloaded (or the script restarted).
+- The records are decoded with the meter's register map and written to
+  '<meter>_backfill_<date>.csv' (and/or .orca): the meter's own columns, with the
+  readings the log doesn't hold left blank, plus a 'backfilled' column of 1s.
+
+The live files are appended in time order and the time index relies on that, so the
+backfilled rows go next to them rather than into them. The backfill files themselves are
+appended one gap at a time, so they may be out of order: time_index.py and
+binary_data_store.py sort them when they are read. While rows are written to them the
+FileCompressor is kept off them ('hold_files'). 'python time_index.py --backfill'
+(time_index.queryTimeRange(..., backfill=True)) merges the two in time order, with
+'backfilled' 0 for the live rows.
+
+The log holds whatever the meter was programmed to log (e.g. with Communicator EXT), at
+its own interval, so backfilled rows are usually further apart than TIMESTEP. The log
+timestamps are the meter's clock, taken as local time like the data files.
+--------------------------------------------------------------------------------------
+"""
+
+import collections
+import contextlib
+import datetime
+import json
+import os
+import struct
+import threading
+import time
+import numpy as np
+from csv_data_writer import dataFileName, periodBounds, DAY
+from file_compressor import findDataFile
+from meter_drivers import MODELS
+from register_decoder import decodeRegisters, registerCount
+
+
+BACKFILL_SUFFIX = '_backfill'     # '<meter>_backfill' is the stream the backfilled rows go to
+PROVENANCE_COLUMN = 'backfilled'
+LOG_NUMBERS = (1, 2, 3)           # The Shark 200's historical logs
+
+RETRY_INTERVAL = 300.0   # Seconds before a gap that couldn't be filled is tried again
+WINDOW_PAUSE = 0.05      # Seconds between two reads of the log, so the live polls don't queue up behind them
+WINDOW_TRIES = 20        # Reads of a window the meter hasn't filled yet before giving up on it
+
+# meter_name: Whose rows are missing
+# start, end: Timestamps of the last row before the gap and the first row after it (neither is backfilled)
+Gap = collections.namedtuple('Gap', ['meter_name', 'start', 'end'])
+
+# As in a log's status block. 'first' and 'last' are the timestamps of its oldest and newest records.
+LogStatus = collections.namedtuple('LogStatus', ['max_records', 'records', 'record_size', 'available', 'first', 'last'])
+
+
+class HistoricalLogError(Exception):
+    pass
+
+
+class HistoricalLogUnavailable(HistoricalLogError):
+    # The meter has no usable log (not enabled, or not set up to log any of the readings): trying again won't help
+    pass
+
+
+def backfillStream(meter_name):
+    return meter_name + BACKFILL_SUFFIX
+
+
+def recordTime(stamp):
+    # Unix timestamp of a 6-byte log timestamp (years since 2000, month, day, hour, minute and
+    #...second, in the meter's local time). None if it isn't a valid time, e.g. an empty record.
+    try:
+        return time.mktime(datetime.datetime(2000 + stamp[0], stamp[1], stamp[2],
+                                             stamp[3], stamp[4], stamp[5]).timetuple())
+    except ValueError:
+        return None
+
+
+    # Reading the meter's logs
+#######################################################################################
+class PooledLogClient:
+
+    # The two requests of a pyModbusTCP client that HistoricalLogReader needs, sent over the
+    #...meter's connection in a ModbusConnectionPool. The pool's lock is only held for one
+    #...request at a time, so the live polls go in between.
+
+    def __init__(self, connection_pool, host, port, unit_id):
+        self.connection_pool = connection_pool
+        self.host = host
+        self.port = port
+        self.unit_id = unit_id
+
+    def read_holding_registers(self, address, count):
+        return self.connection_pool.readHoldingRegisters(self.host, self.port, self.unit_id, address, count)
+
+    def write_multiple_registers(self, address, values):
+        return self.connection_pool.writeRegisters(self.host, self.port, self.unit_id, address, values)
+
+
+class HistoricalLogReader:
+
+    # Reads one historical log of a meter over a pyModbusTCP client (or a PooledLogClient).
+    #...'layout' holds the addresses of the log blocks, see shark_200_readings_blocks.py.
+
+    def __init__(self, client, layout, log_number=1, pause=WINDOW_PAUSE):
+        if log_number not in LOG_NUMBERS:
+            raise ValueError('The historical log number must be 1, 2 or 3, got {}'.format(log_number))
+        self.client = client
+        self.layout = layout
+        self.log_number = log_number
+        self.pause = pause
+        self._records_per_window = 1
+
+    def _read(self, address, count):
+        registers = self.client.read_holding_registers(address, count)
+        if registers is None or len(registers) != count:
+            raise HistoricalLogError('No reply when reading {} registers at {}'.format(count, hex(address)))
+        return np.asarray(registers, dtype='>u2').tobytes()
+
+    def _write(self, address, values):
+        if not self.client.write_multiple_registers(address, values):
+            raise HistoricalLogError('The meter refused the write to {}'.format(hex(address)))
+
+    def status(self):
+        data = self._read(self.layout.historical_log_status[self.log_number], self.layout.historical_log_status_size)
+        max_records, records, record_size, availability = struct.unpack_from('>IIHH', data)
+        return LogStatus(max_records, records, record_size, availability == 0, recordTime(data[12:18]), recordTime(data[18:24]))
+
+    def loggedRegisters(self):
+        # The (wire) addresses of the registers in every record, in record order
+        data = self._read(self.layout.historical_log_programming[self.log_number],
+                          self.layout.historical_log_programming_size)
+        words = np.frombuffer(data, dtype='>u2')
+        return words[2:2 + (int(words[0]) >> 8)].tolist()
+
+    def _engage(self, record_size):
+        # Takes over the retrieval window for this log. Only one client can have it at a time.
+        self._records_per_window = max(1, 2 * self.layout.log_retrieval_window_size // record_size)
+        self._write(self.layout.log_retrieval_engage, [(self.log_number << 8) | 0x80, self._records_per_window << 8])
+
+    def _disengage(self):
+        try:
+            self._write(self.layout.log_retrieval_engage, [0, 0])
+        except HistoricalLogError:
+            pass     # The meter lets the window go on its own after a while
+
+    def _readWindow(self, index, record_size):
+        # The records of the window starting at record 'index' (0 is the oldest in the log)
+        self._write(self.layout.log_retrieval_window_status, [(index >> 16) & 0xFF, index & 0xFFFF])
+        for attempt in range(WINDOW_TRIES):
+            time.sleep(self.pause)
+            data = self._read(self.layout.log_retrieval_window_status, 2 + self.layout.log_retrieval_window_size)
+            if data[0] == 0:
+                break
+        else:
+            raise HistoricalLogError('The meter did not fill the log window for record {}'.format(index))
+        if (data[1] << 16) | (data[2] << 8) | data[3] != index:
+            raise HistoricalLogError('The meter filled the log window from the wrong record')
+        return [data[4 + position * record_size:4 + (position + 1) * record_size]
+                for position in range(self._records_per_window)]
+
+    def recordsBetween(self, start, end):
+
+        # Returns (timestamp, registers as bytes) for every record with start < timestamp < end,
+        #...oldest first. The first of them is found with a binary search over the log, so only
+        #...the windows with those records (and a few to find them) are read.
+
+        status = self.status()
+        if not status.available:
+            raise HistoricalLogUnavailable('Historical log {} is not available'.format(self.log_number))
+        if not status.records or status.first is None or status.last is None:
+            return []
+        if status.first >= end or status.last <= start:
+            return []
+
+        record_size = status.record_size
+        self._engage(record_size)
+        try:
+            low, high = 0, status.records     # First record after 'start'
+            while low < high:
+                middle = (low + high) // 2
+                timestamp = recordTime(self._readWindow(middle, record_size)[0])
+                if timestamp is not None and timestamp <= start:
+                    low = middle + 1
+                else:
+                    high = middle
+
+            records = []
+            index = low
+            while index < status.records:
+                window = self._readWindow(index, record_size)[:status.records - index]
+                for record in window:
+                    timestamp = recordTime(record)
+                    if timestamp is None:
+                        continue
+                    if timestamp >= end:
+                        return records
+                    records.append((timestamp, record[6:]))
+                index += len(window)
+            return records
+        finally:
+            self._disengage()
+#######################################################################################
+
+
+def logColumns(plan, logged_registers):
+
+    # Where each column of 'plan' is in the log records: (position, Register), or None if the log
+    #...doesn't hold all of that reading's registers
+
+    positions = {address: position for position, address in enumerate(logged_registers)}
+    columns = []
+    for name in plan.columns:
+        register = plan.register_map.registers[name]
+        address = register.address - 2     # Wire address, the same offset as getModbusData()
+        position = positions.get(address)
+        if position is None or any(positions.get(address + offset) != position + offset
+                                   for offset in range(registerCount(register.data_type))):
+            columns.append(None)
+        else:
+            columns.append((position, register))
+    return columns
+
+
+def decodeRecords(records, logged_registers, plan):
+
+    # Turns log records into rows for the meter's backfill stream: the timestamp, a value (or
+    #...None) per column of 'plan', then the provenance flag. Every record is decoded at once,
+    #...one column at a time.
+
+    if not records:
+        return []
+    columns = logColumns(plan, logged_registers)
+
+    record_bytes = 2 * len(logged_registers)
+    words = np.frombuffer(b''.join(record[:record_bytes].ljust(record_bytes, b'\0') for timestamp, record in records),
+                          dtype='>u2').reshape(len(records), len(logged_registers))
+
+    values = []
+    for column in columns:
+        if column is None:
+            values.append([None] * len(records))
+            continue
+        position, register = column
+        decoded = decodeRegisters(words[:, position:position + registerCount(register.data_type)],
+                                  register.data_type, scale=register.scale)[:, 0]     # One value per record
+        values.append([round(value, plan.decimal_places) for value in decoded.tolist()])     # Like the live rows
+
+    return [[int(timestamp)] + [column_values[index] for column_values in values] + [1]
+            for index, (timestamp, record) in enumerate(records)]
+
+
+def lastStoredTimestamp(stream, directory='./data', rotation=DAY, oldest=0.0, before=None):
+
+    # Timestamp of the newest row of 'stream' before 'before' (default: now) in its .csv or .orca
+    #...files, looking back period by period until 'oldest'. None if there are no rows since then.
+
+    from time_index import loadIndex, readRange     # (Only needed here)
+    from binary_data_store import openDataFile
+
+    before = time.time() if before is None else before
+    period_timestamp = before
+    while period_timestamp > oldest:
+        period_start, period_end = periodBounds(period_timestamp, rotation)
+        base_name = dataFileName(stream, period_start, rotation, extension='')
+
+        latest = None
+        suffix = 0     # A numbered file is started when the columns change during the day
+        while True:
+            path = os.path.join(directory, base_name + ('_{}'.format(suffix) if suffix else ''))
+            csv_path, binary_path = findDataFile(path + '.csv'), findDataFile(path + '.orca')
+            if csv_path is None and binary_path is None:
+                break
+            if csv_path is not None:
+                buckets = loadIndex(path + '.csv')['bucket']     # Only the last two indexed minutes before
+                buckets = buckets[buckets < before]               #...'before' are read, one of them has rows
+                columns, rows = readRange(path + '.csv', float(buckets[-2]) if len(buckets) > 1 else 0.0, before)
+                if rows:
+                    latest = max(latest or 0.0, max(float(row[0]) for row in rows))
+            if binary_path is not None:
+                timestamps = openDataFile(binary_path)['timestamp']
+                position = np.searchsorted(timestamps, before, 'left')
+                if position:
+                    latest = max(latest or 0.0, float(timestamps[position - 1]))
+            suffix += 1
+
+        if latest is not None:
+            return latest
+        period_timestamp = time.mktime(period_start.timetuple()) - 1     # The period before
+    return None
+
+
+class Backfiller:
+
+    def __init__(self, open_writers, connection_pool, directory='./data', rotation=DAY, log_number=1, min_gap=300,
+                 max_age=7 * 24 * 3600, quiet_time=0, hold_files=None, logger=None):
+
+        # 'open_writers(plan)' returns the data writers for the rows backfilled for one meter (the
+        #...timestamp, the meter's columns, then PROVENANCE_COLUMN). The logs are read through
+        #...'connection_pool', the ModbusConnectionPool the meters are polled with. 'max_age' is
+        #...how far back (in seconds) gaps are filled, 'quiet_time' how long a meter's stream may
+        #...go without rows while it is polled fine (MAX_SILENCE with report by exception). 'hold_files(stream)',
+        #...if given, is a context manager that keeps others off the stream's files while the rows
+        #...are written (FileCompressor.holding()).
+
+        if log_number not in LOG_NUMBERS:
+            raise ValueError('The historical log number must be 1, 2 or 3, got {}'.format(log_number))
+        self.open_writers = open_writers
+        self.connection_pool = connection_pool
+        self.directory = directory
+        self.rotation = rotation
+        self.log_number = log_number
+        self.min_gap = min_gap
+        self.max_age = max_age
+        self.quiet_time = quiet_time
+        self.hold_files = hold_files
+        self.logger = logger
+
+        self._plans = {}           # Meter name -> PollPlan, of the meters with a historical log
+        self._last_rows = {}       # Meter name -> timestamp of its latest row
+        self._stored = {}          # Meter name -> timestamp of its last row in the data files before the start (or None)
+        self._first_rows = {}      # Meter name -> timestamp of its first row, if it came before the data files were looked at
+        self._gaps = []            # Gaps still to fill, oldest first
+        self._retry_at = {}        # Gap -> time.monotonic() before which it isn't tried again
+        self._unavailable = set()  # Meters whose log can't be used, see HistoricalLogUnavailable
+        self._state_path = os.path.join(directory, '.backfill')
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._started = time.time()     # Rows from before this are the ones in the files from earlier runs
+
+        try:
+            with open(self._state_path) as state_file:
+                self._gaps = [Gap(*gap) for gap in json.load(state_file)]
+        except (OSError, ValueError, TypeError):
+            pass     # No gaps left over (or a torn file from a power cut)
+
+    def setPlans(self, plans):
+        # The meters to watch, e.g. after the settings were reloaded. Meters without a historical log are left out.
+        with self._lock:
+            self._plans = {name: plan for name, plan in plans.items()
+                           if MODELS[plan.model].historical_logs is not None and plan.columns}
+            self._unavailable.clear()     # The meters may have been set up to log since
+        self._wake.set()
+
+    def _threshold(self, plan):
+        return max(self.min_gap, 3 * plan.timestep, self.quiet_time + plan.timestep)
+
+    def observe(self, stream, timestamp):
+        # Called with every row written. Only the meters' own streams are looked at.
+        plan = self._plans.get(stream)
+        if plan is None or stream in self._unavailable:
+            return
+        with self._lock:
+            if stream not in self._last_rows and stream not in self._stored:
+                self._first_rows[stream] = timestamp     # Compared with the data files once they've been looked at
+            last = self._last_rows.get(stream, self._stored.get(stream))
+            self._last_rows[stream] = timestamp
+            if last is not None and timestamp - last > self._threshold(plan):
+                self._addGap(Gap(stream, last, timestamp))
+
+    def _addGap(self, gap):
+        # Must be called with the lock held
+        self._gaps.append(gap)
+        self._gaps.sort(key=lambda gap: gap.start)
+        self._saveGaps()
+        self._wake.set()
+        if self.logger is not None:
+            self.logger.info('No data from {} between {} and {}, backfilling it from the meter\'s historical log'.format(
+                gap.meter_name, datetime.datetime.fromtimestamp(gap.start), datetime.datetime.fromtimestamp(gap.end)))
+
+    def _saveGaps(self):
+        # Written to a new file and moved into place, so a power cut leaves the old or the new list
+        try:
+            with open(self._state_path + '.tmp', 'w') as state_file:
+                json.dump([list(gap) for gap in self._gaps], state_file)
+            os.replace(self._state_path + '.tmp', self._state_path)
+        except OSError:
+            if self.logger is not None:
+                self.logger.error('Could not save the gaps to backfill to ' + self._state_path, exc_info=True)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='orca-backfill', daemon=True)
+        self._thread.start()
+
+    def close(self, timeout=10.0):
+        # Stops the thread. A gap that was being filled stays in the list and is done again next time.
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        # On Linux each thread has its own nice value, so this only slows down the backfill
+        native_id = getattr(threading, 'get_native_id', None)     # Python 3.8+
+        if native_id is not None and hasattr(os, 'setpriority'):
+            try:
+                os.setpriority(os.PRIO_PROCESS, native_id(), 19)
+            except OSError:
+                pass
+
+        while not self._stopping.is_set():
+            self._wake.clear()
+            try:
+                self._findStartupGaps()
+                gap = self._nextGap()
+                if gap is not None:
+                    self._fillGap(gap)
+                    continue
+            except Exception:
+                if self.logger is not None:
+                    self.logger.error('Error while backfilling', exc_info=True)
+            self._wake.wait(60)
+
+    def _findStartupGaps(self):
+        # The gap between the last row in the data files and the first one since the start, for
+        #...every meter that hasn't been looked up yet. Done here, since it may have to read a
+        #...compressed file.
+        for meter_name in [name for name in self._plans if name not in self._stored]:
+            stored = lastStoredTimestamp(meter_name, self.directory, self.rotation, time.time() - self.max_age,
+                                         self._started)
+            with self._lock:
+                self._stored[meter_name] = stored
+                plan = self._plans.get(meter_name)
+                first = self._first_rows.pop(meter_name, None)
+                if plan is not None and stored is not None and first is not None and first - stored > self._threshold(plan):
+                    self._addGap(Gap(meter_name, stored, first))
+
+    def _nextGap(self):
+        # The oldest gap that is due. Gaps of meters that were removed, whose log can't be used,
+        #...or that are too old to still be in the log, are dropped.
+        now = time.monotonic()
+        with self._lock:
+            for gap in list(self._gaps):
+                if (gap.meter_name not in self._plans or gap.meter_name in self._unavailable
+                        or gap.end < time.time() - self.max_age):
+                    self._removeGap(gap)
+                elif self._retry_at.get(gap, 0) <= now:
+                    return gap
+        return None
+
+    def _removeGap(self, gap):
+        # Must be called with the lock held
+        if gap in self._gaps:
+            self._gaps.remove(gap)
+            self._saveGaps()
+        self._retry_at.pop(gap, None)
+
+    def _fillGap(self, gap):
+        plan = self._plans[gap.meter_name]
+        layout = MODELS[plan.model].historical_logs
+        start = max(gap.start, time.time() - self.max_age)
+
+        client = PooledLogClient(self.connection_pool, plan.host, plan.port, plan.unit_id)
+        try:
+            reader = HistoricalLogReader(client, layout, self.log_number)
+            logged_registers = reader.loggedRegisters()
+            if not any(logColumns(plan, logged_registers)):
+                raise HistoricalLogUnavailable('Historical log {} holds none of the readings'.format(self.log_number))
+            rows = decodeRecords(reader.recordsBetween(start, gap.end), logged_registers, plan)
+        except HistoricalLogUnavailable as error:
+            plan.logger.warning('Not backfilling {}: {}'.format(gap.meter_name, error))
+            with self._lock:
+                self._unavailable.add(gap.meter_name)     # Its gaps are dropped by _nextGap()
+            return
+        except (HistoricalLogError, OSError):
+            plan.logger.warning('Could not backfill {} from historical log {}, trying again in {} seconds'.format(
+                gap.meter_name, self.log_number, int(RETRY_INTERVAL)), exc_info=True)
+            with self._lock:
+                self._retry_at[gap] = time.monotonic() + RETRY_INTERVAL
+            return
+        except Exception:
+            self._dropGap(gap, plan)     # E.g. a record that doesn't decode: reading the log again won't change it
+            return
+
+        try:
+            if rows:
+                hold = self.hold_files(backfillStream(gap.meter_name)) if self.hold_files is not None else contextlib.nullcontext()
+                with hold:
+                    data_writers = self.open_writers(plan)     # Only opened now, so they're held for as short as possible
+                    try:
+                        for row in rows:
+                            for data_writer in data_writers:
+                                data_writer.writeRow(row, row[0])
+                    finally:
+                        for data_writer in data_writers:
+                            data_writer.close()
+        except Exception:
+            self._dropGap(gap, plan)
+            return
+        plan.logger.info('Backfilled {} rows of {} from historical log {}'.format(
+            len(rows), gap.meter_name, self.log_number))
+
+        with self._lock:
+            self._removeGap(gap)
+
+    def _dropGap(self, gap, plan):
+        # For errors that trying again wouldn't fix. The gap is logged once and given up on, rather
+        #...than the whole log being read again every time the thread wakes up.
+        plan.logger.error('Could not backfill {} between {} and {} from historical log {}, giving up on it'.format(
+            gap.meter_name, datetime.datetime.fromtimestamp(gap.start), datetime.datetime.fromtimestamp(gap.end),
+            self.log_number), exc_info=True)
+        with self._lock:
+            self._removeGap(gap)
@@ -0,0 +1,275 @@
+"""
+--------------------------------------------------------------------------------------
+ORCA Logging
+
+Every log message used to be written to its file (and again to All_Logs.log) by the
+thread that logged it, so a slow SD card held up the polls, and a meter that kept
+failing wrote the same line every tick until the card filled up. With startLogging():
+
+- The root logger has a single QueueHandler, so logging from the poll loop only puts the
+  record on a queue. A QueueListener thread does all the formatting and file writing.
+- As before, everything goes to All_Logs.log, and every logger given a file with
+  addLogFile() (mainErrors and each meter) also goes to '<name>.log'.
+- A message that is logged again and again (same logger, level and text) is only written
+  the first time. The repeats are counted, and a summary line with the count and the time of
+  the first and last repeat is written every 'summary_interval' seconds while they go
+  on, and once the message hasn't come up for 'summary_interval' seconds (after which
+  it is written in full again):
+
+      2020-06-01 12:05:00,004-ERROR: Modbus query returned no data [repeated 74 more
+      times between 2020-06-01 12:00:04 and 2020-06-01 12:05:00]
+
+  Every message is counted on its own, so the lines of several meters that are down at
+  once, taking turns in All_Logs.log, are collapsed as well.
+
+- Worker processes (see sharded_acquisition.py) don't write the files themselves: after
+  restartAfterFork() their records go over a multiprocessing queue (shareWithWorkers())
+  to a second listener thread in the parent, so only one process ever writes, and
+  rotates, each file.
+- Every file rotates at 'max_bytes', keeping 'backup_count' old files ('<name>.log.1'
+  and so on), so the logs never take more than about (backup_count + 1) * max_bytes
+  per file.
+--------------------------------------------------------------------------------------
+"""
+
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+
+LOG_FORMAT = '%(asctime)s-%(levelname)s: %(message)s'
+ALL_LOGS = 'All_Logs'     # The file every message goes to
+TICK_INTERVAL = 10.0      # Seconds between checks for repeat summaries that are due, even if nothing is logged
+
+_queue_handler = None     # On the root logger
+_listener = None          # Thread writing the records from the queue
+_router = None            # Handler on the listener thread, see _LogRouter
+_worker_queue = None      # Records from the worker processes, see shareWithWorkers()
+_worker_listener = None   # Thread writing the records from _worker_queue
+_ticker = None            # Thread putting _TICK on the queue, see _tick()
+_ticker_stopping = threading.Event()
+_settings = {}            # Arguments of the last startLogging()
+
+
+class _Repeats:
+
+    # What CollapsingHandler knows about one (logger, level, message)
+
+    __slots__ = ('last_seen', 'count', 'first', 'last')
+
+    def __init__(self, created):
+        self.last_seen = created     # Time of the last record, written or counted
+        self.count = 0               # Repeats since the last summary
+        self.first = None            # Time of the first of them
+        self.last = None             # The last of them
+
+
+class CollapsingHandler(logging.Handler):
+
+    # Passes records on to 'target', except that a record with the same logger, level and
+    #...message as one passed on or counted less than 'summary_interval' seconds earlier is
+    #...only counted. Each of those keys is counted and summarized on its own (see the
+    #...module docstring).
+
+    def __init__(self, target, summary_interval=300.0):
+        super().__init__()
+        self.target = target
+        self.summary_interval = summary_interval
+        self._repeats = {}     # (logger, level, message) -> _Repeats
+
+    def emit(self, record):
+        self._expire(record.created)
+        key = (record.name, record.levelno, record.getMessage())
+        repeats = self._repeats.get(key)
+        if repeats is None:
+            self._repeats[key] = _Repeats(record.created)
+            self.target.handle(record)
+            return
+
+        if not repeats.count:
+            repeats.first = record.created
+        repeats.count += 1
+        repeats.last = record
+        repeats.last_seen = record.created
+
+    def expire(self, now=None):
+        # Writes the summaries that are due. Called every TICK_INTERVAL from the listener
+        #...thread, so they come out on time even when nothing else is logged.
+        self.acquire()
+        try:
+            self._expire(time.time() if now is None else now)
+        finally:
+            self.release()
+
+    def _expire(self, now):
+        for key, repeats in list(self._repeats.items()):
+            if repeats.count and now - repeats.first >= self.summary_interval:
+                self._summarize(repeats)
+            if now - repeats.last_seen >= self.summary_interval:
+                self._summarize(repeats)
+                del self._repeats[key]     # Stopped coming: the next one is written in full
+
+    def _summarize(self, repeats):
+        # Writes the summary of the repeats counted so far, if there are any
+        if not repeats.count:
+            return
+        summary = logging.makeLogRecord(repeats.last.__dict__)
+        summary.msg = '{} [repeated {} more time{} between {} and {}]'.format(
+            repeats.last.getMessage().split('\n', 1)[0],     # Without the traceback, if any
+            repeats.count, '' if repeats.count == 1 else 's',
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(repeats.first)),
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(repeats.last.created)))
+        summary.args, summary.exc_info, summary.exc_text = None, None, None
+        self.target.handle(summary)
+        repeats.count = 0
+
+    def flush(self):
+        for repeats in self._repeats.values():
+            self._summarize(repeats)
+        self.target.flush()
+
+    def close(self):
+        self.flush()
+        self.target.close()
+        super().close()
+
+
+class _LogRouter(logging.Handler):
+
+    # Runs on the listener thread: every record goes to All_Logs.log and to the file of the
+    #...logger it came from, if it has one.
+
+    def __init__(self):
+        super().__init__()
+        self.handlers = {}     # Logger name -> CollapsingHandler
+
+    def emit(self, record):
+        if record is _TICK:
+            for handler in list(self.handlers.values()):
+                handler.expire()
+            return
+        for name in (ALL_LOGS, record.name):
+            handler = self.handlers.get(name)
+            if handler is not None and record.levelno >= handler.level:
+                handler.handle(record)
+
+    def flush(self):
+        for handler in list(self.handlers.values()):
+            handler.flush()
+
+    def close(self):
+        for handler in list(self.handlers.values()):
+            handler.close()
+        super().close()
+
+
+def _fileHandler(name, level):
+    file_handler = logging.handlers.RotatingFileHandler(os.path.join(_settings['directory'], name + '.log'),
+                                                        maxBytes=_settings['max_bytes'],
+                                                        backupCount=_settings['backup_count'])
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    handler = CollapsingHandler(file_handler, _settings['summary_interval'])
+    handler.setLevel(level)
+    return handler
+
+
+_TICK = logging.makeLogRecord({'msg': 'tick'})     # Not a message: has the router write the summaries that are due
+
+
+def _tick():
+    while not _ticker_stopping.wait(TICK_INTERVAL):
+        _queue_handler.queue.put_nowait(_TICK)
+
+
+def _startListener():
+    global _listener, _ticker
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, _router)
+    _listener.start()
+    _ticker_stopping.clear()
+    _ticker = threading.Thread(target=_tick, name='orca-log-ticker', daemon=True)
+    _ticker.start()
+
+
+def startLogging(directory='./logs', max_bytes=5 * 1024 * 1024, backup_count=5, summary_interval=300.0,
+                 level=logging.INFO):
+
+    # Sets up the root logger and All_Logs.log. Calling it again (e.g. once the settings file
+    #...is known) only changes the size limits and summary interval of every log file.
+
+    global _queue_handler, _router
+
+    _settings.update(directory=directory, max_bytes=max_bytes, backup_count=backup_count,
+                     summary_interval=summary_interval)
+
+    if _queue_handler is not None:
+        for handler in _router.handlers.values():
+            handler.summary_interval = summary_interval
+            handler.target.maxBytes, handler.target.backupCount = max_bytes, backup_count
+        return
+
+    if not os.path.isdir(directory):
+        os.mkdir(directory)
+
+    _router = _LogRouter()
+    _router.handlers[ALL_LOGS] = _fileHandler(ALL_LOGS, level)
+
+    _queue_handler = logging.handlers.QueueHandler(queue.Queue())     # Unbounded, putting a record never blocks
+    root_logger = logging.getLogger()
+    root_logger.addHandler(_queue_handler)
+    root_logger.setLevel(level)
+    _startListener()
+
+
+def addLogFile(name, level=logging.INFO):
+    # Gives the logger called 'name' its own '<name>.log' as well. Safe to call more than once.
+    #...(In a worker process the parent writes the files, so there is nothing to add.)
+    if _router is not None and name not in _router.handlers:
+        _router.handlers[name] = _fileHandler(name, level)
+    return logging.getLogger(name)
+
+
+def shareWithWorkers():
+    # Called in the parent before it forks any workers: starts the listener that writes what
+    #...the workers log (see restartAfterFork()). Safe to call more than once.
+    global _worker_queue, _worker_listener
+    if _worker_queue is None:
+        _worker_queue = multiprocessing.Queue()
+        _worker_listener = logging.handlers.QueueListener(_worker_queue, _router)
+        _worker_listener.start()
+
+
+def restartAfterFork():
+    # A forked process doesn't get the parent's listener thread, and writing to the inherited
+    #...files from two processes would mix up their lines and rotations. Sends this process's
+    #...records to the parent instead, which writes them with its own.
+    global _listener, _router, _worker_listener, _ticker
+    if _queue_handler is not None:
+        if _worker_queue is None:
+            raise RuntimeError('logging_setup.shareWithWorkers() must be called before forking')
+        _queue_handler.queue = _worker_queue
+        _listener, _router, _worker_listener, _ticker = None, None, None, None     # The parent's, not this process's
+
+
+def stopLogging():
+    # Writes out every queued record and any pending repeat summaries. In a worker it only
+    #...sends what is still queued on to the parent.
+    global _listener, _worker_queue, _worker_listener, _ticker
+    if _ticker is not None:
+        _ticker_stopping.set()
+        _ticker.join()
+        _ticker = None
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    if _worker_listener is not None:
+        _worker_listener.stop()     # (After the workers are stopped)
+        _worker_queue, _worker_listener = None, None
+    if _router is not None:
+        _router.flush()
+    elif _worker_queue is not None:
+        _worker_queue.close()
+        _worker_queue.join_thread()
@@ -0,0 +1,109 @@
+"""
+--------------------------------------------------------------------------------------
+ORCA Per-Meter Connection State
+
+Each meter tracks its own connection state so that one unreachable meter no longer
+holds up data collection for all the others:
+
+  UP           - The last read succeeded. Polled every tick.
+  DEGRADED     - One or more reads failed in a row (or the connection was just re-established).
+                 Still polled every tick.
+  BACKING_OFF  - Too many failures in a row. Skipped until its backoff delay runs out.
+  DOWN         - Backoff delay ran out and a reconnect attempt is running in the background.
+                 Still skipped on the tick.
+
+The backoff delay doubles after every failed reconnect (with random jitter so meters
+behind the same gateway don't retry in lock-step) up to 'max_delay'. State changes are
+logged once, instead of logging every failed attempt.
+--------------------------------------------------------------------------------------
+"""
+
+import random
+import threading
+import time
+
+
+UP = 'up'
+DEGRADED = 'degraded'
+BACKING_OFF = 'backing off'
+DOWN = 'down'
+
+
+class MeterConnectionState:
+
+    def __init__(self, meter_name, host, logger, down_after=3, base_delay=2.0, max_delay=300.0, jitter=0.25):
+        self.meter_name = meter_name
+        self.host = host
+        self.logger = logger
+        self.down_after = down_after     # Consecutive failed reads before the meter is backed off
+        self.base_delay = base_delay     # Seconds before the first reconnect attempt
+        self.max_delay = max_delay       # Upper limit on the backoff delay
+        self.jitter = jitter             # +/- fraction of random jitter applied to every delay
+
+        self.state = UP
+        self.consecutive_failures = 0
+        self.reconnect_attempts = 0      # Times the meter has been backed off since it was last UP
+        self.next_attempt = 0.0          # time.monotonic() of the next allowed reconnect
+        self.down_since = None           # time.time() of the failure that started the outage
+
+        self._lock = threading.Lock()    # Reconnect results arrive from the polling engine's threads
+
+    def shouldPoll(self):
+        # True if the meter should be read on the current tick
+        with self._lock:
+            return self.state in (UP, DEGRADED)
+
+    def startRetryIfDue(self):
+        # Returns True (and moves to DOWN) if the backoff delay has run out and the caller
+        #...should start a reconnect attempt in the background.
+        with self._lock:
+            if self.state != BACKING_OFF or time.monotonic() < self.next_attempt:
+                return False
+            self.state = DOWN
+            return True
+
+    def recordSuccess(self):
+        with self._lock:
+            if self.state != UP:
+                self.logger.info('Readings from {} at {} are back to normal'.format(self.meter_name, self.host))
+            self.state = UP
+            self.consecutive_failures = 0
+            self.reconnect_attempts = 0
+            self.down_since = None
+
+    def recordFailure(self):
+        # Called for every failed read. The meter is only backed off after 'down_after'
+        #...failures in a row so that a single dropped reply doesn't cost it several ticks.
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.down_since is None:
+                self.down_since = time.time()
+
+            if self.consecutive_failures >= self.down_after:
+                self._backOff()
+            elif self.state == UP:
+                self.state = DEGRADED
+                self.logger.warning('Read from {} at {} failed, meter marked as degraded'.format(self.meter_name, self.host))
+
+    def finishRetry(self, connected):
+        # Result of a background reconnect attempt started after startRetryIfDue()
+        with self._lock:
+            if connected:
+                self.state = DEGRADED     # Back on the tick, but not UP until a read succeeds
+                outage = time.time() - (self.down_since or time.time())
+                self.logger.info('Connection with {} at {} re-established after {:.0f} s'.format(self.meter_name,
+                                                                                                self.host, outage))
+            else:
+                self._backOff()
+
+    def _backOff(self):
+        # Must be called with the lock held
+        delay = min(self.max_delay, self.base_delay * 2 ** self.reconnect_attempts)
+        delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        self.next_attempt = time.monotonic() + delay
+        self.reconnect_attempts += 1
+
+        if self.state in (UP, DEGRADED):     # Only the first transition is logged, not every retry
+            self.logger.error('Could not connect to {} at {}. Skipping it and retrying in the background'.format(self.meter_name,
+                                                                                                             self.host))
+        self.state = BACKING_OFF
@@ -0,0 +1,106 @@
+"""
+--------------------------------------------------------------------------------------
+ORCA Meter Drivers
+
+One driver class per supported meter model. A driver knows everything that differs
+between the models, so a single acquisition engine (and one scheduler and connection
+pool) can poll a mixed fleet of Shark 100s and Shark 200s:
+
+- its register map (which readings exist, where they are and how they are encoded)
+- the shape of its entry in the settings 'settings' list
+- where its onboard historical logs are, for models that have them (see historical_backfill.py)
+
+Each meter in the settings becomes a driver instance. Drivers are named tuples with
+the same fields as a Shark 200 settings entry,
+
+    (name, host, port, decimal_places, unit_id, readings)
+
+so code that unpacks the settings entries works on them unchanged.
+
+Shark 100 entries usually have no unit ID, since the meter is normally addressed
+directly. A Shark 100 behind a Modbus gateway can be given one by adding it before the
+readings list, exactly like a Shark 200 entry.
+--------------------------------------------------------------------------------------
+"""
+
+import collections
+import os
+import sys
+from modbus_connection_pool import DEFAULT_UNIT_ID
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'shark_100'))  # shark_100_readings_blocks lives there
+import shark_100_readings_blocks
+import shark_200_readings_blocks
+
+
+SHARK_100 = 'shark100'
+SHARK_200 = 'shark200'
+
+
+class MeterDriver(collections.namedtuple('MeterDriver', ['name', 'host', 'port', 'decimal_places', 'unit_id', 'readings'])):
+
+    __slots__ = ()
+
+    model = None
+    register_map = None
+    unit_id_optional = False     # True if the settings entry may leave out the unit ID
+    historical_logs = None       # The meter's onboard log layout, if it has logs to backfill from
+
+    @classmethod
+    def fromSettings(cls, entry):
+        # Builds the driver for one entry of a settings list. Raises ValueError if the entry
+        #...doesn't have the shape this model expects.
+        if len(entry) == 6:
+            name, host, port, decimal_places, unit_id, readings = entry
+        elif len(entry) == 5 and cls.unit_id_optional:
+            name, host, port, decimal_places, readings = entry
+            unit_id = DEFAULT_UNIT_ID
+        else:
+            expected = '5 or 6' if cls.unit_id_optional else '6'
+            raise ValueError('Settings for {} have {} fields, a {} entry needs {}'.format(entry[0], len(entry),
+                                                                                      cls.model, expected))
+        return cls(name, host, port, decimal_places, unit_id, readings)
+
+    def planReads(self, **options):
+        # Read plan for this meter's readings (see register_map.RegisterMap.planReads)
+        return self.register_map.planReads(self.readings, **options)
+
+
+class Shark200(MeterDriver):
+
+    __slots__ = ()
+
+    model = SHARK_200
+    register_map = shark_200_readings_blocks.register_map
+    historical_logs = shark_200_readings_blocks     # See historical_backfill.py
+
+
+class Shark100(MeterDriver):
+
+    __slots__ = ()
+
+    model = SHARK_100
+    register_map = shark_100_readings_blocks.register_map
+    unit_id_optional = True
+
+
+MODELS = {driver.model: driver for driver in (Shark100, Shark200)}
+
+
+def buildMeters(settings, default_model, meter_models=None):
+
+    # Turns a settings list into drivers. 'meter_models' maps meter names to model names for
+    #...meters that aren't of 'default_model' (the METER_MODELS setting).
+    # Raises ValueError for unknown models or malformed entries.
+
+    meter_models = meter_models or {}
+    meters = []
+
+    for entry in settings:
+        model = meter_models.get(entry[0], default_model)
+        if model not in MODELS:
+            raise ValueError('Unknown meter model for {}: {}. Known models: {}'.format(entry[0], model,
+                                                                                 ', '.join(sorted(MODELS))))
+        meters.append(MODELS[model].fromSettings(entry))
+
+    return meters
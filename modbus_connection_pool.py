@@ -0,0 +1,242 @@
+"""
+--------------------------------------------------------------------------------------
+ORCA Modbus TCP Connection Pool
+
+Keeps one persistent Modbus TCP connection open per (host, port) across ticks instead
+of opening and closing a new connection for every read. Meters that share a gateway
+IP and only differ by unit ID (e.g. 'Galena_1' and 'Galena_2') reuse the same socket.
+
+readMany() reads a whole batch of registers from one (host, port). For hosts with a
+pipeline depth above 1 the batch goes over a PipelinedModbusClient instead, with that many
+requests in flight at once (see pipelined_modbus_client.py), otherwise the reads go out
+one after another through pyModbusTCP as before. writeRegisters() writes over the same
+connection, e.g. to move through a meter's historical log (see historical_backfill.py).
+--------------------------------------------------------------------------------------
+"""
+
+import threading
+import time
+from pyModbusTCP.client import ModbusClient
+from pyModbusTCP.constants import MB_EXCEPT_ERR
+from pipelined_modbus_client import PipelinedModbusClient
+
+
+DEFAULT_UNIT_ID = 1     # pyModbusTCP's own default, also what a directly-connected meter answers to
+DEFAULT_TIMEOUT = 5.0   # Seconds to wait for a connect or a reply before giving up on this tick
+
+
+    # pyModbusTCP compatibility
+#######################################################################################
+# pyModbusTCP < 0.2 exposes 'unit_id', 'is_open' and 'last_error' as methods, newer releases
+#...expose them as properties. These helpers let the pool work with either.
+def _setUnitId(client, unit_id):
+    if callable(client.unit_id):
+        client.unit_id(unit_id)
+    else:
+        client.unit_id = unit_id
+
+
+def _isOpen(client):
+    is_open = client.is_open
+    return is_open() if callable(is_open) else is_open
+
+
+def _lastError(client):
+    last_error = client.last_error
+    return last_error() if callable(last_error) else last_error
+#######################################################################################
+
+
+def checkPipelineDepth(pipeline_depth):
+    # Raises ValueError unless 'pipeline_depth' is a whole number of at least 1, or a {host: depth} dictionary of them
+    depths = pipeline_depth.values() if isinstance(pipeline_depth, dict) else [pipeline_depth]
+    for depth in depths:
+        if not isinstance(depth, int) or isinstance(depth, bool) or not 1 <= depth <= 0xFFFF:
+            raise ValueError('Pipeline depths must be whole numbers from 1 to 65535, got {}'.format(depth))
+    return pipeline_depth
+
+
+class PooledConnection:
+
+    # A single persistent connection to one (host, port). The lock makes sure only one
+    #...request (or one pipelined batch) is on the wire at a time, since several unit IDs may
+    #...share this socket. 'pipeline' is a PipelinedModbusClient used instead of 'client' while
+    #...the host's pipeline depth is above 1.
+
+    def __init__(self, host, port, timeout=DEFAULT_TIMEOUT, on_connect=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.client = ModbusClient(host=host, port=port, timeout=timeout,
+                                   auto_open=False, auto_close=False)
+        self.pipeline = None
+        self.lock = threading.Lock()
+        self.opened_at = None       # time.time() of the last successful open(), None while closed
+        self.reconnects = 0         # How many times this connection had to be re-opened
+        self.on_connect = on_connect
+
+    def ensureOpen(self):
+        # Opens the socket only if it isn't already open. Must be called with the lock held.
+        if self.pipeline.isOpen() if self.pipeline is not None else _isOpen(self.client):
+            return True
+
+        reconnect = self.opened_at is not None     # We had a connection before, so this is a reconnect
+        if reconnect:
+            self.reconnects += 1
+
+        started = time.monotonic()
+        opened = bool(self.pipeline.open() if self.pipeline is not None else self.client.open())
+        if self.on_connect is not None:
+            self.on_connect(self.host, self.port, time.monotonic() - started, opened, reconnect)
+
+        self.opened_at = time.time() if opened else None
+        return opened
+
+    def reset(self):
+        # Drops the socket so the next request starts from a fresh connection.
+        self.client.close()
+        if self.pipeline is not None:
+            self.pipeline.close()
+        self.opened_at = None
+
+    def setPipelineDepth(self, depth):
+        # Switches between pyModbusTCP (depth 1) and a pipeline. Must be called with the lock held.
+        current = self.pipeline.depth if self.pipeline is not None else 1
+        if depth == current:
+            return
+        self.reset()
+        self.pipeline = PipelinedModbusClient(self.host, self.port, self.timeout, depth) if depth > 1 else None
+
+
+class ModbusConnectionPool:
+
+    # Connections are created lazily on first use and are then kept open until close()
+    #...or closeAll() is called. A read that gets no reply closes the socket and retries once
+    #...on a fresh connection, so a meter or gateway that dropped us is reconnected
+    #...transparently. A Modbus exception reply is an answer, so the socket is kept.
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, on_connect=None, pipeline_depth=1):
+
+        # 'on_connect(host, port, seconds, opened, reconnect)' is called after every attempt to
+        #...open a connection, e.g. to keep connect-time metrics. It runs on the polling threads.
+        # 'pipeline_depth' is the number of requests readMany() keeps in flight per connection:
+        #...one number for every host, or a {host: depth} dictionary (hosts not in it get 1).
+
+        self.timeout = timeout
+        self.on_connect = on_connect
+        self.pipeline_depth = checkPipelineDepth(pipeline_depth)
+        self._connections = {}               # (host, port) -> PooledConnection
+        self._pool_lock = threading.Lock()   # Only guards the dictionary, not the sockets
+
+    def getConnection(self, host, port):
+        key = (host, port)
+        with self._pool_lock:
+            connection = self._connections.get(key)
+            if connection is None:
+                connection = PooledConnection(host, port, timeout=self.timeout, on_connect=self.on_connect)
+                self._connections[key] = connection
+        return connection
+
+    def readHoldingRegisters(self, host, port, unit_id, address, count):
+
+        # Returns the register values, or None if the meter answered with a Modbus exception or
+        #...could not be read even after one reconnect attempt. Only the latter touches the
+        #...connection, which other meters behind the same gateway may be using too.
+
+        timestamp, response, duration = self.readMany(host, port, [(unit_id, address, count)])[0]
+        return response
+
+    def pipelineDepth(self, host):
+        if isinstance(self.pipeline_depth, dict):
+            return self.pipeline_depth.get(host, 1)
+        return self.pipeline_depth
+
+    def readMany(self, host, port, reads):
+
+        # Reads every (unit_id, address, count) in 'reads' from one (host, port) and returns a
+        #...(timestamp, registers, duration) per read, in the same order. 'registers' is None if
+        #...that read failed. As with readHoldingRegisters(), the reads that got no reply are
+        #...retried once on a fresh connection. A read answered with a Modbus exception (e.g. a
+        #...unit ID the gateway doesn't know) only fails itself, the socket and the other reads
+        #...carry on.
+
+        connection = self.getConnection(host, port)
+        results = [None] * len(reads)
+
+        with connection.lock:
+            connection.setPipelineDepth(self.pipelineDepth(host))
+            for attempt in range(2):
+                missing = [index for index, result in enumerate(results) if result is None]
+                if not missing:
+                    break
+                if not connection.ensureOpen():
+                    break
+
+                if connection.pipeline is not None:
+                    for index, result in zip(missing, connection.pipeline.readMany([reads[index] for index in missing])):
+                        results[index] = result
+                    continue     # (A failed pipeline has already closed its socket)
+
+                for index in missing:
+                    unit_id, address, count = reads[index]
+                    timestamp, started = time.time(), time.monotonic()
+                    _setUnitId(connection.client, unit_id)
+                    response = connection.client.read_holding_registers(address, count)
+                    if response is None and _lastError(connection.client) == MB_EXCEPT_ERR:
+                        results[index] = (timestamp, None, time.monotonic() - started)     # Not retried
+                        continue
+                    if response is None:
+                        connection.reset()     # Stale or half-closed socket, the rest go on a new one
+                        break
+                    results[index] = (timestamp, response, time.monotonic() - started)
+
+        return [result if result is not None else (time.time(), None, 0.0) for result in results]
+
+    def writeRegisters(self, host, port, unit_id, address, values):
+
+        # Writes 'values' to the holding registers starting at 'address'. Returns True if the
+        #...meter confirmed the write. As with the reads, a write that got no reply is tried once
+        #...more on a fresh connection, and a Modbus exception reply leaves the socket alone.
+
+        connection = self.getConnection(host, port)
+        with connection.lock:
+            connection.setPipelineDepth(self.pipelineDepth(host))
+            for attempt in range(2):
+                if not connection.ensureOpen():
+                    return False
+                if connection.pipeline is not None:
+                    written = connection.pipeline.writeRegisters(unit_id, address, values)     # (Closes its socket on failure)
+                else:
+                    _setUnitId(connection.client, unit_id)
+                    written = connection.client.write_multiple_registers(address, values)
+                    if not written and _lastError(connection.client) != MB_EXCEPT_ERR:
+                        connection.reset()
+                        written = None
+                if written is not None:
+                    return bool(written)
+        return False
+
+    def isConnected(self, host, port):
+
+        # Health check on the pooled socket itself. If it is already open nothing goes over
+        #...the wire, otherwise the pool tries to (re)open it and keeps it for the next read.
+
+        connection = self.getConnection(host, port)
+        with connection.lock:
+            connection.setPipelineDepth(self.pipelineDepth(host))
+            return connection.ensureOpen()
+
+    def close(self, host, port):
+        with self._pool_lock:
+            connection = self._connections.pop((host, port), None)
+        if connection is not None:
+            with connection.lock:
+                connection.reset()
+
+    def closeAll(self):
+        with self._pool_lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for connection in connections:
+            with connection.lock:
+                connection.reset()
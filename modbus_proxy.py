@@ -0,0 +1,212 @@
+"""
+--------------------------------------------------------------------------------------
+ORCA Modbus TCP Proxy
+
+A Shark meter only has a few Modbus TCP connection slots, and every SCADA system, HMI
+panel or script that polls it directly competes with the logger for them. With
+PROXY_PORT set, the logger keeps the latest registers it read from every meter in a
+LatestValueCache and answers Modbus TCP reads for them itself (ModbusProxyServer), so
+the meters only ever see one poller:
+
+- Each configured meter gets its own unit ID on the proxy (PROXY_UNIT_IDS in the
+  settings file, the others are numbered from 1 in the order of the settings).
+- The registers are the ones the meter itself sent back, at the same addresses, so a
+  client reads e.g. the Shark 200 primary block exactly as it would from the meter.
+  Only the registers of the readings listed in the settings (and any gaps the logger
+  reads across, see register_map.py) are there.
+- Only 'read holding registers' (function 3) is answered. The proxy is read-only.
+- A read is answered from memory, without waiting for the meter, in well under a
+  millisecond. Errors are answered the way a gateway would: exception 10 for a unit ID
+  that isn't configured, 11 if the meter hasn't been read successfully within
+  'max_age' seconds, and 2 for registers the logger doesn't read.
+--------------------------------------------------------------------------------------
+"""
+
+import bisect
+import collections
+import socket
+import socketserver
+import struct
+import threading
+import time
+import numpy as np
+
+
+ILLEGAL_FUNCTION = 0x01
+ILLEGAL_DATA_ADDRESS = 0x02
+ILLEGAL_DATA_VALUE = 0x03
+GATEWAY_PATH_UNAVAILABLE = 0x0A
+GATEWAY_TARGET_FAILED = 0x0B
+
+READ_HOLDING_REGISTERS = 3
+MAX_READ_COUNT = 125      # Largest number of registers in one Modbus read
+
+_HEADER = struct.Struct('>HHHB')      # MBAP header: transaction ID, protocol (0), length, unit ID
+_REPLY = struct.Struct('>HHHBBB')     # MBAP header, function, byte count (or exception code)
+
+# Sent by acquisition workers to the supervising process (see sharded_acquisition.py):
+#...'blocks' as in LatestValueCache.update()
+CachedBlocks = collections.namedtuple('CachedBlocks', ['meter_name', 'blocks'])
+
+
+def registerBlock(address, registers):
+    # One (address, data) block for LatestValueCache.update() from a read's response
+    #...(a list of register values or a '>u2' array)
+    return address, np.asarray(registers, dtype='>u2').tobytes()
+
+
+class _MeterRegisters:
+
+    # The latest register blocks of one meter: start address -> the registers as big-endian bytes
+
+    def __init__(self):
+        self.blocks = {}
+        self.starts = []     # Sorted start addresses of 'blocks'
+        self.updated = 0.0   # time.time() of the last update
+
+    def read(self, address, count):
+        # The registers as bytes, or None if any of them aren't cached. A read may span adjacent blocks.
+        data = []
+        end = address + count
+        while address < end:
+            position = bisect.bisect_right(self.starts, address) - 1
+            if position < 0:
+                return None
+            start = self.starts[position]
+            block = self.blocks[start]
+            block_end = start + len(block) // 2
+            if address >= block_end:
+                return None
+            stop = min(end, block_end)
+            data.append(block[2 * (address - start):2 * (stop - start)])
+            address = stop
+        return data[0] if len(data) == 1 else b''.join(data)
+
+
+class LatestValueCache:
+
+    def __init__(self, max_age=60.0):
+        self.max_age = max_age
+        self._meters = {}       # Meter name -> _MeterRegisters
+        self._unit_ids = {}     # Unit ID -> meter name
+        self._lock = threading.Lock()
+
+    def setUnitIds(self, unit_ids):
+        # {unit ID: meter name} of every meter the proxy serves. Meters no longer in it are dropped.
+        with self._lock:
+            self._unit_ids = dict(unit_ids)
+            for meter_name in set(self._meters) - set(unit_ids.values()):
+                del self._meters[meter_name]
+
+    def forget(self, meter_name):
+        # Drops a meter's registers, e.g. because its readings (and so its blocks) changed
+        with self._lock:
+            self._meters.pop(meter_name, None)
+
+    def update(self, meter_name, blocks, timestamp):
+        # Stores the latest registers of one poll: 'blocks' is a list of (start address, big-endian bytes), see registerBlock()
+        with self._lock:
+            meter = self._meters.get(meter_name)
+            if meter is None:
+                meter = self._meters[meter_name] = _MeterRegisters()
+            for address, data in blocks:
+                if address not in meter.blocks:
+                    bisect.insort(meter.starts, address)
+                meter.blocks[address] = data
+            meter.updated = timestamp
+
+    def read(self, unit_id, address, count):
+        # The registers as big-endian bytes, or the Modbus exception code to answer with
+        with self._lock:
+            meter_name = self._unit_ids.get(unit_id)
+            if meter_name is None:
+                return GATEWAY_PATH_UNAVAILABLE
+            meter = self._meters.get(meter_name)
+            if meter is None or time.time() - meter.updated > self.max_age:
+                return GATEWAY_TARGET_FAILED
+            data = meter.read(address, count)
+        return ILLEGAL_DATA_ADDRESS if data is None else data
+
+
+def _receiveExactly(connection, view):
+    # Fills 'view' from the socket. Returns False if the client closed the connection first.
+    received = 0
+    while received < len(view):
+        count = connection.recv_into(view[received:])
+        if not count:
+            return False
+        received += count
+    return True
+
+
+class _ProxyRequestHandler(socketserver.BaseRequestHandler):
+
+    # Answers one client's requests, one after another, until it disconnects
+
+    def handle(self):
+        connection = self.request
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        cache = self.server.cache
+        header = bytearray(_HEADER.size)
+        pdu = bytearray(253)     # Largest Modbus PDU
+        header_view, pdu_view = memoryview(header), memoryview(pdu)
+
+        try:
+            while _receiveExactly(connection, header_view):
+                transaction_id, protocol, length, unit_id = _HEADER.unpack(header)
+                if protocol != 0 or not 2 <= length <= 254:
+                    return     # Not Modbus TCP, dropping the connection
+                if not _receiveExactly(connection, pdu_view[:length - 1]):
+                    return
+                function = pdu[0]
+
+                if function != READ_HOLDING_REGISTERS:
+                    result = ILLEGAL_FUNCTION
+                elif length != 6:
+                    result = ILLEGAL_DATA_VALUE
+                else:
+                    address, count = struct.unpack_from('>HH', pdu, 1)
+                    if 1 <= count <= MAX_READ_COUNT:
+                        result = cache.read(unit_id, address, count)
+                    else:
+                        result = ILLEGAL_DATA_VALUE
+
+                if isinstance(result, int):
+                    reply = _REPLY.pack(transaction_id, 0, 3, unit_id, function | 0x80, result)
+                else:
+                    reply = _REPLY.pack(transaction_id, 0, 3 + len(result), unit_id, function, len(result)) + result
+                connection.sendall(reply)
+        except OSError:
+            pass     # The client went away
+
+
+class _ProxyTCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True     # Connected clients don't keep the script from exiting
+
+
+class ModbusProxyServer:
+
+    # Serves a LatestValueCache over Modbus TCP, one thread per client connection
+
+    def __init__(self, cache, host='127.0.0.1', port=5020):
+        self.cache = cache
+        self.host = host
+        self.port = port
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        # Raises OSError if the port can't be opened (e.g. in use, or below 1024 without root)
+        self._server = _ProxyTCPServer((self.host, self.port), _ProxyRequestHandler)
+        self._server.cache = self.cache
+        self.port = self._server.server_address[1]     # The port picked by the system if 'port' was 0
+        self._thread = threading.Thread(target=self._server.serve_forever, name='orca-modbus-proxy', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            self._thread = None
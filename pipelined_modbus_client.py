@@ -0,0 +1,180 @@
+"""
+--------------------------------------------------------------------------------------
+ORCA Pipelined Modbus TCP Client
+
+pyModbusTCP sends one request and waits for its reply before sending the next, so a
+gateway with 30 meters behind it (addressed by unit ID, like 'Galena_1' and 'Galena_2')
+costs 30 round-trips per tick. Modbus TCP numbers every request with a transaction ID,
+and gateways that queue requests answer them in turn, so PipelinedModbusClient keeps up
+to 'depth' read requests in flight on one socket and matches the replies to them by
+transaction ID. With a depth of 30, those 30 reads take about one round-trip.
+
+- The requests that fit in the pipeline are packed into one send buffer and sent with a
+  single sendall().
+- Replies are received straight into one buffer per batch with recv_into(), and each
+  one's registers are returned as a numpy '>u2' view into that buffer, which
+  register_decoder.decodeRegisters() takes without converting or copying. Every batch
+  gets a buffer of its own, so the views stay valid after later calls (e.g. the retry
+  of the reads a dropped connection left unanswered).
+- writeRegisters() writes a block of registers on the same socket, one request at a time
+  (see historical_backfill.py).
+- Not every gateway queues requests. Leave the depth at 1 (PIPELINE_DEPTH in the
+  settings file) for any that drop or refuse them.
+--------------------------------------------------------------------------------------
+"""
+
+import socket
+import struct
+import time
+import numpy as np
+
+
+MAX_ADU_SIZE = 260           # Largest Modbus TCP frame (7-byte MBAP header + 253-byte PDU)
+READ_HOLDING_REGISTERS = 3
+WRITE_MULTIPLE_REGISTERS = 16
+
+_REQUEST = struct.Struct('>HHHBBHH')     # MBAP header (transaction, protocol 0, length 6, unit ID), function, address, count
+_REPLY_HEADER = struct.Struct('>HHHBBB')  # MBAP header, function, byte count (or exception code)
+_WRITE_REQUEST = struct.Struct('>HHHBBHHB')   # MBAP header, function, address, count, byte count, then the values
+
+
+class ModbusProtocolError(Exception):
+    pass
+
+
+class PipelinedModbusClient:
+
+    def __init__(self, host, port, timeout=5.0, depth=8):
+        if depth < 1 or depth > 0xFFFF:
+            raise ValueError('Pipeline depth must be between 1 and 65535, got {}'.format(depth))
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.depth = depth
+
+        self._socket = None
+        self._transaction_id = 0
+        self._send_buffer = bytearray(_REQUEST.size * depth)
+
+    def open(self):
+        if self._socket is not None:
+            return True
+        try:
+            self._socket = socket.create_connection((self.host, self.port), self.timeout)
+        except OSError:
+            return False
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)     # Don't hold back small requests
+        return True
+
+    def isOpen(self):
+        return self._socket is not None
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def _receive(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self._socket.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError('{}:{} closed the connection'.format(self.host, self.port))
+            data += chunk
+        return data
+
+    def writeRegisters(self, unit_id, address, values):
+
+        # Writes 'values' to the holding registers starting at 'address' (function 16), on its
+        #...own rather than pipelined. Returns True once the meter confirms the write, False if
+        #...it answered with a Modbus exception, or None if the connection failed (it is closed).
+
+        if not self.open():
+            return None
+        self._transaction_id = (self._transaction_id + 1) & 0xFFFF
+        request = _WRITE_REQUEST.pack(self._transaction_id, 0, 7 + 2 * len(values), unit_id, WRITE_MULTIPLE_REGISTERS,
+                                      address, len(values), 2 * len(values)) + struct.pack('>{}H'.format(len(values)), *values)
+        try:
+            self._socket.sendall(request)
+            while True:
+                header = self._receive(_REPLY_HEADER.size)
+                transaction_id, protocol, length, reply_unit_id, function, byte_count = _REPLY_HEADER.unpack(header)
+                if protocol != 0 or length < 3 or length > MAX_ADU_SIZE - 6:
+                    raise ModbusProtocolError('Invalid reply header from {}:{}'.format(self.host, self.port))
+                self._receive(6 + length - _REPLY_HEADER.size)
+                if transaction_id == self._transaction_id:     # (Anything else is a late reply to an earlier read)
+                    return function == WRITE_MULTIPLE_REGISTERS
+        except (OSError, ModbusProtocolError):
+            self.close()
+            return None
+
+    def readMany(self, reads):
+
+        # Reads holding registers for every (unit_id, address, count) in 'reads', keeping up to
+        #...'depth' requests in flight. Returns a (timestamp, registers, duration) per read, in
+        #...the same order: 'timestamp' is time.time() when its request went out, 'registers' a
+        #...'>u2' array (None if the meter answered with a Modbus exception) and 'duration' the
+        #...seconds until its reply came in. If the connection fails part way, it is closed and
+        #...the reads that got no reply are None instead of a tuple.
+
+        results = [None] * len(reads)
+        if not reads or not self.open():
+            return results
+
+        # Every reply of this batch gets its own place in a new receive buffer. It is never
+        #...reused, since the register views handed back (and still held by the caller) point
+        #...into it. One frame extra leaves room for a late reply to an earlier batch.
+        buffer = bytearray(sum(9 + 2 * count for unit_id, address, count in reads) + MAX_ADU_SIZE)
+        view = memoryview(buffer)
+
+        pending = {}      # Transaction ID -> (index in 'reads', timestamp, monotonic time sent)
+        next_read = 0
+        received = 0      # Bytes in the buffer
+        parsed = 0        # Bytes of those already taken apart into replies
+
+        try:
+            while next_read < len(reads) or pending:
+
+                # Filling the pipeline back up
+                frames = 0
+                while next_read < len(reads) and len(pending) < self.depth:
+                    unit_id, address, count = reads[next_read]
+                    self._transaction_id = (self._transaction_id + 1) & 0xFFFF
+                    _REQUEST.pack_into(self._send_buffer, frames * _REQUEST.size, self._transaction_id, 0, 6,
+                                       unit_id, READ_HOLDING_REGISTERS, address, count)
+                    pending[self._transaction_id] = (next_read, time.time(), time.monotonic())
+                    next_read += 1
+                    frames += 1
+                if frames:
+                    self._socket.sendall(memoryview(self._send_buffer)[:frames * _REQUEST.size])
+
+                if received == len(buffer):
+                    raise ModbusProtocolError('More reply data than requested from {}:{}'.format(self.host, self.port))
+                count_received = self._socket.recv_into(view[received:])
+                if not count_received:
+                    raise ConnectionError('{}:{} closed the connection'.format(self.host, self.port))
+                received += count_received
+
+                # Taking apart every complete reply in the buffer
+                while received - parsed >= _REPLY_HEADER.size:
+                    transaction_id, protocol, length, unit_id, function, byte_count = _REPLY_HEADER.unpack_from(buffer, parsed)
+                    if protocol != 0 or length < 3 or length > MAX_ADU_SIZE - 6:
+                        raise ModbusProtocolError('Invalid reply header from {}:{}'.format(self.host, self.port))
+                    end = parsed + 6 + length
+                    if end > received:
+                        break     # The rest of this reply hasn't arrived yet
+
+                    sent = pending.pop(transaction_id, None)
+                    if sent is not None:     # (Anything else is a late reply to a request we gave up on)
+                        index, timestamp, started = sent
+                        register_count = reads[index][2]
+                        if function == READ_HOLDING_REGISTERS and byte_count == 2 * register_count == length - 3:
+                            registers = np.frombuffer(buffer, dtype='>u2', count=register_count, offset=parsed + 9)
+                        else:
+                            registers = None     # Exception reply (function | 0x80), e.g. an unknown unit ID
+                        results[index] = (timestamp, registers, time.monotonic() - started)
+                    parsed = end
+        except (OSError, ModbusProtocolError):
+            self.close()     # Whatever was still in flight is lost with the socket
+
+        return results
@@ -0,0 +1,185 @@
+"""
+--------------------------------------------------------------------------------------
+ORCA Poll Plans and Settings Reloading
+
+Everything the acquisition loop needs to know about a meter is worked out once, when the
+settings are loaded, and kept in an immutable PollPlan: where the meter is, its timestep,
+its cleaned column names in row order, the Modbus reads and how to decode them, and its
+logger. The loop then only looks things up in the plans, instead of re-checking and
+re-cleaning the 'readings' lists and searching the loggers on every tick.
+
+A meter's readings can come from blocks that are polled at different rates (BLOCK_RATES
+in the settings file): e.g. the primary readings every second, the energy accumulators
+every minute and demand every 15 minutes. Each rate is a RateGroup of the plan with its
+own reads and its own output stream: the meter's own timestep writes to '<meter>' as
+always, the others to '<meter>_1min', '<meter>_15min' and so on. Blocks with a rate of
+None are only read on request, when the READ_REQUEST_FILE is saved (see
+ReadRequestWatcher), and go to '<meter>_on_request'. Only the blocks that are due are read,
+so the load on the meters and the network follows the rates, not the number of blocks.
+
+The plans don't hold the meters' data writers. The plans are sent to the worker processes
+with sharded acquisition (see sharded_acquisition.py), and open files can't be, and the
+samples may be written on the write-behind thread, which swaps writers on its own
+schedule (see WriteBehindBuffer.runAfterQueued()). The writers stay in the main script's
+'data_writers', one dict lookup per row.
+
+SettingsWatcher notices when the settings file is saved and reloads it. The main script
+then compiles new plans and comparePlans() tells it which meters were added, changed or
+removed, so only those are touched and every other meter keeps its schedule.
+--------------------------------------------------------------------------------------
+"""
+
+import collections
+import importlib
+import importlib.util
+import os
+import time
+from register_map import cleanName
+from rollup_aggregator import intervalLabel
+
+
+# name, host, port, unit_id, decimal_places: as in the settings
+# timestep: Seconds between polls
+# model:    Meter model (see meter_drivers.py)
+# columns:  Cleaned reading names in row order, after the timestamp
+# reads:    The register_map.ReadRequests that fetch them, with their decode runs
+# register_map, logger: The meter's register map and logger
+# groups:   A RateGroup per polling rate, the meter's timestep first. 'columns' and 'reads'
+#           above are those of the first group, empty if every reading has a rate of its own.
+PollPlan = collections.namedtuple('PollPlan', ['name', 'host', 'port', 'unit_id', 'decimal_places', 'timestep', 'model',
+                                               'columns', 'reads', 'register_map', 'logger', 'groups'])
+
+# stream:   Output stream the group's rows go to (also its scheduler task name)
+# timestep: Seconds between polls, or None if the group is only read on request
+# columns, reads: As in PollPlan, for the readings of this group only
+RateGroup = collections.namedtuple('RateGroup', ['stream', 'timestep', 'columns', 'reads'])
+
+ON_REQUEST = None     # BLOCK_RATES value of a block that is only read when asked for
+
+
+def groupStream(meter_name, timestep, meter_timestep):
+    # Stream name of a rate group: the meter's own name for its main timestep
+    if timestep == meter_timestep:
+        return meter_name
+    if timestep is ON_REQUEST:
+        return meter_name + '_on_request'
+    return '{}_{}'.format(meter_name, intervalLabel(int(timestep)) if timestep == int(timestep) else '{}s'.format(timestep))
+
+
+def meterColumns(meter):
+    # The reading names of a settings entry, cleaned, in row order and without 'timestamp'
+    return tuple(cleanName(name) for name in meter.readings if cleanName(name) != 'timestamp')
+
+
+def compilePlan(meter, timestep, logger, block_rates=None, **read_options):
+
+    # Builds the PollPlan for one meter driver (see meter_drivers.py). 'block_rates' maps
+    #...register map block names to their own timestep, or to ON_REQUEST. Raises ValueError
+    #...if anything about the meter is invalid.
+
+    if len([char for char in meter.host if ((char >= '0') & (char <= '9')) | (char == '.')]) != len(meter.host):
+        raise ValueError('Invalid host name for {}: {}'.format(meter.name, meter.host))
+    if not timestep > 0:
+        raise ValueError('Timestep for {} must be greater than 0, got {}'.format(meter.name, timestep))
+    block_rates = block_rates or {}
+    for block, rate in block_rates.items():
+        if rate is not ON_REQUEST and not (isinstance(rate, (int, float)) and rate > 0):
+            raise ValueError('The rate of block {} must be a number of seconds or None, got {}'.format(block, rate))
+
+    columns = meterColumns(meter)
+    try:
+        rates = [block_rates.get(meter.register_map.registers[name].block, timestep) for name in columns]
+    except KeyError as error:
+        raise ValueError('Invalid reading name for {}: {}'.format(meter.name, error))
+
+    groups = []
+    for rate in [timestep] + sorted(set(rates) - {timestep, ON_REQUEST}) + [ON_REQUEST]:     # Fastest first
+        names = tuple(name for name, name_rate in zip(columns, rates) if name_rate == rate)
+        if names:
+            reads = tuple(meter.register_map.planReads(names, **read_options))
+            groups.append(RateGroup(groupStream(meter.name, rate, timestep), rate, names, reads))
+
+    main_columns, main_reads = (groups[0].columns, groups[0].reads) if groups and groups[0].timestep == timestep else ((), ())
+    return PollPlan(meter.name, meter.host, meter.port, meter.unit_id, meter.decimal_places, timestep, meter.model,
+                    main_columns, main_reads, meter.register_map, logger, tuple(groups))
+
+
+def comparePlans(old_plans, new_plans):
+    # Returns the names of the meters that were (added, changed, removed) between two {name: PollPlan}
+    added = [name for name in new_plans if name not in old_plans]
+    changed = [name for name in new_plans if name in old_plans and new_plans[name] != old_plans[name]]
+    removed = [name for name in old_plans if name not in new_plans]
+    return added, changed, removed
+
+
+class ReadRequestWatcher:
+
+    # Watches the read request file. Saving (or touching) it asks for the on-request blocks of
+    #...the meters named in it, one per line, or of every meter if it's empty. Each acquisition
+    #...loop (and each worker process) sees the change on its own, so the file is left in place.
+
+    def __init__(self, path):
+        self.path = path
+        self._stamp = self._stat()     # A file left over from before the start isn't a request
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def poll(self):
+        # Returns the set of meter names asked for (empty for all) if the file changed, None otherwise
+        stamp = self._stat()
+        if stamp is None or stamp == self._stamp:
+            return None
+        self._stamp = stamp
+        try:
+            with open(self.path) as request_file:
+                return set(line.strip() for line in request_file if line.strip())
+        except OSError:
+            return None
+
+
+class SettingsWatcher:
+
+    # Reloads a settings module when its file changes. The file is looked at (one os.stat())
+    #...at most every 'check_interval' seconds.
+
+    def __init__(self, settings_module, check_interval=2.0):
+        self.module = settings_module
+        self.path = settings_module.__file__
+        self.check_interval = check_interval
+        self._stamp = self._stat()
+        self._last_check = time.monotonic()
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None     # Probably being saved right now
+        return stat.st_mtime_ns, stat.st_size
+
+    def poll(self):
+
+        # Returns the reloaded module if the file has changed since the last call, None otherwise.
+        #...Anything the settings file raises (e.g. a SyntaxError while it's half edited) is
+        #...passed on; the next save is picked up again.
+
+        if time.monotonic() - self._last_check < self.check_interval:
+            return None
+        self._last_check = time.monotonic()
+
+        stamp = self._stat()
+        if stamp is None or stamp == self._stamp:
+            return None
+        self._stamp = stamp
+
+        # The cached bytecode only records the file's size and whole-second modification time,
+        #...so two saves within a second could otherwise reload the old settings
+        try:
+            os.remove(importlib.util.cache_from_source(self.path))
+        except OSError:
+            pass
+        return importlib.reload(self.module)
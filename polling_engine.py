@@ -0,0 +1,114 @@
+"""
+--------------------------------------------------------------------------------------
+ORCA Concurrent Polling Engine
+
+Issues the Modbus reads for every configured meter at the same time on each tick
+instead of walking the meters one after another. The reads themselves are still the
+blocking pyModbusTCP calls, so they are handed to a thread pool from an asyncio event
+loop. A per-host semaphore bounds how many requests are in flight against one meter
+or gateway, and each meter's timestamp is taken when its request actually goes out.
+
+With a 'batch_function', all the requests to one host are instead handed over in a single
+call, so the connection pool can pipeline them on one socket (see
+pipelined_modbus_client.py) rather than waiting out one round-trip per meter.
+--------------------------------------------------------------------------------------
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import time
+
+
+# meter_name: Only used to label the result
+# host:       Requests are throttled per host, so meters behind one gateway share a limit
+# read_args:  Positional arguments handed to the engine's read function, e.g. getModbusData()
+PollRequest = collections.namedtuple('PollRequest', ['meter_name', 'host', 'read_args'])
+
+# timestamp: time.time() taken right before the request went out
+# response:  Whatever the read function returned (None if the meter couldn't be read)
+# duration:  Seconds the read took, measured on the monotonic clock
+# error:     The exception raised by the read function, if any
+PollResult = collections.namedtuple('PollResult', ['meter_name', 'timestamp', 'response', 'duration', 'error'])
+
+
+class PollingEngine:
+
+    def __init__(self, read_function, max_in_flight_per_host=1, max_workers=64, batch_function=None):
+
+        # 'batch_function(list of read_args)', if given, reads all of a host's requests for the
+        #...tick at once and returns a (timestamp, response, duration) per request. It is used
+        #...instead of 'read_function', and each host then has one batch in flight at a time.
+
+        self.read_function = read_function
+        self.batch_function = batch_function
+        self.max_in_flight_per_host = max_in_flight_per_host
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                               thread_name_prefix='orca-poll')
+        self._loop = asyncio.new_event_loop()   # Kept for the life of the engine, not rebuilt every tick
+        self._host_semaphores = {}              # host -> asyncio.Semaphore, created on first use
+
+    def _semaphoreFor(self, host):
+        # Created lazily from inside the running loop so it is bound to self._loop
+        semaphore = self._host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_in_flight_per_host)
+            self._host_semaphores[host] = semaphore
+        return semaphore
+
+    async def _pollOne(self, request):
+        async with self._semaphoreFor(request.host):
+            timestamp = time.time()     # Per-meter acquisition time, taken at request time
+            started = time.monotonic()
+            response, error = None, None
+            try:
+                response = await self._loop.run_in_executor(self._executor,
+                                                            self.read_function,
+                                                            *request.read_args)
+            except Exception as exception:     # One meter failing must not cancel the reads of the others
+                error = exception
+            return PollResult(request.meter_name, timestamp, response, time.monotonic() - started, error)
+
+    async def _pollBatch(self, requests):
+        async with self._semaphoreFor(requests[0].host):
+            timestamp = time.time()
+            started = time.monotonic()
+            try:
+                responses = await self._loop.run_in_executor(self._executor,
+                                                             self.batch_function,
+                                                             [request.read_args for request in requests])
+            except Exception as exception:     # Only fails this host's requests
+                return [PollResult(request.meter_name, timestamp, None, time.monotonic() - started, exception)
+                        for request in requests]
+            return [PollResult(request.meter_name, read_timestamp, response, duration, None)
+                    for request, (read_timestamp, response, duration) in zip(requests, responses)]
+
+    async def pollAllAsync(self, requests):
+        if self.batch_function is None:
+            return await asyncio.gather(*[self._pollOne(request) for request in requests])
+
+        by_host = {}     # host -> indexes of its requests, in order
+        for index, request in enumerate(requests):
+            by_host.setdefault(request.host, []).append(index)
+        batches = await asyncio.gather(*[self._pollBatch([requests[index] for index in indexes])
+                                         for indexes in by_host.values()])
+        results = [None] * len(requests)
+        for indexes, batch in zip(by_host.values(), batches):
+            for index, result in zip(indexes, batch):
+                results[index] = result
+        return results
+
+    def pollAll(self, requests):
+        # Blocking entry point for the main loop. Returns one PollResult per request,
+        #...in the same order as 'requests'.
+        return self._loop.run_until_complete(self.pollAllAsync(requests))
+
+    def submit(self, function, *args):
+        # Runs a one-off blocking call (e.g. a reconnect attempt) on the engine's thread pool
+        #...without waiting for it. Returns a concurrent.futures.Future.
+        return self._executor.submit(function, *args)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._loop.close()
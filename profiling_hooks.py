@@ -0,0 +1,246 @@
+"""
+--------------------------------------------------------------------------------------
+ORCA Profiling Hooks
+
+Lets a running logger be profiled without stopping it, so a site that starts falling
+behind can be looked at while the problem is actually happening.
+
+Two kinds of profiling can be switched on and off independently:
+
+    cpu      Where the time goes. Either a stack sampler (the default), which looks at
+             every thread's stack every few milliseconds and so also covers the polling
+             threads and the write-behind thread, or cProfile, which traces every call
+             made by the acquisition loop's own thread.
+    memory   tracemalloc: the top allocation sites, and how they grew while tracing was on.
+
+Two ways to switch them:
+
+    Signals      'kill -USR1 <pid>' toggles cpu profiling, 'kill -USR2 <pid>' toggles
+                 memory tracing.
+    Control file Writing 'cpu' and/or 'memory' into the control file (by default
+                 './logs/profiling') switches those on. Removing a word, or the whole
+                 file, switches it off again. With several worker processes this
+                 reaches all of them at once.
+
+When something is switched off its results are written to './logs/' with a timestamp
+and the process name in the file name:
+
+    profile_<time>_<process>.txt        the hottest functions (both profilers)
+    profile_<time>_<process>.folded     folded stacks for flamegraph.pl / speedscope (sampler)
+    profile_<time>_<process>.prof       pstats data for snakeviz and friends (cProfile)
+    memory_<time>_<process>.txt         top allocation sites and the growth since tracing started
+
+The signal handlers only set a flag. Everything else happens in poll(), which the loop
+calls once per pass, so while nothing is switched on the only cost is checking two flags
+and looking at the control file once a second.
+--------------------------------------------------------------------------------------
+"""
+
+import cProfile
+import collections
+import datetime
+import io
+import multiprocessing
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+
+
+SAMPLER = 'sampler'
+CPROFILE = 'cprofile'
+
+CPU = 'cpu'
+MEMORY = 'memory'
+
+
+class StackSampler:
+
+    # Samples the stacks of every other thread every 'interval' seconds from a background thread
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = collections.Counter()     # Folded stack ('thread;outer;...;inner') -> samples
+        self.samples = 0
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='orca-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stopping.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def writeResults(self, base_path):
+        with open(base_path + '.folded', 'w') as folded_file:
+            for stack, count in self.stacks.most_common():
+                folded_file.write('{} {}\n'.format(stack, count))
+
+        # The innermost frame of each sample is where that thread was actually spending its time
+        own_time = collections.Counter()
+        for stack, count in self.stacks.items():
+            own_time[stack.rsplit(';', 1)[-1]] += count
+        total = sum(own_time.values()) or 1
+
+        with open(base_path + '.txt', 'w') as text_file:
+            text_file.write('{} samples every {:.1f} ms, all threads (wall-clock, so idle threads waiting for work show up too)\n\n'.format(self.samples, self.interval * 1000))
+            text_file.write('{:>8} {:>7}  {}\n'.format('samples', 'share', 'innermost frame'))
+            for frame, count in own_time.most_common(50):
+                text_file.write('{:>8} {:>7.1%}  {}\n'.format(count, count / total, frame))
+
+
+class ProfilingHooks:
+
+    def __init__(self, directory='./logs', control_file='./logs/profiling', profiler=SAMPLER,
+                 sample_interval=0.005, control_interval=1.0, logger=None):
+        if profiler not in (SAMPLER, CPROFILE):
+            raise ValueError("Profiler must be '{}' or '{}', got {}".format(SAMPLER, CPROFILE, profiler))
+
+        self.directory = directory
+        self.control_file = control_file
+        self.profiler = profiler
+        self.sample_interval = sample_interval
+        self.control_interval = control_interval     # Seconds between looks at the control file
+        self.logger = logger
+
+        self._toggle_requested = {CPU: False, MEMORY: False}     # Set by the signal handlers
+        self._from_control_file = set()     # What the control file switched on, so removing it switches it off
+        self._last_control_check = 0.0
+
+        self._cpu_profiler = None           # StackSampler or cProfile.Profile while cpu profiling is on
+        self._memory_baseline = None        # tracemalloc snapshot taken when memory tracing was switched on
+
+    def install(self, cpu_signal=signal.SIGUSR1, memory_signal=signal.SIGUSR2):
+        # Must be called from the main thread
+        signal.signal(cpu_signal, lambda signum, frame: self._toggle_requested.__setitem__(CPU, True))
+        signal.signal(memory_signal, lambda signum, frame: self._toggle_requested.__setitem__(MEMORY, True))
+
+    def isRunning(self, kind):
+        return (self._cpu_profiler if kind == CPU else self._memory_baseline) is not None
+
+    def poll(self):
+        # Called once per pass of the loop, from the thread that should be traced by cProfile
+
+        for kind in (CPU, MEMORY):
+            if self._toggle_requested[kind]:
+                self._toggle_requested[kind] = False
+                self._from_control_file.discard(kind)
+                self._switch(kind, not self.isRunning(kind))
+
+        if self.control_file is None or time.monotonic() - self._last_control_check < self.control_interval:
+            return
+        self._last_control_check = time.monotonic()
+
+        try:
+            with open(self.control_file) as control_file:
+                wanted = set(control_file.read().split()) & {CPU, MEMORY}
+        except OSError:
+            wanted = set()     # No control file, which is the usual case
+
+        for kind in (CPU, MEMORY):
+            if kind in wanted and not self.isRunning(kind):
+                self._from_control_file.add(kind)
+                self._switch(kind, True)
+            elif kind not in wanted and kind in self._from_control_file:
+                self._from_control_file.discard(kind)
+                self._switch(kind, False)
+
+    def _switch(self, kind, on):
+        try:
+            if kind == CPU:
+                self._startCpu() if on else self._stopCpu()
+            else:
+                self._startMemory() if on else self._stopMemory()
+        except Exception:
+            if self.logger is not None:
+                self.logger.error('Could not switch {} profiling {}'.format(kind, 'on' if on else 'off'), exc_info=True)
+
+    def _basePath(self, prefix):
+        stamp = datetime.datetime.now().strftime('%Y_%m_%d_%H%M%S')
+        return os.path.join(self.directory, '{}_{}_{}'.format(prefix, stamp, multiprocessing.current_process().name))
+
+    def _log(self, message):
+        if self.logger is not None:
+            self.logger.info(message)
+
+    def _startCpu(self):
+        if self.profiler == SAMPLER:
+            self._cpu_profiler = StackSampler(self.sample_interval)
+            self._cpu_profiler.start()
+        else:
+            self._cpu_profiler = cProfile.Profile()
+            self._cpu_profiler.enable()
+        self._log('CPU profiling ({}) switched on'.format(self.profiler))
+
+    def _stopCpu(self):
+        profiler, self._cpu_profiler = self._cpu_profiler, None
+        base_path = self._basePath('profile')
+
+        if isinstance(profiler, StackSampler):
+            profiler.stop()
+            profiler.writeResults(base_path)
+        else:
+            profiler.disable()
+            profiler.dump_stats(base_path + '.prof')
+            text = io.StringIO()
+            pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(50)
+            with open(base_path + '.txt', 'w') as text_file:
+                text_file.write(text.getvalue())
+
+        self._log('CPU profiling switched off, results written to ' + base_path + '.*')
+
+    def _startMemory(self):
+        tracemalloc.start(10)     # Keeping 10 frames per allocation
+        self._memory_baseline = tracemalloc.take_snapshot()
+        self._log('Memory tracing switched on')
+
+    def _stopMemory(self):
+        baseline, self._memory_baseline = self._memory_baseline, None
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        ignored = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, '<frozen importlib._bootstrap>')]
+        snapshot, baseline = snapshot.filter_traces(ignored), baseline.filter_traces(ignored)
+
+        path = self._basePath('memory') + '.txt'
+        with open(path, 'w') as text_file:
+            text_file.write('Traced memory: {:.1f} KiB now, {:.1f} KiB peak\n\n'.format(current / 1024, peak / 1024))
+            text_file.write('Top allocation sites:\n')
+            for statistic in snapshot.statistics('lineno')[:30]:
+                text_file.write('    {}\n'.format(statistic))
+            text_file.write('\nGrowth since tracing was switched on:\n')
+            for difference in snapshot.compare_to(baseline, 'lineno')[:30]:
+                text_file.write('    {}\n'.format(difference))
+            text_file.write('\nLargest allocation site, full traceback:\n')
+            for statistic in snapshot.statistics('traceback')[:1]:
+                text_file.write('    ' + '\n    '.join(statistic.traceback.format()) + '\n')
+
+        self._log('Memory tracing switched off, results written to ' + path)
+
+    def close(self):
+        # Writes out anything still running, e.g. when the logger is stopped mid-profile
+        for kind in (CPU, MEMORY):
+            if self.isRunning(kind):
+                self._switch(kind, False)
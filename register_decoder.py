@@ -0,0 +1,101 @@
+"""
+--------------------------------------------------------------------------------------
+ORCA Vectorized Register Decoder
+
+Converts whole blocks of raw 16-bit Modbus registers into values in one NumPy pass,
+instead of packing and unpacking every register pair with 'struct' in a Python loop.
+
+Supported data types (number of registers per value in brackets):
+    'float32' (2)    IEEE 754 single precision, used by the Shark primary readings
+    'int16'   (1)    signed,   e.g. the phase angle block (usually with a scale of 0.1)
+    'uint16'  (1)    unsigned, e.g. status and bit-mapped registers
+    'int32'   (2)    signed
+    'uint32'  (2)    unsigned, e.g. time counters
+    'int64'   (4)    signed,   the energy accumulators
+    'uint64'  (4)    unsigned
+
+Word order is the order of the registers that make up one value:
+    'little' - least significant register first. This is how the Shark meters send their
+               floats, and what the old format32BitFloat() assumed.
+    'big'    - most significant register first.
+
+Byte order is the order of the two bytes inside each register. pyModbusTCP already hands
+us each register as an integer, so this is 'big' for every well-behaved device; 'little'
+is for gateways that swap the bytes of every register.
+
+A 'scale' multiplies the decoded values (returned as float64), for the scaled-integer
+registers in the Shark Modbus map.
+--------------------------------------------------------------------------------------
+"""
+
+import numpy as np
+
+
+FLOAT32 = 'float32'
+INT16 = 'int16'
+UINT16 = 'uint16'
+INT32 = 'int32'
+UINT32 = 'uint32'
+INT64 = 'int64'
+UINT64 = 'uint64'
+
+# data type -> (registers per value, big-endian NumPy dtype of one whole value)
+DATA_TYPES = {FLOAT32: (2, np.dtype('>f4')),
+              INT16:   (1, np.dtype('>i2')),
+              UINT16:  (1, np.dtype('>u2')),
+              INT32:   (2, np.dtype('>i4')),
+              UINT32:  (2, np.dtype('>u4')),
+              INT64:   (4, np.dtype('>i8')),
+              UINT64:  (4, np.dtype('>u8'))}
+
+
+def registerCount(data_type):
+    # Number of 16-bit registers one value of 'data_type' takes up
+    return DATA_TYPES[data_type][0]
+
+
+def registersFromBytes(buffer):
+    # Turns a raw Modbus payload (big-endian registers, as they come off the wire) into a
+    #...uint16 array without copying it.
+    return np.frombuffer(buffer, dtype='>u2')
+
+
+def decodeRegisters(registers, data_type=FLOAT32, word_order='little', byte_order='big', scale=None):
+
+    # Decodes a block of registers, or a batch of equally sized blocks (e.g. the same block
+    #...read from many meters, as a 2-D array or a list of lists), in a single pass.
+    # The last axis holds the registers. Returns an array with one value per
+    #...'registerCount(data_type)' registers along that axis.
+
+    if data_type not in DATA_TYPES:
+        raise ValueError('Unknown register data type: {}'.format(data_type))
+    if word_order not in ('little', 'big') or byte_order not in ('little', 'big'):
+        raise ValueError("Word and byte order must each be 'little' or 'big'")
+
+    words_per_value, value_dtype = DATA_TYPES[data_type]
+
+    registers = np.asarray(registers)
+    if registers.dtype != np.dtype('>u2'):
+        registers = registers.astype('>u2')     # Plain Python ints from pyModbusTCP end up here
+
+    if registers.shape[-1] % words_per_value:
+        raise ValueError('{} registers is not a whole number of {} values'.format(registers.shape[-1], data_type))
+
+    if byte_order == 'little':
+        registers = registers.byteswap()        # Swapping the two bytes inside each register
+
+    values_shape = registers.shape[:-1] + (registers.shape[-1] // words_per_value,)
+    words = registers.reshape(values_shape + (words_per_value,))
+
+    if word_order == 'little' and words_per_value > 1:
+        words = words[..., ::-1]                # Most significant register first from here on
+
+    # With the registers now in big-endian order, the bytes of each value are contiguous
+    #...and can be reinterpreted as the target type directly.
+    values = np.ascontiguousarray(words).view(value_dtype).reshape(values_shape)
+    values = values.astype(value_dtype.newbyteorder('='))     # Native byte order for the rest of the pipeline
+
+    if scale is not None:
+        values = values * float(scale)
+
+    return values
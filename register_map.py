@@ -0,0 +1,140 @@
+"""
+--------------------------------------------------------------------------------------
+ORCA Register Map and Read Planner
+
+Describes every measurement a meter offers as a Register (name, address, data type,
+scale and the block it belongs to), and turns the list of readings a meter actually
+wants into the fewest Modbus read requests:
+
+- Registers that sit next to each other in the same block are merged into one read.
+- Unrequested registers between two requested ones of the same block are read through
+  and discarded, since one longer read is cheaper than another round-trip. 'max_gap'
+  limits how many may be read through (None, the default, allows any gap that keeps
+  the read within the limit below).
+- No read is ever longer than the Modbus limit of 125 registers.
+- Reads never cross from one block into another, since some meters reject reads that
+  touch undefined registers.
+
+Addresses are the register numbers as listed in the meter's user manual, the same
+numbers getModbusData() takes.
+--------------------------------------------------------------------------------------
+"""
+
+import collections
+from register_decoder import decodeRegisters, registerCount, FLOAT32
+
+
+MAX_REGISTERS_PER_READ = 125     # Modbus limit for one 'read holding registers' request
+
+
+# name:      Column name, as used in the settings 'readings' lists and the .csv headers
+# address:   First register of the value (user manual numbering)
+# data_type: One of the register_decoder data types
+# scale:     Multiplier applied after decoding, or None
+# block:     Name of the block the register belongs to
+Register = collections.namedtuple('Register', ['name', 'address', 'data_type', 'scale', 'block'])
+
+# A run of registers of the same type and scale that can be decoded in a single pass
+# offset: index of the first register of the run within the read's response
+DecodeRun = collections.namedtuple('DecodeRun', ['offset', 'register_count', 'data_type', 'scale', 'names'])
+
+# One Modbus read. start_register and end_register are inclusive, like getModbusData()'s.
+ReadRequest = collections.namedtuple('ReadRequest', ['block', 'start_register', 'end_register', 'runs'])
+
+
+def cleanName(name):
+    # The names in the settings and readings blocks may contain commas (e.g. 'VARs, Phase B'),
+    #...which would break the .csv files, so they are always compared in this cleaned form.
+    return name.replace(',', '').strip()
+
+
+def registerBlock(block, start_address, names, data_type=FLOAT32, scale=None):
+    # Builds the Registers for a block of consecutive values that all share one data type,
+    #...which is how most of the Shark Modbus map is laid out.
+    size = registerCount(data_type)
+    return [Register(cleanName(name), start_address + index * size, data_type, scale, block)
+            for index, name in enumerate(names)]
+
+
+class RegisterMap:
+
+    def __init__(self, registers):
+        self.registers = {}     # name -> Register
+        for register in registers:
+            if register.name in self.registers:
+                raise ValueError('Register {} is defined twice'.format(register.name))
+            self.registers[register.name] = register
+
+    def names(self, block=None):
+        # All register names (optionally of one block) in address order
+        return [register.name for register in sorted(self.registers.values(), key=lambda register: register.address)
+                if block is None or register.block == block]
+
+    def blocks(self):
+        return sorted(set(register.block for register in self.registers.values()))
+
+    def planReads(self, readings, max_gap=None, max_registers=MAX_REGISTERS_PER_READ):
+
+        # Returns the list of ReadRequests needed to get every name in 'readings'.
+        # Raises KeyError naming the first reading that isn't in the map.
+
+        wanted = []
+        for name in set(cleanName(name) for name in readings):
+            if name == 'timestamp':
+                continue
+            if name not in self.registers:
+                raise KeyError('Unknown reading: {}'.format(name))
+            wanted.append(self.registers[name])
+
+        wanted.sort(key=lambda register: (register.block, register.address))
+
+        # Grouping the requested registers into reads
+        #------------------------------------------------------------------------------
+        groups = []
+        for register in wanted:
+            end = register.address + registerCount(register.data_type) - 1
+            if groups:
+                group = groups[-1]
+                group_start, group_end = group[0].address, group[-1].address + registerCount(group[-1].data_type) - 1
+                if (register.block == group[0].block
+                        and (max_gap is None or register.address - group_end - 1 <= max_gap)
+                        and end - group_start + 1 <= max_registers):
+                    group.append(register)
+                    continue
+            groups.append([register])
+        #------------------------------------------------------------------------------
+
+        return [self._buildRead(group) for group in groups]
+
+    def _buildRead(self, group):
+        # Precomputes the decode runs so that decodeRead() only has to slice and decode
+        start = group[0].address
+        end = group[-1].address + registerCount(group[-1].data_type) - 1
+
+        runs = []
+        for register in group:
+            offset = register.address - start
+            size = registerCount(register.data_type)
+            if runs:
+                last = runs[-1]
+                if (last.data_type == register.data_type and last.scale == register.scale
+                        and last.offset + last.register_count == offset):
+                    runs[-1] = last._replace(register_count=last.register_count + size,
+                                             names=last.names + (register.name,))
+                    continue
+            runs.append(DecodeRun(offset, size, register.data_type, register.scale, (register.name,)))
+
+        return ReadRequest(group[0].block, start, end, tuple(runs))
+
+    def decodeRead(self, read_request, response):
+        # Decodes the response of one ReadRequest into a {name: value} dictionary. Raises
+        #...ValueError if the response doesn't hold the registers that were asked for.
+        expected = read_request.end_register - read_request.start_register + 1
+        if len(response) != expected:
+            raise ValueError('Expected {} registers from {}, got {}'.format(expected, read_request.start_register, len(response)))
+        values = {}
+        for run in read_request.runs:
+            decoded = decodeRegisters(response[run.offset:run.offset + run.register_count],
+                                      run.data_type, scale=run.scale)
+            values.update(zip(run.names, decoded.tolist()))
+        return values
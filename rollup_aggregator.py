@@ -0,0 +1,160 @@
+"""
+--------------------------------------------------------------------------------------
+ORCA Rollup Aggregator
+
+Keeps running per-minute, per-15-minute and per-hour statistics of every reading while
+the samples come in, so nobody has to re-read a whole day of raw data with pandas to get
+them. One MeterRollup per meter, fed every decoded row:
+
+- For each interval it keeps the sample count and, per reading, the min, max, sum (for
+  the mean) and last value, as rows of NumPy arrays, so a sample costs a handful of
+  vectorized updates whatever the number of intervals.
+- Instantaneous power readings (Watts, VARs and VAs, total or per phase) are also
+  integrated over time (trapezoidal rule) into Wh, VARh and VAh for each interval. Gaps
+  longer than 'max_gap' seconds (the meter was down) are not integrated across.
+- When a sample falls into a new interval, the finished one comes out as a row. An
+  interval whose meter has stopped answering is finished by expire() instead.
+
+Intervals are aligned to the Unix epoch, which is on the local hour for every whole-hour
+time zone. Each interval is written as its own stream, e.g. 'Galena_1_rollup_15min',
+with one row per interval:
+
+    timestamp (start of the interval), samples,
+    <reading> min, <reading> max, <reading> mean, <reading> last, ...,
+    <power reading> Wh / VARh / VAh, ...
+--------------------------------------------------------------------------------------
+"""
+
+import numpy as np
+
+
+STATISTICS = ('min', 'max', 'mean', 'last')
+
+# Power reading prefix -> unit of its integral. Only the instantaneous readings, not the
+#...averages, minimums and maximums from the other blocks.
+ENERGY_UNITS = {'Watts': 'Wh', 'VARs': 'VARh', 'VAs': 'VAh'}
+ENERGY_PHASES = ('3-Ph total', 'Phase A', 'Phase B', 'Phase C')
+
+
+def energyUnit(name):
+    # Unit of the integral of a reading, or None if it isn't an instantaneous power reading
+    prefix, _, phase = name.partition(' ')
+    if prefix in ENERGY_UNITS and phase in ENERGY_PHASES:
+        return ENERGY_UNITS[prefix]
+    return None
+
+
+def intervalLabel(interval):
+    # 60 -> '1min', 900 -> '15min', 3600 -> '1h'
+    if interval % 3600 == 0:
+        return '{}h'.format(interval // 3600)
+    if interval % 60 == 0:
+        return '{}min'.format(interval // 60)
+    return '{}s'.format(interval)
+
+
+class MeterRollup:
+
+    # 'names' are the meter's readings in row order (after the timestamp)
+
+    def __init__(self, meter_name, names, intervals=(60, 900, 3600), max_gap=60, decimal_places=3):
+        if not intervals or any(not isinstance(interval, int) or interval <= 0 for interval in intervals):
+            raise ValueError('Rollup intervals must be whole numbers of seconds, got {}'.format(intervals))
+
+        self.meter_name = meter_name
+        self.names = list(names)
+        self.intervals = sorted(set(intervals))
+        self.max_gap = max_gap
+        self.decimal_places = decimal_places
+
+        self.energy_names = [(name, energyUnit(name)) for name in self.names if energyUnit(name)]
+        self._energy_index = np.array([self.names.index(name) for name, unit in self.energy_names], dtype=np.intp)
+
+        # One row per interval, one column per reading
+        shape = (len(self.intervals), len(self.names))
+        self._bucket_start = [None] * len(self.intervals)     # Start of the interval being accumulated
+        self._count = np.zeros(len(self.intervals), dtype=np.int64)
+        self._min = np.full(shape, np.inf)
+        self._max = np.full(shape, -np.inf)
+        self._sum = np.zeros(shape)
+        self._last = np.zeros(shape)
+        self._energy = np.zeros((len(self.intervals), len(self.energy_names)))
+
+        self._previous = None     # (timestamp, power readings) of the last sample, for the integration
+
+    def streamName(self, interval):
+        return '{}_rollup_{}'.format(self.meter_name, intervalLabel(interval))
+
+    def streams(self):
+        # Stream name of every interval, in the same order as self.intervals
+        return [self.streamName(interval) for interval in self.intervals]
+
+    def columns(self):
+        return (['timestamp', 'samples']
+                + ['{} {}'.format(name, statistic) for name in self.names for statistic in STATISTICS]
+                + ['{} {}'.format(name, unit) for name, unit in self.energy_names])
+
+    def _reset(self, index, start):
+        self._bucket_start[index] = start
+        self._count[index] = 0
+        self._min[index] = np.inf
+        self._max[index] = -np.inf
+        self._sum[index] = 0.0
+        self._energy[index] = 0.0
+
+    def _finish(self, index):
+        # Returns (stream name, row, timestamp) for the interval and forgets it
+        count = int(self._count[index])
+        statistics = np.column_stack((self._min[index], self._max[index], self._sum[index] / count, self._last[index]))
+        values = np.round(np.concatenate((statistics.ravel(), self._energy[index])), self.decimal_places)
+        start = self._bucket_start[index]
+        self._bucket_start[index] = None
+        return self.streamName(self.intervals[index]), [start, count] + values.tolist(), start
+
+    def update(self, row, timestamp):
+
+        # Adds one sample (a full row, timestamp first). Returns the (stream name, row, timestamp)
+        #...of every interval this sample finished, usually none.
+
+        values = np.asarray(row[1:], dtype=float)
+        power = values[self._energy_index]
+
+        # Energy per second over the stretch since the last sample, if it's short enough to trust
+        segment = None
+        if self._previous is not None:
+            previous_timestamp, previous_power = self._previous
+            if 0 < timestamp - previous_timestamp <= self.max_gap:
+                segment = previous_timestamp, (previous_power + power) / 2 / 3600
+        self._previous = timestamp, power
+
+        finished = []
+        for index, interval in enumerate(self.intervals):
+            start = timestamp - timestamp % interval
+            bucket_start = self._bucket_start[index]
+            if bucket_start != start:
+                if bucket_start is not None:
+                    if segment is not None and segment[0] < start:     # The part of the stretch before the boundary
+                        self._energy[index] += segment[1] * (start - max(segment[0], bucket_start))
+                    finished.append(self._finish(index))
+                self._reset(index, start)
+            if segment is not None:
+                self._energy[index] += segment[1] * (timestamp - max(segment[0], start))
+
+        # The same sample goes into every interval at once
+        np.minimum(self._min, values, out=self._min)
+        np.maximum(self._max, values, out=self._max)
+        self._sum += values
+        self._last[:] = values
+        self._count += 1
+
+        return finished
+
+    def expire(self, now):
+        # Finishes the intervals that ended more than 'max_gap' seconds ago without a newer
+        #...sample coming in (the meter is down). Called once per tick.
+        finished = []
+        for index, interval in enumerate(self.intervals):
+            bucket_start = self._bucket_start[index]
+            if bucket_start is not None and now >= bucket_start + interval + self.max_gap:
+                finished.append(self._finish(index))
+        return finished
@@ -0,0 +1,195 @@
+"""
+--------------------------------------------------------------------------------------
+ORCA Runtime Metrics
+
+In-process counters, gauges and latency histograms for every meter, published in the
+Prometheus text format so a slow meter or an overloaded Pi shows up before samples
+start getting lost. Two ways to get at them, both optional:
+
+- A text file that is rewritten (atomically) every tick, for node_exporter's textfile
+  collector or just 'cat'. Best kept on a RAM disk such as /run or /dev/shm.
+- A small HTTP endpoint on localhost ('http://127.0.0.1:<port>/metrics'), rendered
+  fresh on every request.
+
+Metrics are identified by name plus labels (e.g. meter='Galena_1'). Every metric has to
+be listed in METRICS below, with its type and help text. No third-party client library
+is needed.
+
+With several worker processes (see sharded_acquisition.py) each worker keeps its own
+RuntimeMetrics and sends snapshot() to the supervising process, which merge()s them.
+Each meter is only ever polled by one worker, so the series never overlap.
+--------------------------------------------------------------------------------------
+"""
+
+import bisect
+import http.server
+import os
+import threading
+
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+# Upper bounds (in seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name -> (type, help text)
+METRICS = {
+    'orca_connect_seconds': (HISTOGRAM, 'Time taken to open a Modbus TCP connection'),
+    'orca_connect_failures_total': (COUNTER, 'Modbus TCP connections that could not be opened'),
+    'orca_reconnects_total': (COUNTER, 'Modbus TCP connections that were re-opened after being dropped'),
+    'orca_modbus_round_trip_seconds': (HISTOGRAM, 'Time taken by one Modbus read, including any reconnect'),
+    'orca_decode_seconds': (HISTOGRAM, 'Time taken to decode one poll of a meter'),
+    'orca_write_seconds': (HISTOGRAM, 'Time taken to hand one row to the data writers or write-behind buffer'),
+    'orca_polls_total': (COUNTER, 'Successful polls of a meter'),
+    'orca_empty_responses_total': (COUNTER, 'Modbus reads that returned no data'),
+    'orca_decode_errors_total': (COUNTER, 'Polls of a meter whose reply could not be decoded'),
+    'orca_suppressed_rows_total': (COUNTER, 'Rows not written because no value moved beyond its deadband'),
+    'orca_carried_forward_values_total': (COUNTER, 'Values left blank in a written row because they stayed within their deadband'),
+    'orca_tick_overruns_total': (COUNTER, 'Passes that were still running when the next deadline came up'),
+    'orca_missed_ticks_total': (COUNTER, 'Deadlines that were skipped entirely'),
+    'orca_meter_up': (GAUGE, '1 if the meter answered its last poll, 0 while it is degraded, backing off or down'),
+    'orca_last_poll_timestamp_seconds': (GAUGE, 'Unix time of the last successful poll of a meter'),
+    'orca_tick_seconds': (HISTOGRAM, 'Time taken by one pass of the acquisition loop'),
+}
+
+
+class Histogram:
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)     # One per bucket, plus the +Inf bucket
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def copy(self):
+        histogram = Histogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.sum, histogram.count = self.sum, self.count
+        return histogram
+
+
+def _formatLabels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = ['{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for key, value in pairs]
+    return '{' + ','.join(escaped) + '}'
+
+
+def _formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class RuntimeMetrics:
+
+    def __init__(self):
+        self._series = {}     # (name, ((label, value), ...)) -> number or Histogram
+        self._lock = threading.Lock()
+        self._server = None
+
+    def _key(self, name, labels):
+        if name not in METRICS:
+            raise KeyError('Unknown metric: {}'.format(name))
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def observe(self, name, value, **labels):
+        # Adds one observation (in seconds) to a histogram
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._series.get(key)
+            if histogram is None:
+                histogram = self._series[key] = Histogram()
+            histogram.observe(value)
+
+    def increment(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        # Sets a gauge (counters only ever go up, with increment())
+        key = self._key(name, labels)
+        with self._lock:
+            self._series[key] = value
+
+    def snapshot(self):
+        # A copy of every series, safe to pickle and hand to another process
+        with self._lock:
+            return {key: value.copy() if isinstance(value, Histogram) else value
+                    for key, value in self._series.items()}
+
+    def merge(self, snapshot):
+        # Takes over the series of another process's snapshot()
+        with self._lock:
+            self._series.update(snapshot)
+
+    def render(self):
+        # Everything in the Prometheus text exposition format
+        series = self.snapshot()
+        lines = []
+        for name in sorted(set(key[0] for key in series)):
+            metric_type, help_text = METRICS[name]
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+
+            for (_, labels), value in sorted(((key, value) for key, value in series.items() if key[0] == name),
+                                             key=lambda item: item[0]):
+                if metric_type != HISTOGRAM:
+                    lines.append('{}{} {}'.format(name, _formatLabels(labels), _formatValue(value)))
+                    continue
+                cumulative = 0
+                for bound, count in zip(value.buckets + (float('inf'),), value.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(name, _formatLabels(labels, [('le', _formatValue(bound))]),
+                                                         cumulative))
+                lines.append('{}_sum{} {}'.format(name, _formatLabels(labels), repr(value.sum)))
+                lines.append('{}_count{} {}'.format(name, _formatLabels(labels), value.count))
+
+        return '\n'.join(lines) + '\n'
+
+    def writeTextFile(self, path):
+        # Written to a temporary file and renamed, so a reader never sees half a file
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'w') as metrics_file:
+            metrics_file.write(self.render())
+        os.replace(temporary_path, path)
+
+    def serve(self, port, host='127.0.0.1'):
+        # Serves the metrics at http://<host>:<port>/metrics from a background thread
+        metrics = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass     # Keeping scrapes out of the logs
+
+        self._server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='orca-metrics', daemon=True).start()
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
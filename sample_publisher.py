@@ -0,0 +1,437 @@
+"""
+--------------------------------------------------------------------------------------
+ORCA Sample Publisher
+
+Pushes every row the logger writes (each meter's samples, its other polling rates and
+its rollups) to live subscribers as soon as it is acquired, so nothing has to tail the
+.csv files. Nothing is read back from disk.
+
+- UNIX domain socket (PUBLISH_SOCKET): every connection is one subscriber. It first sends
+  one line of JSON saying what it wants, e.g.
+
+      {"meters": ["Galena_1"], "columns": ["Volts A-N", "Watts 3-Ph total"], "format": "json"}
+
+  (leave 'meters' or 'columns' out, or empty, for all of them) and then receives the
+  samples of those meters, with only those columns.
+- UDP multicast (PUBLISH_MULTICAST): every sample goes to the group in PUBLISH_FORMAT,
+  with every column, to any number of listeners on the local network (TTL 1).
+  Subscribers filter for themselves.
+
+Two formats:
+
+- 'json': one line per sample, {"meter": ..., "stream": ..., "timestamp": ...,
+  "values": {column: value}}. 'stream' is the meter name, or e.g. 'Galena_1_15min' or
+  'Galena_1_rollup_1min' for its other rates and rollups.
+- 'binary': a 3-byte header per message (kind, body length as '<BH'). A SCHEMA message
+  ('<H' schema ID, then JSON with 'meter', 'stream' and 'columns') is sent before the
+  first sample of each stream and column set, and again every second over
+  multicast. A SAMPLE message is '<Hd' (schema ID, timestamp) followed by one '<d' per
+  column, NaN for a missing value. About a third of the size of the JSON.
+
+The poll loop only appends each row to an in-memory queue. A background thread does all
+the encoding and sending, on non-blocking sockets, and every subscriber has its own
+backlog limit: a subscriber that falls behind loses samples, and a queue that fills up
+drops its oldest samples, but neither ever holds up the polling. With REPORT_BY_EXCEPTION
+on, the blank values are filled in with the last value published.
+
+subscribe() reads either kind of stream, and so does this file from the command line:
+
+    python sample_publisher.py --socket /run/orca.sock --meter Galena_1 --column 'Volts A-N'
+--------------------------------------------------------------------------------------
+"""
+
+import argparse
+import collections
+import json
+import math
+import os
+import selectors
+import socket
+import struct
+import threading
+import time
+
+
+JSON = 'json'
+BINARY = 'binary'
+FORMATS = (JSON, BINARY)
+
+SCHEMA = 1
+SAMPLE = 2
+
+SCHEMA_INTERVAL = 1.0     # Seconds between repeats of the binary schemas over multicast, for late joiners
+
+_FRAME = struct.Struct('<BH')            # Message kind, body length
+_SAMPLE_HEADER = struct.Struct('<Hd')    # Schema ID, timestamp
+_SCHEMA_HEADER = struct.Struct('<H')     # Schema ID
+
+
+def _message(kind, body):
+    return _FRAME.pack(kind, len(body)) + body
+
+
+class _Subscriber:
+
+    # One UNIX socket connection. Nothing is sent until its subscription line has come in.
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.request = b''          # The subscription line, as far as it has been received
+        self.subscribed = False
+        self.meters = set()         # Empty for all
+        self.columns = set()        # Empty for all
+        self.format = JSON
+        self.backlog = bytearray()  # Encoded messages not yet taken by the socket
+        self.schemas = set()        # Binary schema IDs already sent to it
+        self.dropped = 0
+
+
+class SamplePublisher:
+
+    def __init__(self, socket_path=None, multicast=None, multicast_format=JSON, capacity=10000,
+                 max_backlog=1024 * 1024, logger=None):
+
+        # 'multicast' is a (group, port) tuple, e.g. ('239.255.0.1', 5021). 'capacity' is the
+        #...number of rows the queue holds, 'max_backlog' the bytes a slow subscriber may fall behind.
+
+        if socket_path is None and multicast is None:
+            raise ValueError('The publisher needs a socket path, a multicast group or both')
+        if multicast_format not in FORMATS:
+            raise ValueError("The publishing format must be 'json' or 'binary', got {}".format(multicast_format))
+
+        self.socket_path = socket_path
+        self.multicast = tuple(multicast) if multicast is not None else None
+        self.multicast_format = multicast_format
+        self.max_backlog = max_backlog
+        self.logger = logger
+        self.dropped = 0     # Rows dropped because the queue was full
+
+        self._samples = collections.deque(maxlen=capacity)
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._streams = {}       # Stream name -> (meter name, columns after the timestamp)
+        self._last_rows = {}     # Stream name -> the last row published, to fill in blanks
+        self._schemas = {}       # (stream, columns) -> binary schema ID
+        self._indexes = {}       # (stream, columns) -> where those columns are in the stream's rows
+        self._schema_sent = {}   # Schema ID -> time.monotonic() it was last sent over multicast
+        self._subscribers = []
+        self._selector = None
+        self._listener = None
+        self._multicast_socket = None
+
+    def setStreams(self, streams):
+        # {stream name: (meter name, columns after the timestamp)} of every stream published.
+        #...Called again whenever the meters change.
+        streams = {stream_name: (meter_name, tuple(columns)) for stream_name, (meter_name, columns) in streams.items()}
+        for stream_name, stream in streams.items():
+            if self._streams.get(stream_name) != stream:
+                self._last_rows.pop(stream_name, None)
+        self._streams = streams
+
+    def publish(self, stream_name, row, timestamp):
+        # Queues one row (timestamp first, as written to the data files). Never blocks.
+        if len(self._samples) == self._samples.maxlen:
+            self.dropped += 1     # (The oldest row makes way)
+        self._samples.append((stream_name, row, timestamp))
+        self._wake.set()
+
+    def start(self):
+        # Raises OSError if the socket can't be opened
+        self._selector = selectors.DefaultSelector()
+        if self.socket_path is not None:
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)     # Left over from a run that didn't exit cleanly
+            self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._listener.bind(self.socket_path)
+            self._listener.listen(16)
+            self._listener.setblocking(False)
+            self._selector.register(self._listener, selectors.EVENT_READ)
+        if self.multicast is not None:
+            self._multicast_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._multicast_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)     # Local network only
+            self._multicast_socket.setblocking(False)
+        self._thread = threading.Thread(target=self._run, name='orca-publisher', daemon=True)
+        self._thread.start()
+
+    def close(self, timeout=5.0):
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        for subscriber in self._subscribers:
+            subscriber.connection.close()
+        self._subscribers = []
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+        if self._multicast_socket is not None:
+            self._multicast_socket.close()
+            self._multicast_socket = None
+        if self._selector is not None:
+            self._selector.close()
+            self._selector = None
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wake.wait(0.1)
+            self._wake.clear()
+            try:
+                self._serviceSockets()
+                while self._samples:
+                    self._send(*self._samples.popleft())
+                self._flushBacklogs()
+            except Exception:
+                if self.logger is not None:
+                    self.logger.error('Error while publishing samples', exc_info=True)
+
+    # Subscribers
+    #---------------------------------------------------------------------------------
+    def _serviceSockets(self):
+        # Accepts new subscribers, reads their subscription lines and notices the ones that left
+        for key, events in self._selector.select(0):
+            if key.fileobj is self._listener:
+                try:
+                    while True:
+                        connection, address = self._listener.accept()
+                        connection.setblocking(False)
+                        subscriber = _Subscriber(connection)
+                        self._subscribers.append(subscriber)
+                        self._selector.register(connection, selectors.EVENT_READ, subscriber)
+                except BlockingIOError:
+                    pass
+                continue
+
+            subscriber = key.data
+            try:
+                data = subscriber.connection.recv(4096)
+            except BlockingIOError:
+                continue
+            except OSError:
+                data = b''
+            if not data:
+                self._dropSubscriber(subscriber)
+            elif not subscriber.subscribed:
+                subscriber.request += data
+                if b'\n' in subscriber.request:
+                    self._subscribe(subscriber, subscriber.request.split(b'\n', 1)[0])
+                elif len(subscriber.request) > 65536:
+                    self._dropSubscriber(subscriber)
+
+    def _subscribe(self, subscriber, line):
+        try:
+            request = json.loads(line.decode('utf-8')) if line.strip() else {}
+            subscriber.meters = set(request.get('meters') or ())
+            subscriber.columns = set(request.get('columns') or ())
+            subscriber.format = request.get('format', JSON)
+            if subscriber.format not in FORMATS:
+                raise ValueError('Unknown format {}'.format(subscriber.format))
+        except (ValueError, AttributeError, TypeError):
+            if self.logger is not None:
+                self.logger.warning('Dropping a subscriber with an invalid subscription: {!r}'.format(line[:200]))
+            self._dropSubscriber(subscriber)
+            return
+        subscriber.subscribed = True
+
+    def _dropSubscriber(self, subscriber):
+        self._selector.unregister(subscriber.connection)
+        subscriber.connection.close()
+        self._subscribers.remove(subscriber)
+
+    def _queue(self, subscriber, data):
+        # Adds a message to a subscriber's backlog, unless it has fallen too far behind
+        if len(subscriber.backlog) + len(data) > self.max_backlog:
+            subscriber.dropped += 1
+            return False
+        subscriber.backlog += data
+        return True
+
+    def _flushBacklogs(self):
+        for subscriber in list(self._subscribers):
+            if not subscriber.backlog:
+                continue
+            try:
+                sent = subscriber.connection.send(subscriber.backlog)
+            except BlockingIOError:
+                continue     # Its socket buffer is full, the rest waits for the next round
+            except OSError:
+                self._dropSubscriber(subscriber)
+                continue
+            del subscriber.backlog[:sent]
+    #---------------------------------------------------------------------------------
+
+    # Encoding
+    #---------------------------------------------------------------------------------
+    def _schemaId(self, stream_name, columns):
+        key = (stream_name, columns)
+        schema_id = self._schemas.get(key)
+        if schema_id is None:
+            schema_id = self._schemas[key] = len(self._schemas) & 0xFFFF
+        return schema_id
+
+    def _schemaMessage(self, schema_id, meter_name, stream_name, columns):
+        body = json.dumps({'meter': meter_name, 'stream': stream_name, 'columns': list(columns)}).encode('utf-8')
+        return _message(SCHEMA, _SCHEMA_HEADER.pack(schema_id) + body)
+
+    def _send(self, stream_name, row, timestamp):
+        stream = self._streams.get(stream_name)
+        if stream is None:
+            return
+        meter_name, columns = stream
+
+        if None in row:     # Blanks left by report by exception
+            last_row = self._last_rows.get(stream_name)
+            if last_row is not None:
+                row = [last_row[index] if value is None else value for index, value in enumerate(row)]
+        self._last_rows[stream_name] = row
+        values = row[1:]
+
+        encoded = {}     # (format, columns) -> message, shared by subscribers asking for the same thing
+
+        def encode(message_format, selected):
+            key = (message_format, selected)
+            if key not in encoded:
+                indexes = self._indexes.get((stream_name, selected))
+                if indexes is None:
+                    indexes = self._indexes[(stream_name, selected)] = [columns.index(name) for name in selected]
+                if message_format == JSON:
+                    encoded[key] = (json.dumps({'meter': meter_name, 'stream': stream_name, 'timestamp': timestamp,
+                                                'values': {name: values[index] for name, index in zip(selected, indexes)}},
+                                               separators=(',', ':')) + '\n').encode('utf-8')
+                else:
+                    sample = [math.nan if values[index] is None else values[index] for index in indexes]
+                    encoded[key] = _message(SAMPLE, _SAMPLE_HEADER.pack(self._schemaId(stream_name, selected), timestamp)
+                                            + struct.pack('<{}d'.format(len(sample)), *sample))
+            return encoded[key]
+
+        for subscriber in self._subscribers:
+            if not subscriber.subscribed or (subscriber.meters and meter_name not in subscriber.meters):
+                continue
+            selected = columns
+            if subscriber.columns:
+                selected = tuple(name for name in columns if name in subscriber.columns)
+                if not selected:
+                    continue     # None of the columns it asked for are in this stream
+            if subscriber.format == BINARY:
+                schema_id = self._schemaId(stream_name, selected)
+                if schema_id not in subscriber.schemas:
+                    if not self._queue(subscriber, self._schemaMessage(schema_id, meter_name, stream_name, selected)):
+                        continue
+                    subscriber.schemas.add(schema_id)
+            self._queue(subscriber, encode(subscriber.format, selected))
+
+        if self._multicast_socket is not None:
+            messages = []
+            if self.multicast_format == BINARY:
+                schema_id = self._schemaId(stream_name, columns)
+                if time.monotonic() - self._schema_sent.get(schema_id, -SCHEMA_INTERVAL) >= SCHEMA_INTERVAL:
+                    messages.append(self._schemaMessage(schema_id, meter_name, stream_name, columns))
+                    self._schema_sent[schema_id] = time.monotonic()
+            messages.append(encode(self.multicast_format, columns))
+            for message in messages:
+                try:
+                    self._multicast_socket.sendto(message, self.multicast)
+                except OSError:
+                    self.dropped += 1     # E.g. the socket buffer is full or the network is down
+    #---------------------------------------------------------------------------------
+
+
+def _decode(data, message_format, schemas):
+    # Returns ([(meter, stream, timestamp, {column: value})], bytes used) for the complete
+    #...messages at the start of 'data'. 'schemas' collects the binary schemas seen so far.
+    samples = []
+    position = 0
+    if message_format == JSON:
+        end = data.find(b'\n')
+        while end >= 0:
+            message = json.loads(data[position:end].decode('utf-8'))
+            samples.append((message['meter'], message['stream'], message['timestamp'], message['values']))
+            position = end + 1
+            end = data.find(b'\n', position)
+        return samples, position
+
+    while len(data) - position >= _FRAME.size:
+        kind, length = _FRAME.unpack_from(data, position)
+        end = position + _FRAME.size + length
+        if end > len(data):
+            break
+        body = data[position + _FRAME.size:end]
+        position = end
+        if kind == SCHEMA:
+            schemas[_SCHEMA_HEADER.unpack_from(body)[0]] = json.loads(body[_SCHEMA_HEADER.size:].decode('utf-8'))
+        elif kind == SAMPLE:
+            schema_id, timestamp = _SAMPLE_HEADER.unpack_from(body)
+            schema = schemas.get(schema_id)
+            if schema is None:
+                continue     # Joined a multicast stream before its schema came round again
+            values = struct.unpack_from('<{}d'.format(len(schema['columns'])), body, _SAMPLE_HEADER.size)
+            samples.append((schema['meter'], schema['stream'], timestamp, dict(zip(schema['columns'], values))))
+    return samples, position
+
+
+def subscribe(socket_path=None, multicast=None, meters=(), columns=(), message_format=JSON):
+
+    # Yields (meter, stream, timestamp, {column: value}) for every sample published, from the
+    #...publisher's UNIX socket or from its multicast group ('message_format' must then be the
+    #...publisher's PUBLISH_FORMAT). 'meters' and 'columns' narrow it down.
+
+    if socket_path is not None:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(socket_path)
+        connection.sendall((json.dumps({'meters': list(meters), 'columns': list(columns),
+                                        'format': message_format}) + '\n').encode('utf-8'))
+    else:
+        connection = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        connection.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        connection.bind(('', multicast[1]))
+        connection.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                              socket.inet_aton(multicast[0]) + socket.inet_aton('0.0.0.0'))
+
+    schemas = {}
+    data = b''
+    try:
+        while True:
+            received = connection.recv(65536)
+            if not received:
+                return     # The publisher closed the socket
+            data += received
+            samples, used = _decode(data, message_format, schemas)
+            data = data[used:] if socket_path is not None else b''     # (Every datagram is complete on its own)
+
+            for meter_name, stream_name, timestamp, values in samples:
+                if meters and meter_name not in meters:
+                    continue
+                if columns:
+                    values = {name: value for name, value in values.items() if name in columns}
+                    if not values:
+                        continue
+                yield meter_name, stream_name, timestamp, values
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print the samples published by ORCA as JSON lines')
+    parser.add_argument('--socket', help='PUBLISH_SOCKET of the logger, e.g. /run/orca.sock')
+    parser.add_argument('--multicast', metavar='GROUP:PORT', help='PUBLISH_MULTICAST of the logger, e.g. 239.255.0.1:5021')
+    parser.add_argument('--format', default=JSON, choices=FORMATS, help='Message format (for multicast: PUBLISH_FORMAT)')
+    parser.add_argument('--meter', action='append', default=[], help='Only this meter (may be given more than once)')
+    parser.add_argument('--column', action='append', default=[], help='Only this column (may be given more than once)')
+    arguments = parser.parse_args()
+    if (arguments.socket is None) == (arguments.multicast is None):
+        parser.error('give either --socket or --multicast')
+
+    group = None
+    if arguments.multicast is not None:
+        host, port = arguments.multicast.rsplit(':', 1)
+        group = (host, int(port))
+    try:
+        for meter_name, stream_name, timestamp, values in subscribe(arguments.socket, group, arguments.meter,
+                                                                    arguments.column, arguments.format):
+            print(json.dumps({'meter': meter_name, 'stream': stream_name, 'timestamp': timestamp, 'values': values}),
+                  flush=True)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,182 @@
+"""
+--------------------------------------------------------------------------------------
+ORCA Sharded Acquisition
+
+For sites with hundreds of meters, the meter list is split across several worker
+processes so the polling and decoding can use every core:
+
+- shardMeters() groups the meters by host and port first, so meters behind the same gateway
+  always end up in the same worker (and keep sharing one connection), then spreads
+  those groups over the workers so each gets about the same number of meters.
+- WorkerSupervisor starts one process per shard. Each worker runs its own polling loop
+  and sends its samples back over a multiprocessing queue to the supervising process,
+  which does all the writing (one shared output stage).
+- Every worker updates a heartbeat once per pass of its loop. A worker that dies, or
+  whose heartbeat goes stale, is stopped and restarted on its own without touching
+  the other workers.
+- Workers are asked to stop through a StopFlag first, so they finish what they are doing
+  (a process killed halfway through putting a sample on the queue can leave the queue
+  unusable). Only one that hasn't stopped after 'stop_timeout' seconds is terminated.
+--------------------------------------------------------------------------------------
+"""
+
+import collections
+import multiprocessing
+import queue
+import time
+
+
+def shardMeters(settings, worker_count):
+
+    # Returns a list of shards, each a list of meter tuples from 'settings'. Never returns
+    #...more shards than there are distinct hosts (gateways), or any empty ones.
+
+    hosts = collections.OrderedDict()     # (host, port) -> meters, in the order they appear in the settings
+    for meter in settings:
+        hosts.setdefault((meter[1], meter[2]), []).append(meter)
+
+    worker_count = max(1, min(worker_count, len(hosts)))
+    shards = [[] for _ in range(worker_count)]
+
+    # Biggest gateways first, each into the shard that currently has the fewest meters
+    for meters in sorted(hosts.values(), key=len, reverse=True):
+        min(shards, key=len).extend(meters)
+
+    return [shard for shard in shards if shard]
+
+
+class StopFlag:
+
+    # Like a multiprocessing.Event (is_set(), wait() and set()), but on a pipe: set() never
+    #...waits for the processes that wait on it, so a worker that died while waiting can't hang
+    #...the supervisor, and it is safe to call from a signal handler.
+
+    def __init__(self):
+        self._reader, self._writer = multiprocessing.Pipe(duplex=False)
+
+    def set(self):
+        if not self._reader.poll():
+            self._writer.send_bytes(b'')
+
+    def is_set(self):
+        return self._reader.poll()
+
+    def wait(self, timeout=None):
+        return self._reader.poll(timeout)
+
+    def close(self):
+        self._reader.close()
+        self._writer.close()
+
+
+class Worker:
+
+    def __init__(self, number, shard):
+        self.number = number
+        self.shard = shard
+        self.process = None
+        self.heartbeat = None     # multiprocessing.Value holding the time.monotonic() of the worker's last pass
+        self.stopping = None      # StopFlag asking the worker to stop
+        self.started_at = 0.0
+        self.restarts = 0
+
+    @property
+    def meter_names(self):
+        return [meter[0] for meter in self.shard]
+
+
+class WorkerSupervisor:
+
+    def __init__(self, shards, worker_function, heartbeat_timeout=60.0, restart_delay=10.0, stop_timeout=10.0,
+                 logger=None):
+
+        # 'worker_function(shard, sample_queue, heartbeat, stopping)' is run in each worker
+        #...process. It must put (meter_name, row, timestamp) tuples on 'sample_queue', set
+        #...'heartbeat.value = time.monotonic()' once per pass of its loop (the monotonic clock is
+        #...the same in every process), and return soon after the 'stopping' StopFlag is set.
+
+        self.worker_function = worker_function
+        self.heartbeat_timeout = heartbeat_timeout
+        self.restart_delay = restart_delay     # Minimum seconds between two starts of the same worker
+        self.stop_timeout = stop_timeout       # Seconds a worker gets to stop by itself before it is terminated
+        self.logger = logger
+
+        self.sample_queue = multiprocessing.Queue()
+        self.workers = [Worker(number, shard) for number, shard in enumerate(shards)]
+
+    def _startWorker(self, worker):
+        worker.heartbeat = multiprocessing.Value('d', time.monotonic(), lock=False)
+        worker.stopping = StopFlag()
+        worker.process = multiprocessing.Process(target=self.worker_function,
+                                                 args=(worker.shard, self.sample_queue, worker.heartbeat,
+                                                       worker.stopping),
+                                                 name='orca-worker-{}'.format(worker.number),
+                                                 daemon=True)
+        worker.process.start()
+        worker.started_at = time.monotonic()
+
+        if self.logger is not None:
+            self.logger.info('Started worker {} (pid {}) for {}'.format(worker.number, worker.process.pid,
+                                                                       ', '.join(worker.meter_names)))
+
+    def _stopWorker(self, worker):
+        if worker.process is None:
+            return
+        worker.stopping.set()
+        worker.process.join(self.stop_timeout)
+        if worker.process.is_alive():
+            if self.logger is not None:
+                self.logger.warning('Worker {} did not stop within {} s, terminating it'.format(worker.number,
+                                                                                                self.stop_timeout))
+            worker.process.terminate()
+            worker.process.join(5)
+            if worker.process.is_alive():
+                worker.process.kill()
+                worker.process.join()
+        worker.stopping.close()
+        worker.process = None
+
+    def start(self):
+        for worker in self.workers:
+            self._startWorker(worker)
+
+    def collectSamples(self, timeout=1.0, max_samples=10000):
+        # Waits up to 'timeout' seconds for the first sample, then returns everything that is
+        #...already waiting (up to 'max_samples') without blocking any further.
+        samples = []
+        try:
+            samples.append(self.sample_queue.get(timeout=timeout))
+            while len(samples) < max_samples:
+                samples.append(self.sample_queue.get_nowait())
+        except queue.Empty:
+            pass
+        return samples
+
+    def checkWorkers(self):
+        # Restarts any worker that has exited or stopped updating its heartbeat
+        for worker in self.workers:
+            if worker.process is not None:
+                if worker.process.is_alive():
+                    stale = time.monotonic() - worker.heartbeat.value
+                    if stale < self.heartbeat_timeout:
+                        continue
+                    problem = 'has not finished a pass in {:.0f} s (hung)'.format(stale)
+                else:
+                    problem = 'exited with code {}'.format(worker.process.exitcode)
+
+                if self.logger is not None:
+                    self.logger.error('Worker {} ({}) {}. Restarting it'.format(worker.number,
+                                                                                ', '.join(worker.meter_names), problem))
+                self._stopWorker(worker)
+
+            # A worker that keeps crashing right away is only restarted every 'restart_delay' seconds
+            if time.monotonic() - worker.started_at >= self.restart_delay:
+                worker.restarts += 1
+                self._startWorker(worker)
+
+    def stop(self):
+        for worker in self.workers:     # All of them are asked first, so they stop at the same time
+            if worker.process is not None:
+                worker.stopping.set()
+        for worker in self.workers:
+            self._stopWorker(worker)
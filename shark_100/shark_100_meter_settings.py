@@ -19,18 +19,106 @@ be entered in manually:
 
  - PORT: The port the specific device is using for Modbus communication. Usually 502 or 503.
 
- - TIMESTEP: Here you can choose the interval between data measurements (in seconds). You unfortunately you must choose the same timestep for each meter.
+ - UNIT ID: Optional, and not shown in the example below. Only needed for a Shark 100 behind a Modbus gateway, in which
+            case it goes between NUMBER OF DECIMAL PLACES and the readings, like in the Shark 200 settings.
+
+ - TIMESTEP: Here you can choose the interval between data measurements (in seconds). It doesn't have to divide into 60 and may be
+            fractional (e.g. 0.5), in which case the timestamps keep their milliseconds.
+
+ - METER_TIMESTEPS: Optional. Gives individual meters their own timestep (in seconds), by meter name. Any meter that isn't
+            listed here uses TIMESTEP.
+
+ - BLOCK_RATES, READ_REQUEST_FILE: Optional. Readings from the slower-changing blocks of the register map (energy and
+            demand) can be read less often than TIMESTEP, so the meters and the network only carry what is
+            needed. Each block listed gets its own rate in seconds, and its readings go to their own files named after the rate,
+            e.g. '<meter>_15min_<date>.csv'. Blocks set to None are only read when the READ_REQUEST_FILE is saved: empty for
+            every meter, or with one meter name per line. Those readings go to '<meter>_on_request_<date>.csv'.
+
+ - FILE_ROTATION, FLUSH_INTERVAL, FLUSH_BYTES, FSYNC: How often new .csv files are started and how often data is written to them.
+            The defaults are fine for most sites.
+
+ - WRITE_BEHIND, BUFFER_CAPACITY, BATCH_SIZE, MAX_BATCH_DELAY: Recommended on Raspberry Pi SD cards. Samples are kept in memory
+            and written in large batches, which wears the card much less and keeps slow card writes from delaying the meter polls.
+
+ - STORAGE_BACKEND: 'csv' writes the usual .csv files. 'binary' writes much smaller fixed-width .orca files that can be loaded
+            straight into numpy, and converted to .csv with 'python binary_data_store.py <file.orca>'. 'both' writes both.
+
+ - COMPRESSION: Optional. Once a day is over its data files are compressed in the background (usually to about a tenth of their size),
+            e.g. 'Galena_1_2020_6_1.csv' becomes 'Galena_1_2020_6_1.csv.gz'. 'auto' uses zstd if the zstandard package is
+            installed and gzip otherwise. pandas, zcat and file_compressor.openData() read the compressed files directly.
+
+ - ROLLUP_INTERVALS: Optional. Alongside the raw data, files with one row per interval (e.g. a minute, 15 minutes and an
+            hour) holding the min, max, mean and last value of every reading, plus the energy (Wh, VARh, VAh) integrated from the
+            Watts, VARs and VAs readings. They are kept up to date as the samples come in and are named like
+            '<meter>_rollup_15min_<date>.csv'.
+
+ - REPORT_BY_EXCEPTION, MAX_SILENCE, DEADBANDS: Optional. Cuts the size of the data files by about ten times at sites where
+            most values barely change between samples. A value is only written when it has moved beyond its deadband in
+            DEADBANDS (by reading name, absolute or a percentage), or, for readings not listed there, when its rounded value
+            changes at all. Values that didn't move are left blank, meaning "same as above", and rows where nothing moved are
+            left out. Every file starts with a full row, and a full row is written at least every MAX_SILENCE seconds.
+            deadband_filter.fillForward() fills the blanks back in.
+
+ - WORKER_PROCESSES: Leave at 1 unless the site has hundreds of meters. Above 1, the meters are split over that many worker
+            processes (meters behind the same gateway always stay together), so polling can use every CPU core. A worker
+            that crashes or hangs is restarted on its own.
+
+ - PIPELINE_DEPTH: For gateways with many meters behind them (same HOST, different UNIT IDs). Instead of waiting for each
+            meter's reply before asking the next one, up to this many requests are sent at once on the gateway's connection,
+            so 30 meters take about one round-trip per tick instead of 30. One number for every gateway, or e.g.
+            {'192.168.1.50': 16} for just some (the others get 1). Leave it at 1 for gateways that can't queue requests.
+
+ - PROXY_PORT, PROXY_HOST, PROXY_UNIT_IDS, PROXY_MAX_AGE: Optional. Lets SCADA, HMI panels and other scripts read live values
+            from this script instead of polling the meters themselves, so the meters' few connection slots aren't fought over.
+            The script answers Modbus TCP reads on PROXY_PORT (e.g. 5020) with the registers it last read from each meter, at
+            the same addresses as on the meter, one unit ID per meter. Meters listed in PROXY_UNIT_IDS get the unit ID given
+            there, the others are numbered from 1 in the order of the 'settings' list. PROXY_HOST is '127.0.0.1' for the Pi
+            itself only, or '0.0.0.0' to let other machines on the network connect. A meter that hasn't answered for
+            PROXY_MAX_AGE seconds is reported as failed (Modbus exception 11). See modbus_proxy.py.
+
+ - PUBLISH_SOCKET, PUBLISH_MULTICAST, PUBLISH_FORMAT: Optional. Pushes every row written to the data files to programs that
+            want to react to new data right away, within milliseconds and without reading the files. PUBLISH_SOCKET is a UNIX
+            socket on the Pi (e.g. '/run/orca.sock') where each program can ask for just the meters and columns it needs.
+            PUBLISH_MULTICAST (e.g. ('239.255.0.1', 5021)) sends everything to a multicast group on the local network, in
+            PUBLISH_FORMAT: 'json' (one line per sample) or 'binary' (much smaller). A program that can't keep up misses
+            samples instead of slowing down the polling. Try it with 'python sample_publisher.py --socket /run/orca.sock'.
+
+ - BACKFILL, BACKFILL_LOG, BACKFILL_MIN_GAP, BACKFILL_MAX_AGE: Optional, for Shark 200s with logging enabled. When the
+            network or the Pi goes down, the meter keeps recording into its historical logs. With BACKFILL on, any time a
+            meter's data stops for more than BACKFILL_MIN_GAP seconds (also across a restart of this script), the missing
+            time is downloaded from historical log BACKFILL_LOG once the meter answers again, in the background. It
+            shares the meter's polling connection, taking the connection's lock for one request at a time, so the live
+            polls wait for at most one log read. With WORKER_PROCESSES above 1 the polling connections belong to the
+            workers, so the backfill opens one extra connection per meter instead: leave a free connection slot on
+            the meter (or gateway). The rows go to '<meter>_backfill_<date>.csv' with the same columns plus 'backfilled'
+            (readings the log doesn't hold are blank), at the log's own interval.
+            'python time_index.py <meter> <start> <end> --backfill' merges them with the live rows in time order.
+
+ - METRICS_FILE, METRICS_PORT: Optional. Per-meter poll latencies, failed reads, reconnects, tick overruns and write times in
+            the Prometheus text format. METRICS_FILE is rewritten every tick (put it somewhere like '/run/orca.prom', not on the
+            SD card), METRICS_PORT serves the same text at http://127.0.0.1:<port>/metrics. Both are off when set to None.
+
+ - PROFILER, PROFILE_CONTROL_FILE: For tracking down a logger that falls behind, without restarting it. 'kill -USR1 <pid>'
+            (or writing 'cpu' into the control file) starts CPU profiling, and doing it again (or removing the word) stops it
+            and writes the results to ./logs/. 'kill -USR2 <pid>' or 'memory' does the same for memory allocations. PROFILER is
+            'sampler' (low overhead, all threads) or 'cprofile' (every call of the main loop). See profiling_hooks.py.
+
+ - LOG_MAX_BYTES, LOG_BACKUPS, LOG_REPEAT_SUMMARY: The log files in ./logs are written in the background and rotated at
+            LOG_MAX_BYTES, keeping LOG_BACKUPS old copies each, so they can't fill the SD card. A message that keeps repeating
+            (e.g. while a meter is down) is written once, then as a summary with a count every LOG_REPEAT_SUMMARY seconds.
 
  - NUMBER OF DECIMAL PLACES: Here you can choose how many decimal places to round your data.
 
  - VALUES: The final item in each tuple is a list containing every value currently available for measurement. If you only want specific values,
-           please comment out any you do not wish to include.
+           please comment out any you do not wish to include. Readings from the other blocks listed in the register map at the
+           bottom of 'shark_100_readings_blocks.py' can be added by name as well. Only the registers needed for the
+           listed values are read from the meter.
     --------------------------------------------------------------------------------------
 
 
     # Instructions
     --------------------------------------------------------------------------------------
-    I. Set your timestep(in seconds). This value will be applied accross all your meters.
+    I. Set your timestep(in seconds). This value will be applied accross all your meters, except the ones listed in METER_TIMESTEPS.
 
     II. In the 'settings' list, you will find a meter called 'test_meter' already entered complete with all required paramters.
         A. Copy and paste this tuple for each meter you wish to pull data from.
@@ -46,6 +134,13 @@ be entered in manually:
     IV. Save 'shark_100_meter_settings.py'
 
     V. Close the file
+
+    VI. The script doesn't need to be restarted after changing the meters: when this file is saved, the 'settings' list,
+        METER_MODELS, TIMESTEP and METER_TIMESTEPS are reloaded within a few seconds. Only the meters that were added, changed
+        or removed are touched, the others keep polling. If the saved file has an error, it is logged in mainErrors.log and
+        the script keeps going with the meters it had. Restart the script after changing any of the other settings,
+        otherwise they only apply to the meters that were added or changed.
+        With WORKER_PROCESSES above 1 the workers are restarted to pick up the changes.
     --------------------------------------------------------------------------------------
 
 
@@ -68,6 +163,106 @@ TIMESTEP = 4
 #------------------------------------------------------
 
 
+    # Optional Per-Meter Timesteps
+#------------------------------------------------------
+METER_TIMESTEPS = {
+#    'TestMeter': 1,
+}
+#------------------------------------------------------
+
+
+    # Optional Block Rates (poll some blocks less often, each rate goes to its own files)
+#------------------------------------------------------
+BLOCK_RATES = {
+#    'energy': 60,            # Energy accumulators every minute (on a Shark 200 listed in METER_MODELS)
+#    'demand': None,          # Demand only when asked for, through the READ_REQUEST_FILE
+}
+READ_REQUEST_FILE = './logs/read_blocks'     # Save this file to read the blocks with a rate of None (see poll_plan.py)
+#------------------------------------------------------
+
+
+    # Data File Settings
+#------------------------------------------------------
+FILE_ROTATION = 'day'     # Start a new .csv file every 'day' or every 'hour'
+FLUSH_INTERVAL = 10       # Seconds between writes to the data files
+FLUSH_BYTES = 65536       # Write early once this many bytes of data are waiting
+FSYNC = False             # Force every write onto the disk. Safer on power loss, but wears SD cards faster.
+STORAGE_BACKEND = 'csv'   # 'csv', 'binary' (compact .orca files, see binary_data_store.py) or 'both'
+COMPRESSION = None        # Keep the files as they are, or compress each day's files once it's over: 'auto', 'zstd', 'xz' or 'gzip'
+
+WRITE_BEHIND = False      # Buffer samples in memory and write them in large batches from a background thread
+BUFFER_CAPACITY = 10000   # Samples the buffer holds before the oldest ones are dropped
+BATCH_SIZE = 500          # Samples per batch write
+MAX_BATCH_DELAY = 30      # Seconds before a smaller batch is written anyway (at most this much data is lost on power failure)
+#------------------------------------------------------
+
+
+    # Rollups (running min/max/mean/last and energy per interval)
+#------------------------------------------------------
+ROLLUP_INTERVALS = ()     # Seconds, e.g. (60, 900, 3600). Empty for no rollup files (see rollup_aggregator.py)
+#------------------------------------------------------
+
+
+    # Optional Report By Exception (only write values that changed)
+#------------------------------------------------------
+REPORT_BY_EXCEPTION = False     # Leave values that didn't move beyond their deadband blank (see deadband_filter.py)
+MAX_SILENCE = 900               # Seconds between full rows, even if nothing changed
+DEADBANDS = {
+#    'Frequency': 0.02,         # Absolute, in the reading's own units
+#    'Volts A-N': '0.2%',       # Or a percentage of the last value written
+}
+#------------------------------------------------------
+
+
+    # Acquisition Settings
+#------------------------------------------------------
+WORKER_PROCESSES = 1      # Number of processes polling the meters (see sharded_acquisition.py)
+PIPELINE_DEPTH = 1        # Requests in flight at once per gateway, or {'HOST': depth} (see pipelined_modbus_client.py)
+
+METRICS_FILE = None       # e.g. '/run/orca.prom' (see runtime_metrics.py)
+METRICS_PORT = None       # e.g. 9105, only reachable from the Pi itself
+
+PROFILER = 'sampler'      # 'sampler' or 'cprofile' (see profiling_hooks.py)
+PROFILE_CONTROL_FILE = './logs/profiling'     # Write 'cpu' and/or 'memory' into this file to start profiling
+#------------------------------------------------------
+
+
+    # Optional Modbus TCP Proxy (live values for SCADA/HMI without polling the meters again)
+#------------------------------------------------------
+PROXY_PORT = None           # e.g. 5020 to turn it on (see modbus_proxy.py)
+PROXY_HOST = '127.0.0.1'    # '0.0.0.0' to let other machines on the network read it too
+PROXY_MAX_AGE = 60          # Seconds without a good poll before a meter is reported as failed
+PROXY_UNIT_IDS = {
+#    'TestMeter': 1,
+}
+#------------------------------------------------------
+
+
+    # Optional Live Sample Stream
+#------------------------------------------------------
+PUBLISH_SOCKET = None       # e.g. '/run/orca.sock' (see sample_publisher.py)
+PUBLISH_MULTICAST = None    # e.g. ('239.255.0.1', 5021), local network only
+PUBLISH_FORMAT = 'json'     # 'json' or 'binary', for PUBLISH_MULTICAST (socket subscribers choose their own)
+#------------------------------------------------------
+
+
+    # Optional Backfill From the Meters' Historical Logs (Shark 200 only)
+#------------------------------------------------------
+BACKFILL = False            # Fill gaps in the data from each Shark 200's own historical log (see historical_backfill.py)
+BACKFILL_LOG = 1            # Which of the meter's historical logs (1, 2 or 3) to read
+BACKFILL_MIN_GAP = 300      # Seconds without rows before it counts as a gap
+BACKFILL_MAX_AGE = 604800   # Seconds back (7 days) that gaps are still filled
+#------------------------------------------------------
+
+
+    # Log Files
+#------------------------------------------------------
+LOG_MAX_BYTES = 5242880     # Size at which a log file is rotated (5 MB)
+LOG_BACKUPS = 5             # Rotated log files kept per log, older ones are deleted
+LOG_REPEAT_SUMMARY = 300    # Seconds between summaries of a message that keeps repeating
+#------------------------------------------------------
+
+
 settings = [
 
 # EXAMPLE:
@@ -13,4 +13,17 @@ primary_readings_block = (('timestamp',
                                  'VAs 3-Ph total',
                                  'Power Factor 3-Ph total',
                                  'Frequency',
-                                 'Neutral Current'))
\ No newline at end of file
+                                 'Neutral Current'))
+
+# Register map
+#######################################################################################
+# Every reading the logger knows how to fetch from a Shark 100, with its register address,
+#...data type and scale (see register_map.py in the main ORCA directory). The 'readings' lists
+#...in the settings can use any of these names, and only the registers they need are read.
+# The primary readings block is on page MM-1 of the shark100 user's manual.
+#######################################################################################
+from register_map import RegisterMap, registerBlock
+from register_decoder import FLOAT32
+
+
+register_map = RegisterMap(registerBlock('primary', 1000, primary_readings_block[1:], FLOAT32))
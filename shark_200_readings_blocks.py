@@ -28,4 +28,74 @@ primary_readings_block = (('timestamp',
                                  'Power Factor Phase C',
                                  'Symmetrical Component Magnitude 0 Seq',
                                  'Symmetrical Component Magnitude + Seq',
-                                 'Symmetrical Component Magnitude - Seq'))
\ No newline at end of file
+                                 'Symmetrical Component Magnitude - Seq'))
+
+# Register map
+#######################################################################################
+# Every reading the logger knows how to fetch from a Shark 200, with its register address,
+#...data type and scale (see register_map.py). The 'readings' lists in the settings can use
+#...any of these names, and only the registers they need are read.
+#
+# The primary readings block is on pages MM-2 to MM-3 of the shark200 user's manual, the
+#...primary energy block (registers 1500 on) and the primary demand block (2000 on) follow it
+#...in the same Modbus map. Other blocks can be added here once checked against the manual.
+#######################################################################################
+from register_map import RegisterMap, registerBlock
+from register_decoder import FLOAT32, INT64
+
+
+energy_block = ('W-hours Received',          # Units depend on the meter's energy format setting
+                'W-hours Delivered',
+                'W-hours Net',
+                'W-hours Total',
+                'VAR-hours Positive',
+                'VAR-hours Negative',
+                'VAR-hours Net',
+                'VAR-hours Total',
+                'VA-hours Total')
+
+demand_block = ('Amps A Average',
+                'Amps B Average',
+                'Amps C Average',
+                'Positive Watts 3-Ph Average',
+                'Positive VARs 3-Ph Average',
+                'Negative Watts 3-Ph Average',
+                'Negative VARs 3-Ph Average',
+                'VAs 3-Ph Average',
+                'Positive Power Factor 3-Ph Average',
+                'Negative Power Factor 3-Ph Average')
+
+
+register_map = RegisterMap(registerBlock('primary', 1000, primary_readings_block[1:], FLOAT32)
+                           + registerBlock('energy', 1500, energy_block, INT64)
+                           + registerBlock('demand', 2000, demand_block, FLOAT32))
+
+
+# Historical log retrieval
+#######################################################################################
+# The Shark 200 (with the V-Switch that enables logging) keeps up to three historical logs
+#...of any registers it's programmed to record, at a fixed interval, in its own memory. They
+#...are read through the log retrieval block: a window of records, moved through the log by
+#...writing a record offset. See historical_backfill.py.
+#
+# Unlike the register map above, these are the addresses as sent on the wire (what
+#...getModbusData() turns the manual's register numbers into). Like the other blocks they
+#...follow the Shark 200 Modbus map, so check them against your meter's manual.
+#######################################################################################
+# Per log: a block of 16 registers with its size and use (UINT32 max records, UINT32 records
+#...used, UINT16 record size in bytes, UINT16 availability (0 = available), the timestamps of
+#...the first and last records, 3 registers each), and its programming (a register with the
+#...registers per record in its high byte, the interval register, then the address of every
+#...logged register in record order).
+historical_log_status = {1: 0xC747, 2: 0xC757, 3: 0xC767}
+historical_log_programming = {1: 0x7917, 2: 0x79D7, 3: 0x7A97}
+historical_log_status_size = 16
+historical_log_programming_size = 119
+
+# The retrieval block: log number (high byte) and enable bit, records per window, then the
+#...window status (0 when the window is ready, 0xFF while it's being filled) with the 24-bit
+#...offset of its first record, then the window itself.
+log_retrieval_engage = 0xC352
+log_retrieval_window_status = 0xC354
+log_retrieval_window = 0xC356
+log_retrieval_window_size = 123     # Registers. The status and the window fit in one 125-register read.
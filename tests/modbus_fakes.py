@@ -0,0 +1,96 @@
+"""
+--------------------------------------------------------------------------------------
+A scriptable Modbus TCP gateway for the tests. It answers 'read holding registers'
+(function 3) for any unit ID from a function, takes 'write multiple registers' (function
+16), and can drop the first connection(s)
+after a number of replies, like a gateway that resets while requests are in flight.
+--------------------------------------------------------------------------------------
+"""
+
+import socket
+import socketserver
+import struct
+import threading
+
+
+def unitRegisters(unit_id, address, count):
+    # Default contents: every unit answers with values that say which unit and address they came from
+    return [(unit_id * 1000 + address + offset) & 0xFFFF for offset in range(count)]
+
+
+class _Handler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        gateway = self.server.gateway
+        with gateway.lock:
+            gateway.connections += 1
+            drop_after = gateway.drops.pop(0) if gateway.drops else None
+        replies = 0
+        connection = self.request
+        data = b''
+        while True:
+            while len(data) < 7 or len(data) < 6 + struct.unpack_from('>H', data, 4)[0]:
+                chunk = connection.recv(4096)
+                if not chunk:
+                    return
+                data += chunk
+            length = struct.unpack_from('>H', data, 4)[0]
+            frame, data = data[:6 + length], data[6 + length:]
+            transaction_id, protocol, length, unit_id, function, address, count = struct.unpack('>HHHBBHH', frame[:12])
+
+            if drop_after is not None and replies >= drop_after:
+                connection.close()
+                return
+            with gateway.lock:
+                gateway.requests.append((unit_id, address, count))
+            if function == 16:
+                result = gateway.write(unit_id, address, list(struct.unpack_from('>{}H'.format(count), frame, 13)))
+                if result is None:
+                    result = struct.pack('>HH', address, count)     # Confirmed: echoes the address and count
+            else:
+                result = gateway.registers(unit_id, address, count) if function == 3 else 1
+            if isinstance(result, int):
+                reply = struct.pack('>HHHBBB', transaction_id, 0, 3, unit_id, function | 0x80, result)
+            elif isinstance(result, bytes):
+                reply = struct.pack('>HHHBB', transaction_id, 0, 2 + len(result), unit_id, function) + result
+            else:
+                body = struct.pack('>{}H'.format(len(result)), *result)
+                reply = struct.pack('>HHHBBB', transaction_id, 0, 3 + len(body), unit_id, function, len(body)) + body
+            connection.sendall(reply)
+            replies += 1
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class FakeGateway:
+
+    def __init__(self, registers=unitRegisters, drops=(), refuse_writes=None):
+        # 'registers(unit_id, address, count)' returns the register values, or a Modbus exception
+        #...code to answer with. Writes are kept in 'writes', unless 'refuse_writes' is the
+        #...exception code to answer them with. 'drops' lists, per connection in turn, after how many replies it
+        #...is closed (None for never); later connections are never dropped.
+        self.registers = registers
+        self.drops = list(drops)
+        self.connections = 0
+        self.requests = []
+        self.writes = []
+        self.refuse_writes = refuse_writes
+        self.lock = threading.Lock()
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.gateway = self
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def write(self, unit_id, address, values):
+        if self.refuse_writes is not None:
+            return self.refuse_writes
+        with self.lock:
+            self.writes.append((unit_id, address, values))
+        return None
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
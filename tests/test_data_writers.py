@@ -0,0 +1,55 @@
+import csv
+import datetime
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from binary_data_store import MeterBinaryWriter, openDataFile, readTimeSlice
+from csv_data_writer import MeterCsvWriter
+from time_index import queryTimeRange
+
+MIDNIGHT = time.mktime(datetime.datetime(2024, 3, 2).timetuple())
+COLUMNS = ['timestamp', 'Volts A-N']
+
+
+def csvTimestamps(path):
+    with open(path, newline='') as data_file:
+        return [float(row[0]) for row in list(csv.reader(data_file))[1:]]
+
+
+class LateRowTest(unittest.TestCase):
+
+    # A rollup interval that ends just before midnight is written after the writer has
+    #...rotated to the new day: it must still go into the previous day's file.
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def writeAcrossMidnight(self, writer):
+        writer.writeRow([MIDNIGHT - 7200, 1.0], MIDNIGHT - 7200)
+        writer.maintain(MIDNIGHT + 5)
+        writer.writeRow([MIDNIGHT - 3600, 2.0], MIDNIGHT - 3600)
+        writer.writeRow([MIDNIGHT, 3.0], MIDNIGHT)
+        writer.close()
+
+    def test_csv(self):
+        self.writeAcrossMidnight(MeterCsvWriter('Meter1', COLUMNS, self.directory))
+        self.assertEqual(csvTimestamps(os.path.join(self.directory, 'Meter1_2024_3_1.csv')), [MIDNIGHT - 7200, MIDNIGHT - 3600])
+        self.assertEqual(csvTimestamps(os.path.join(self.directory, 'Meter1_2024_3_2.csv')), [MIDNIGHT])
+        rows = [row for columns, rows in queryTimeRange('Meter1', MIDNIGHT - 3600, MIDNIGHT + 1, self.directory) for row in rows]
+        self.assertEqual([float(row[0]) for row in rows], [MIDNIGHT - 3600, MIDNIGHT])
+
+    def test_binary(self):
+        self.writeAcrossMidnight(MeterBinaryWriter('Meter1', COLUMNS, ['<f4'], self.directory))
+        self.assertEqual(list(openDataFile(os.path.join(self.directory, 'Meter1_2024_3_1.orca'))['timestamp']),
+                         [MIDNIGHT - 7200, MIDNIGHT - 3600])
+        self.assertEqual(list(readTimeSlice('Meter1', MIDNIGHT - 3600, MIDNIGHT + 1, self.directory)['timestamp']),
+                         [MIDNIGHT - 3600, MIDNIGHT])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from file_compressor import FileCompressor, GZIP, openData
+
+
+class FileCompressorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.compressor = FileCompressor(self.directory, GZIP)
+        for stream in ('Meter1', 'Meter1_backfill'):
+            with open(os.path.join(self.directory, stream + '_2020_6_1.csv'), 'w') as data_file:
+                data_file.write('timestamp,Frequency\n1590969600,60.0\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_held_streams_are_left_alone(self):
+        with self.compressor.holding('Meter1_backfill'):
+            self.assertEqual(self.compressor.compressCompleted(), 1)
+            self.assertEqual(sorted(os.listdir(self.directory)), ['Meter1_2020_6_1.csv.gz', 'Meter1_backfill_2020_6_1.csv'])
+        self.assertEqual(self.compressor.compressCompleted(), 1)
+        with openData(os.path.join(self.directory, 'Meter1_backfill_2020_6_1.csv'), 'r') as data_file:
+            self.assertEqual(data_file.read(), 'timestamp,Frequency\n1590969600,60.0\n')
+
+    def test_holding_waits_for_a_compression_under_way(self):
+        started, held = threading.Event(), []
+        compress_file = self.compressor.compressFile
+
+        def slowCompressFile(path):
+            started.set()
+            time.sleep(0.2)
+            return compress_file(path)
+
+        def hold():
+            started.wait()
+            with self.compressor.holding('Meter1'):
+                held.append(os.listdir(self.directory))
+
+        self.compressor.compressFile = slowCompressFile
+        holder = threading.Thread(target=hold)
+        holder.start()
+        self.compressor.compressCompleted()
+        holder.join()
+        self.assertNotIn('Meter1_2020_6_1.csv', held[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
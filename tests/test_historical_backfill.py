@@ -0,0 +1,79 @@
+import logging
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+import shark_200_readings_blocks
+from historical_backfill import Backfiller, Gap, HistoricalLogReader, HistoricalLogUnavailable, PooledLogClient
+from meter_drivers import Shark200
+from modbus_connection_pool import ModbusConnectionPool
+from modbus_fakes import FakeGateway, unitRegisters
+from poll_plan import compilePlan
+
+LOG_STATUS = shark_200_readings_blocks.historical_log_status[1]
+
+
+def disabledLog(unit_id, address, count):
+    # Log 1 answers with availability 1 (not available), everything else as usual
+    if address == LOG_STATUS:
+        return [0, 100, 0, 0, 10, 1] + [0] * (count - 6)
+    return unitRegisters(unit_id, address, count)
+
+
+class UnavailableLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.gateway = FakeGateway(registers=disabledLog)
+        self.pool = ModbusConnectionPool(timeout=2.0)
+
+    def tearDown(self):
+        self.pool.closeAll()
+        self.gateway.close()
+        shutil.rmtree(self.directory)
+
+    def test_reader_raises_unavailable(self):
+        reader = HistoricalLogReader(PooledLogClient(self.pool, '127.0.0.1', self.gateway.port, 1), shark_200_readings_blocks)
+        with self.assertRaises(HistoricalLogUnavailable):
+            reader.recordsBetween(time.time() - 3600, time.time())
+
+    def test_gaps_of_the_meter_are_dropped(self):
+        meter = Shark200('Meter1', '127.0.0.1', self.gateway.port, 2, 1, ['Volts A-N'])
+        plan = compilePlan(meter, 1, logging.getLogger('Meter1'))
+        backfiller = Backfiller(lambda plan: [], self.pool, self.directory)
+        backfiller.setPlans({'Meter1': plan})
+        now = time.time()
+        with backfiller._lock:
+            backfiller._addGap(Gap('Meter1', now - 3600, now - 1800))
+            backfiller._addGap(Gap('Meter1', now - 600, now - 60))
+
+        backfiller._fillGap(backfiller._nextGap())
+        self.assertIsNone(backfiller._nextGap())
+        self.assertEqual(backfiller._gaps, [])
+        backfiller.observe('Meter1', now)
+        backfiller.observe('Meter1', now + 3600)
+        self.assertEqual(backfiller._gaps, [])
+
+        # Only the status was read, over the pool's one connection
+        self.assertEqual(self.gateway.connections, 1)
+        self.assertEqual(self.gateway.writes, [])
+
+
+    def test_gap_that_fails_to_decode_is_given_up_on(self):
+        meter = Shark200('Meter1', '127.0.0.1', self.gateway.port, 2, 1, ['Volts A-N'])
+        backfiller = Backfiller(lambda plan: [], self.pool, self.directory)
+        backfiller.setPlans({'Meter1': compilePlan(meter, 1, logging.getLogger('Meter1'))})
+        now = time.time()
+        with backfiller._lock:
+            backfiller._addGap(Gap('Meter1', now - 3600, now - 1800))
+
+        with mock.patch.object(HistoricalLogReader, 'loggedRegisters', side_effect=IndexError('odd record')):
+            backfiller._fillGap(backfiller._nextGap())
+        self.assertEqual(backfiller._gaps, [])
+        self.assertEqual(backfiller._retry_at, {})
+        self.assertNotIn('Meter1', backfiller._unavailable)
+
+
+if __name__ == '__main__':
+    unittest.main()
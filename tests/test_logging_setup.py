@@ -0,0 +1,113 @@
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+import logging_setup
+from logging_setup import CollapsingHandler
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append((record.name, record.getMessage()))
+
+
+def record(name, message, created):
+    record = logging.makeLogRecord({'name': name, 'msg': message, 'levelno': logging.ERROR, 'levelname': 'ERROR'})
+    record.created = created
+    return record
+
+
+def workerLogging():
+    logging_setup.restartAfterFork()
+    logging.getLogger('Meter1').error('From the worker')
+    logging_setup.stopLogging()
+
+
+class CollapsingHandlerTest(unittest.TestCase):
+
+    def test_repeats_are_counted(self):
+        target = ListHandler()
+        handler = CollapsingHandler(target, summary_interval=300)
+        for second in range(4):
+            handler.handle(record('Meter1', 'No data', second))
+        handler.handle(record('Meter1', 'Back', 4))
+        self.assertEqual(target.messages, [('Meter1', 'No data'), ('Meter1', 'Back')])
+        handler.expire(303)
+        self.assertTrue(target.messages[2][1].startswith('No data [repeated 3 more times'))
+        self.assertEqual(len(target.messages), 3)
+
+    def test_same_message_from_another_logger_is_written(self):
+        target = ListHandler()
+        handler = CollapsingHandler(target)
+        handler.handle(record('Meter1', 'No data', 0))
+        handler.handle(record('Meter2', 'No data', 1))
+        self.assertEqual(target.messages, [('Meter1', 'No data'), ('Meter2', 'No data')])
+
+    def test_interleaved_repeats_are_collapsed(self):
+        # Two meters down at once take turns in All_Logs.log
+        target = ListHandler()
+        handler = CollapsingHandler(target, summary_interval=300)
+        for second in range(0, 100, 10):
+            handler.handle(record('Meter1', 'Could not connect', second))
+            handler.handle(record('Meter2', 'Could not connect', second + 1))
+        self.assertEqual(target.messages, [('Meter1', 'Could not connect'), ('Meter2', 'Could not connect')])
+        handler.flush()
+        self.assertEqual([name for name, message in target.messages[2:]], ['Meter1', 'Meter2'])
+        self.assertTrue(all('[repeated 9 more times' in message for name, message in target.messages[2:]))
+
+    def test_summary_while_the_repeats_go_on(self):
+        target = ListHandler()
+        handler = CollapsingHandler(target, summary_interval=300)
+        for second in range(0, 700, 100):
+            handler.handle(record('Meter1', 'No data', second))
+        # Written at 0, counted from 100, and the 3 up to 300 summarized once 300 s had gone by
+        self.assertEqual(len(target.messages), 2)
+        self.assertTrue(target.messages[1][1].startswith('No data [repeated 3 more times between'))
+
+    def test_written_again_after_it_stopped(self):
+        target = ListHandler()
+        handler = CollapsingHandler(target, summary_interval=300)
+        handler.handle(record('Meter1', 'No data', 0))
+        handler.handle(record('Meter1', 'No data', 1000))
+        self.assertEqual(target.messages, [('Meter1', 'No data'), ('Meter1', 'No data')])
+
+
+@unittest.skipUnless('fork' in multiprocessing.get_all_start_methods(), 'needs fork')
+class WorkerLoggingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        logging_setup.stopLogging()
+        logging.getLogger().removeHandler(logging_setup._queue_handler)
+        logging_setup._queue_handler, logging_setup._router = None, None
+        shutil.rmtree(self.directory)
+
+    def test_worker_records_are_written_by_the_parent(self):
+        logging_setup.startLogging(self.directory)
+        logging_setup.addLogFile('Meter1')
+        logging_setup.shareWithWorkers()
+
+        worker = multiprocessing.get_context('fork').Process(target=workerLogging)
+        worker.start()
+        worker.join(10)
+        self.assertEqual(worker.exitcode, 0)
+        logging.getLogger('Meter1').error('From the parent')
+        logging_setup.stopLogging()
+
+        for name in ('Meter1', logging_setup.ALL_LOGS):
+            with open(os.path.join(self.directory, name + '.log')) as log_file:
+                lines = log_file.read().splitlines()
+            self.assertEqual(sorted(line.split(': ', 1)[1] for line in lines), ['From the parent', 'From the worker'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import unittest
+import numpy as np
+from modbus_connection_pool import ModbusConnectionPool
+from pipelined_modbus_client import PipelinedModbusClient
+from modbus_fakes import FakeGateway, unitRegisters
+
+
+READS = [(unit_id, 100, 3) for unit_id in (1, 2, 3, 4)]
+
+
+def values(results):
+    return [None if registers is None else list(registers) for timestamp, registers, duration in results]
+
+
+class PoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.gateway = None
+        self.pool = None
+
+    def tearDown(self):
+        if self.pool is not None:
+            self.pool.closeAll()
+        if self.gateway is not None:
+            self.gateway.close()
+
+    def read(self, reads=READS, depth=4, **gateway_options):
+        self.gateway = FakeGateway(**gateway_options)
+        self.pool = ModbusConnectionPool(timeout=2.0, pipeline_depth=depth)
+        return self.pool.readMany('127.0.0.1', self.gateway.port, reads)
+
+    def test_all_reads_answered(self):
+        self.assertEqual(values(self.read()), [unitRegisters(*read) for read in READS])
+        self.assertEqual(self.gateway.connections, 1)
+
+    def test_retry_after_drop_keeps_the_earlier_replies(self):
+        # The gateway drops the connection after two replies: the other two are read again on a
+        #...new connection, and the first two must still hold their own units' registers.
+        results = self.read(drops=(2,))
+        self.assertEqual(values(results), [unitRegisters(*read) for read in READS])
+        self.assertEqual(self.gateway.connections, 2)
+
+    def test_exception_reply_only_fails_its_read(self):
+        results = self.read(registers=lambda unit_id, address, count: 11 if unit_id == 2 else
+                            unitRegisters(unit_id, address, count))
+        self.assertEqual(values(results), [unitRegisters(*READS[0]), None, unitRegisters(*READS[2]), unitRegisters(*READS[3])])
+        self.assertEqual(self.gateway.connections, 1)
+
+    def test_serial_exception_reply_only_fails_its_read(self):
+        # One misconfigured unit behind a gateway must not reset the shared socket for the others
+        results = self.read(depth=1, registers=lambda unit_id, address, count: 11 if unit_id == 2 else
+                            unitRegisters(unit_id, address, count))
+        self.assertEqual(values(results), [unitRegisters(*READS[0]), None, unitRegisters(*READS[2]), unitRegisters(*READS[3])])
+        self.assertEqual(self.gateway.connections, 1)
+        self.assertEqual(self.pool.getConnection('127.0.0.1', self.gateway.port).reconnects, 0)
+
+    def test_serial_retry_after_drop(self):
+        results = self.read(depth=1, drops=(2,))
+        self.assertEqual(values(results), [unitRegisters(*read) for read in READS])
+        self.assertEqual(self.gateway.connections, 2)
+
+    def test_single_read_exception_keeps_the_connection(self):
+        self.gateway = FakeGateway(registers=lambda unit_id, address, count: 2 if unit_id == 5 else
+                                   unitRegisters(unit_id, address, count))
+        self.pool = ModbusConnectionPool(timeout=2.0)
+        self.assertIsNone(self.pool.readHoldingRegisters('127.0.0.1', self.gateway.port, 5, 100, 3))
+        self.assertEqual(list(self.pool.readHoldingRegisters('127.0.0.1', self.gateway.port, 1, 100, 3)),
+                         unitRegisters(1, 100, 3))
+        self.assertEqual(self.gateway.connections, 1)
+        self.assertEqual(self.pool.getConnection('127.0.0.1', self.gateway.port).reconnects, 0)
+
+    def test_write_then_read_on_one_connection(self):
+        for depth in (1, 4):
+            self.read(depth=depth)
+            self.assertTrue(self.pool.writeRegisters('127.0.0.1', self.gateway.port, 7, 200, [1, 2, 3]))
+            self.assertEqual(values(self.pool.readMany('127.0.0.1', self.gateway.port, READS)),
+                             [unitRegisters(*read) for read in READS])
+            self.assertEqual(self.gateway.writes, [(7, 200, [1, 2, 3])])
+            self.assertEqual(self.gateway.connections, 1)
+            self.tearDown()
+
+    def test_refused_write_keeps_the_connection(self):
+        for depth in (1, 4):
+            self.read(depth=depth, refuse_writes=2)
+            self.assertFalse(self.pool.writeRegisters('127.0.0.1', self.gateway.port, 7, 200, [1]))
+            self.assertEqual(self.gateway.connections, 1)
+            self.assertEqual(self.pool.getConnection('127.0.0.1', self.gateway.port).reconnects, 0)
+            self.tearDown()
+
+    def test_views_survive_the_next_batch(self):
+        self.gateway = FakeGateway()
+        client = PipelinedModbusClient('127.0.0.1', self.gateway.port, timeout=2.0, depth=4)
+        try:
+            first = client.readMany(READS)
+            client.readMany([(9, 100, 3)] * 4)
+            self.assertEqual([list(registers) for timestamp, registers, duration in first],
+                             [unitRegisters(*read) for read in READS])
+            self.assertEqual(first[0][1].dtype, np.dtype('>u2'))
+        finally:
+            client.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
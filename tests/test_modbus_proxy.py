@@ -0,0 +1,77 @@
+import socket
+import struct
+import time
+import unittest
+from modbus_proxy import LatestValueCache, ModbusProxyServer, registerBlock
+
+
+def request(transaction_id, unit_id, address, count, function=3):
+    return struct.pack('>HHHBBHH', transaction_id, 0, 6, unit_id, function, address, count)
+
+
+class ProxyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = LatestValueCache(max_age=60)
+        self.cache.setUnitIds({1: 'Meter1', 2: 'Meter2'})
+        self.cache.update('Meter1', [registerBlock(1000, [10, 11, 12, 13]), registerBlock(1004, [14, 15]),
+                                     registerBlock(2000, [20, 21])], time.time())
+        self.cache.update('Meter2', [registerBlock(1000, [1, 2])], time.time() - 120)     # Not read for two minutes
+        self.proxy = ModbusProxyServer(self.cache, port=0)
+        self.proxy.start()
+        self.client = socket.create_connection(('127.0.0.1', self.proxy.port), timeout=2)
+
+    def tearDown(self):
+        self.client.close()
+        self.proxy.close()
+
+    def receive(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.client.recv(size - len(data))
+            self.assertTrue(chunk, 'The proxy closed the connection')
+            data += chunk
+        return data
+
+    def ask(self, transaction_id, unit_id, address, count, function=3):
+        # Returns the registers, or the exception code
+        self.client.sendall(request(transaction_id, unit_id, address, count, function))
+        return self.reply(transaction_id, unit_id)
+
+    def reply(self, transaction_id, unit_id):
+        reply_id, protocol, length, reply_unit_id, function, byte_count = struct.unpack('>HHHBBB', self.receive(9))
+        self.assertEqual((reply_id, protocol, reply_unit_id), (transaction_id, 0, unit_id))
+        if function & 0x80:
+            self.assertEqual(length, 3)
+            return byte_count
+        self.assertEqual(length, 3 + byte_count)
+        return list(struct.unpack('>{}H'.format(byte_count // 2), self.receive(byte_count)))
+
+    def test_read_within_a_block(self):
+        self.assertEqual(self.ask(7, 1, 1001, 2), [11, 12])
+
+    def test_read_across_adjacent_blocks(self):
+        self.assertEqual(self.ask(8, 1, 1002, 4), [12, 13, 14, 15])
+
+    def test_registers_not_read(self):
+        self.assertEqual(self.ask(9, 1, 1004, 3), 2)     # Runs past the end of the block
+        self.assertEqual(self.ask(10, 1, 999, 2), 2)
+
+    def test_unit_id_not_configured(self):
+        self.assertEqual(self.ask(11, 3, 1000, 1), 10)
+
+    def test_meter_not_read_lately(self):
+        self.assertEqual(self.ask(12, 2, 1000, 2), 11)
+
+    def test_only_reads(self):
+        self.assertEqual(self.ask(13, 1, 1000, 1, function=4), 1)
+        self.assertEqual(self.ask(14, 1, 1000, 126), 3)
+
+    def test_requests_sent_together(self):
+        self.client.sendall(request(1, 1, 1000, 1) + request(2, 1, 2000, 2))
+        self.assertEqual(self.reply(1, 1), [10])
+        self.assertEqual(self.reply(2, 1), [20, 21])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import struct
+import unittest
+from register_map import RegisterMap, registerBlock, MAX_REGISTERS_PER_READ
+from register_decoder import FLOAT32, INT16
+from shark_200_readings_blocks import register_map as shark_200_map
+
+
+def float32Registers(value):
+    # The Shark's word order: low word first
+    high, low = struct.unpack('>HH', struct.pack('>f', value))
+    return [low, high]
+
+
+def covered(read):
+    return set(range(read.start_register, read.end_register + 1))
+
+
+class PlanReadsTest(unittest.TestCase):
+
+    def test_gaps_in_a_block_are_read_through(self):
+        reads = shark_200_map.planReads(['Volts A-N', 'Volts B-N', 'Amps A', 'Watts 3-Ph total', 'Frequency'])
+        self.assertEqual(len(reads), 1)
+        self.assertEqual((reads[0].start_register, reads[0].end_register), (1000, 1027))
+
+    def test_max_gap_still_splits_when_given(self):
+        reads = shark_200_map.planReads(['Volts A-N', 'Volts B-N', 'Amps A'], max_gap=0)
+        self.assertEqual([(read.start_register, read.end_register) for read in reads], [(1000, 1003), (1012, 1013)])
+
+    def test_reads_never_cross_blocks(self):
+        reads = shark_200_map.planReads(shark_200_map.names())
+        for read in reads:
+            blocks = set(register.block for register in shark_200_map.registers.values()
+                         if register.address in covered(read))
+            self.assertEqual(blocks, {read.block})
+
+    def test_reads_stay_within_the_modbus_limit(self):
+        register_map = RegisterMap(registerBlock('big', 0, ['Value {}'.format(index) for index in range(200)]))
+        reads = register_map.planReads(register_map.names())
+        self.assertEqual(len(reads), 4)
+        for read in reads:
+            self.assertLessEqual(read.end_register - read.start_register + 1, MAX_REGISTERS_PER_READ)
+        self.assertEqual(sum(len(run.names) for read in reads for run in read.runs), 200)
+
+    def test_every_reading_is_planned_once(self):
+        names = shark_200_map.names()
+        planned = [name for read in shark_200_map.planReads(names) for run in read.runs for name in run.names]
+        self.assertEqual(sorted(planned), sorted(names))
+
+    def test_unknown_reading(self):
+        with self.assertRaises(KeyError):
+            shark_200_map.planReads(['Volts A-N', 'Not a reading'])
+
+
+class DecodeReadTest(unittest.TestCase):
+
+    def test_values_around_a_gap(self):
+        register_map = RegisterMap(registerBlock('primary', 100, ['A', 'B', 'C', 'D'])
+                                   + registerBlock('primary', 108, ['Angle'], INT16, scale=0.1))
+        read, = register_map.planReads(['A', 'C', 'Angle'])
+        self.assertEqual((read.start_register, read.end_register), (100, 108))
+
+        response = float32Registers(1.5) + float32Registers(-7.0) + float32Registers(230.25) + [0, 0] + [65535 - 122]
+        self.assertEqual(register_map.decodeRead(read, response), {'A': 1.5, 'C': 230.25, 'Angle': -12.3})
+
+    def test_short_reply(self):
+        # A truncated reply must not quietly leave readings out of the row
+        read, = shark_200_map.planReads(['Volts A-N', 'Frequency'])
+        with self.assertRaises(ValueError):
+            shark_200_map.decodeRead(read, [0] * (read.end_register - read.start_register))
+
+
+if __name__ == '__main__':
+    unittest.main()
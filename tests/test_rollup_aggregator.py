@@ -0,0 +1,68 @@
+import unittest
+from rollup_aggregator import MeterRollup
+
+NAMES = ['Volts A-N', 'Watts 3-Ph total']
+BASE = 3600 * 500000     # On a minute and an hour boundary
+
+
+def sample(offset, volts, watts):
+    return [BASE + offset, volts, watts], BASE + offset
+
+
+class MeterRollupTest(unittest.TestCase):
+
+    def test_statistics_of_a_finished_interval(self):
+        rollup = MeterRollup('Meter1', NAMES, intervals=(60,))
+        self.assertEqual(rollup.update(*sample(10, 230.0, 3600.0)), [])
+        self.assertEqual(rollup.update(*sample(40, 232.0, 3600.0)), [])
+        (stream, row, timestamp), = rollup.update(*sample(70, 231.0, 3600.0))
+        self.assertEqual(stream, 'Meter1_rollup_1min')
+        self.assertEqual(timestamp, BASE)
+        self.assertEqual(rollup.columns()[:6], ['timestamp', 'samples', 'Volts A-N min', 'Volts A-N max',
+                                                'Volts A-N mean', 'Volts A-N last'])
+        self.assertEqual(row[:6], [BASE, 2, 230.0, 232.0, 231.0, 232.0])
+
+    def test_energy_is_split_at_the_boundary(self):
+        # 3600 W is 1 Wh per second: the stretch from 30 to 90 s is 30 Wh either side of the minute
+        rollup = MeterRollup('Meter1', NAMES, intervals=(60,))
+        rollup.update(*sample(30, 230.0, 3600.0))
+        (stream, first, timestamp), = rollup.update(*sample(90, 230.0, 3600.0))
+        (stream, second, timestamp), = rollup.update(*sample(150, 230.0, 3600.0))
+        self.assertEqual(first[-1], 30.0)
+        self.assertEqual(second[-1], 60.0)
+        self.assertEqual(rollup.columns()[-1], 'Watts 3-Ph total Wh')
+
+    def test_trapezoid_of_a_changing_reading(self):
+        rollup = MeterRollup('Meter1', NAMES, intervals=(3600,), max_gap=3600)
+        rollup.update(*sample(0, 230.0, 0.0))
+        rollup.update(*sample(1800, 230.0, 7200.0))
+        (stream, row, timestamp), = rollup.update(*sample(3600, 230.0, 7200.0))
+        self.assertEqual(row[-1], 1800.0 + 3600.0)     # Ramp 0 -> 7200 W over half an hour, then 7200 W for half an hour
+
+    def test_no_energy_across_a_long_gap(self):
+        rollup = MeterRollup('Meter1', NAMES, intervals=(60,), max_gap=60)
+        rollup.update(*sample(30, 230.0, 3600.0))
+        (stream, row, timestamp), = rollup.update(*sample(200, 230.0, 3600.0))
+        self.assertEqual(row[-1], 0.0)
+        (stream, row, timestamp), = rollup.update(*sample(250, 230.0, 3600.0))
+        self.assertEqual(timestamp, BASE + 180)
+        self.assertEqual(row[-1], 40.0)     # From 200 s to the boundary at 240 s
+
+    def test_expire_after_max_gap(self):
+        rollup = MeterRollup('Meter1', NAMES, intervals=(60, 900), max_gap=60)
+        rollup.update(*sample(30, 230.0, 3600.0))
+        self.assertEqual(rollup.expire(BASE + 119), [])
+        expired = rollup.expire(BASE + 120)
+        self.assertEqual([(stream, timestamp) for stream, row, timestamp in expired], [('Meter1_rollup_1min', BASE)])
+        self.assertEqual(rollup.expire(BASE + 120), [])
+        (stream, row, timestamp), = rollup.expire(BASE + 900 + 60)
+        self.assertEqual((stream, row[:2]), ('Meter1_rollup_15min', [BASE, 1]))
+        self.assertEqual(rollup.expire(BASE + 3600), [])
+
+    def test_invalid_intervals(self):
+        with self.assertRaises(ValueError):
+            MeterRollup('Meter1', NAMES, intervals=(60, 0.5))
+
+
+if __name__ == '__main__':
+    unittest.main()
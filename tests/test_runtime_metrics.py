@@ -0,0 +1,22 @@
+import unittest
+from runtime_metrics import RuntimeMetrics, METRICS, COUNTER
+
+
+class RuntimeMetricsTest(unittest.TestCase):
+
+    def test_counters_accumulate(self):
+        metrics = RuntimeMetrics()
+        metrics.increment('orca_tick_overruns_total', 0, meter='Galena_1')
+        metrics.increment('orca_tick_overruns_total', meter='Galena_1')
+        metrics.increment('orca_tick_overruns_total', meter='Galena_1')
+        text = metrics.render()
+        self.assertIn('# TYPE orca_tick_overruns_total counter', text)
+        self.assertIn('orca_tick_overruns_total{meter="Galena_1"} 2', text)
+
+    def test_counter_names_end_in_total(self):
+        for name, (metric_type, help_text) in METRICS.items():
+            self.assertEqual(metric_type == COUNTER, name.endswith('_total'), name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import json
+import math
+import os
+import queue
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from sample_publisher import SamplePublisher, subscribe, BINARY, JSON
+
+STREAMS = {'Meter1': ('Meter1', ['Volts A-N', 'Amps A']), 'Meter2': ('Meter2', ['Volts A-N', 'Amps A'])}
+
+
+def waitFor(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('Timed out')
+        time.sleep(0.01)
+
+
+class PublisherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.directory, 'orca.sock')
+        self.publisher = SamplePublisher(self.socket_path, max_backlog=4096)
+        self.publisher.setStreams(STREAMS)
+        self.publisher.start()
+
+    def tearDown(self):
+        self.publisher.close()
+        shutil.rmtree(self.directory)
+
+    def subscribe(self, **options):
+        # Starts a subscriber on a thread and waits until the publisher has its subscription
+        received = queue.Queue()
+        subscribers = len(self.publisher._subscribers)
+
+        def run():
+            for sample in subscribe(self.socket_path, **options):
+                received.put(sample)
+
+        threading.Thread(target=run, daemon=True).start()
+        waitFor(lambda: len([subscriber for subscriber in self.publisher._subscribers if subscriber.subscribed])
+                > subscribers)
+        return received
+
+    def test_binary_round_trip(self):
+        received = self.subscribe(meters=['Meter1'], columns=['Amps A'], message_format=BINARY)
+        self.publisher.publish('Meter2', [1.0, 230.0, 5.0], 1.0)     # Another meter: not sent
+        self.publisher.publish('Meter1', [2.0, 231.0, 6.5], 2.0)
+        self.publisher.publish('Meter1', [3.0, 232.0, None], 3.0)    # Blank: filled in from the last row
+        self.assertEqual(received.get(timeout=5), ('Meter1', 'Meter1', 2.0, {'Amps A': 6.5}))
+        self.assertEqual(received.get(timeout=5), ('Meter1', 'Meter1', 3.0, {'Amps A': 6.5}))
+
+    def test_binary_missing_value_is_nan(self):
+        received = self.subscribe(message_format=BINARY)
+        self.publisher.publish('Meter2', [1.0, None, 5.0], 1.0)
+        meter_name, stream_name, timestamp, values = received.get(timeout=5)
+        self.assertTrue(math.isnan(values['Volts A-N']))
+        self.assertEqual(values['Amps A'], 5.0)
+
+    def test_json(self):
+        received = self.subscribe(message_format=JSON)
+        self.publisher.publish('Meter2', [1.0, 230.0, 5.0], 1.0)
+        self.assertEqual(received.get(timeout=5), ('Meter2', 'Meter2', 1.0, {'Volts A-N': 230.0, 'Amps A': 5.0}))
+
+    def test_slow_subscriber_loses_samples_only_for_itself(self):
+        slow = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)     # Subscribes, then never reads
+        slow.connect(self.socket_path)
+        slow.sendall(json.dumps({'format': JSON}).encode('utf-8') + b'\n')
+        try:
+            waitFor(lambda: self.publisher._subscribers and self.publisher._subscribers[0].subscribed)
+            slow_subscriber = self.publisher._subscribers[0]
+            received = self.subscribe(message_format=JSON)
+            fast_subscriber = self.publisher._subscribers[1]
+
+            timestamp = 0.0
+            while not slow_subscriber.dropped:     # Until its socket buffer and backlog are full
+                for _ in range(100):
+                    timestamp += 1
+                    self.publisher.publish('Meter1', [timestamp, 230.0, 5.0], timestamp)
+                waitFor(lambda: not self.publisher._samples and not fast_subscriber.backlog)
+                self.assertLess(timestamp, 1e6)
+            self.assertLessEqual(len(slow_subscriber.backlog), self.publisher.max_backlog)
+
+            self.publisher.publish('Meter1', [-1.0, 230.0, 5.0], -1.0)
+            last = None
+            while last != -1.0:
+                meter_name, stream_name, last, values = received.get(timeout=5)
+        finally:
+            slow.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
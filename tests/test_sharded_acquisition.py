@@ -0,0 +1,46 @@
+import time
+import unittest
+from sharded_acquisition import WorkerSupervisor, shardMeters
+
+
+def politeWorker(shard, sample_queue, heartbeat, stopping):
+    while not stopping.wait(0.05):
+        heartbeat.value = time.monotonic()
+    sample_queue.put((shard[0][0], ['stopped'], time.time()))
+
+
+def hungWorker(shard, sample_queue, heartbeat, stopping):
+    time.sleep(60)
+
+
+class SupervisorTest(unittest.TestCase):
+
+    def test_shards_keep_gateways_together(self):
+        settings = [('A', '10.0.0.1', 502), ('B', '10.0.0.1', 502), ('C', '10.0.0.2', 502)]
+        self.assertEqual(sorted(len(shard) for shard in shardMeters(settings, 4)), [1, 2])
+
+    def test_workers_are_asked_to_stop(self):
+        supervisor = WorkerSupervisor([[('A', '10.0.0.1', 502)], [('B', '10.0.0.2', 502)]], politeWorker, stop_timeout=5)
+        supervisor.start()
+        time.sleep(0.2)
+        processes = [worker.process for worker in supervisor.workers]
+        supervisor.stop()
+        self.assertEqual([process.exitcode for process in processes], [0, 0])
+        samples = supervisor.collectSamples(timeout=2)
+        while len(samples) < 2:
+            samples += supervisor.collectSamples(timeout=2)
+        self.assertEqual(sorted(sample[0] for sample in samples), ['A', 'B'])
+
+    def test_hung_worker_is_terminated_after_the_timeout(self):
+        supervisor = WorkerSupervisor([[('A', '10.0.0.1', 502)]], hungWorker, heartbeat_timeout=0.1, stop_timeout=0.2)
+        supervisor.start()
+        time.sleep(0.3)
+        process = supervisor.workers[0].process
+        supervisor.checkWorkers()     # Stale heartbeat: stopped, then (after restart_delay) started again
+        self.assertIsNotNone(process.exitcode)
+        self.assertNotEqual(process.exitcode, 0)
+        supervisor.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
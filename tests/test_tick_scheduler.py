@@ -0,0 +1,33 @@
+import threading
+import time
+import unittest
+from tick_scheduler import DeadlineScheduler
+
+
+class DeadlineSchedulerTest(unittest.TestCase):
+
+    def test_no_tasks_idles(self):
+        started = time.monotonic()
+        self.assertEqual(DeadlineScheduler().waitForDueTasks(idle=0.05), [])
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+
+    def test_stopping_ends_the_wait(self):
+        scheduler = DeadlineScheduler()
+        scheduler.addTask('Meter1', 60)
+        scheduler.tasks['Meter1'].origin = time.monotonic() + 60     # Not due for a minute
+        stopping = threading.Event()
+        threading.Timer(0.05, stopping.set).start()
+        started = time.monotonic()
+        self.assertEqual(scheduler.waitForDueTasks(stopping), [])
+        self.assertLess(time.monotonic() - started, 5)
+
+    def test_tasks_come_due_together(self):
+        scheduler = DeadlineScheduler()
+        scheduler.addTask('Meter1', 0.05)
+        scheduler.addTask('Meter2', 0.05)
+        scheduler.waitForDueTasks()
+        self.assertEqual(sorted(tick.name for tick in scheduler.waitForDueTasks()), ['Meter1', 'Meter2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import os
+import shutil
+import tempfile
+import unittest
+from csv_data_writer import MeterCsvWriter
+from time_index import readRange, queryTimeRange
+
+
+START = 1590969600.0     # 2020-06-01 00:00 UTC, the 20 minutes of rows stay within one local day
+BACKFILLED = [(START + 600 + second * 60, 1) for second in range(10)] + [(START + second * 60, 2) for second in range(10)]
+
+
+class OutOfOrderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        writer = MeterCsvWriter('Meter1_backfill', ['timestamp', 'Frequency', 'backfilled'], self.directory)
+        for timestamp, gap in BACKFILLED:     # Two gaps, the later one filled first
+            writer.writeRow([int(timestamp), 60.0 + gap, 1], timestamp)
+        writer.close()
+        self.path = writer.file_path
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_rows_come_back_sorted(self):
+        columns, rows = readRange(self.path, START + 300, START + 900)
+        self.assertEqual([int(row[0]) for row in rows], [int(START) + minute * 60 for minute in range(5, 15)])
+
+    def test_backfill_is_merged_in_time_order(self):
+        rows = [row for columns, rows in queryTimeRange('Meter1', START, START + 1200, self.directory, backfill=True)
+                for row in rows]
+        self.assertEqual([float(row[0]) for row in rows], sorted(timestamp for timestamp, gap in BACKFILLED))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from write_behind_buffer import WriteBehindBuffer
+
+
+class ListWriter:
+
+    def __init__(self):
+        self.rows = []
+
+    def writeRow(self, row, timestamp):
+        self.rows.append(row)
+
+    def sync(self):
+        pass
+
+    def maintain(self):
+        pass
+
+
+class WriteBehindBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.writer = ListWriter()
+        self.buffer = WriteBehindBuffer({'Meter1': [self.writer]}, batch_size=1000, max_delay=3600,
+                                        spool_path=os.path.join(self.directory, '.spool'))
+
+    def tearDown(self):
+        self.buffer.close()
+        shutil.rmtree(self.directory)
+
+    def test_callbacks_split_the_batch(self):
+        # Rows put() before a callback reach the old writer, rows put() after it the new one
+        new_writer = ListWriter()
+        done = threading.Event()
+        self.buffer.put('Meter1', [1], 1.0)
+        self.buffer.put('Meter1', [2], 2.0)
+        self.buffer.runAfterQueued(lambda: self.buffer.data_writers.update(Meter1=[new_writer]))
+        self.buffer.put('Meter1', [3], 3.0)
+        self.buffer.runAfterQueued(done.set)
+        self.buffer.start()
+        self.assertTrue(done.wait(10))
+        self.assertEqual(self.writer.rows, [[1], [2]])
+        self.assertEqual(new_writer.rows, [[3]])
+
+    def test_spool_is_written_again_after_a_power_cut(self):
+        spool_path = os.path.join(self.directory, '.spool')
+        with open(spool_path, 'w') as spool_file:
+            spool_file.write('["Meter1", 1.0, [1]]\n["Meter1", 2.0, [2]]\n["Meter1", 3.0, [3')     # Torn last line
+        self.buffer.start()
+        self.assertEqual(self.writer.rows, [[1], [2]])
+        self.assertEqual(os.path.getsize(spool_path), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
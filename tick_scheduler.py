@@ -0,0 +1,119 @@
+"""
+--------------------------------------------------------------------------------------
+ORCA Deadline Scheduler
+
+Replaces the busy-wait loop that polled the wall clock every 50 ms. Every task (one per
+meter) gets absolute deadlines on the monotonic clock, computed as
+
+    origin + tick_number * timestep
+
+so there is no accumulated drift no matter how long a pass takes, and the scheduler
+sleeps exactly until the next deadline instead of waking up 20 times a second.
+
+- Timesteps can be fractional (e.g. 0.5 s) and don't have to divide into 60.
+- Each task can have its own timestep.
+- Whole ticks that passed while the previous pass was still running are counted as
+  'missed' and skipped, rather than fired back-to-back to catch up.
+- A pass that finishes after the task's next deadline is counted as an 'overrun'.
+
+The first deadline of each task is lined up with the wall clock (a timestep of 4 fires
+at :00, :04, :08, ... like the old loop did), after that only the monotonic clock is used.
+--------------------------------------------------------------------------------------
+"""
+
+import collections
+import math
+import time
+
+
+# name:     The task name given to addTask()
+# deadline: The time.monotonic() deadline this tick was scheduled for
+# missed:   How many earlier deadlines of this task were skipped because they had already passed
+ScheduledTick = collections.namedtuple('ScheduledTick', ['name', 'deadline', 'missed'])
+
+
+class ScheduledTask:
+
+    def __init__(self, name, timestep, origin):
+        self.name = name
+        self.timestep = timestep
+        self.origin = origin         # time.monotonic() of tick number 0
+        self.tick_number = 0
+
+        self.ticks = 0               # Ticks fired
+        self.missed_ticks = 0        # Deadlines that were skipped entirely
+        self.overruns = 0            # Passes that were still running when the next deadline came up
+
+    @property
+    def deadline(self):
+        return self.origin + self.tick_number * self.timestep
+
+
+class DeadlineScheduler:
+
+    def __init__(self):
+        self.tasks = {}     # name -> ScheduledTask
+
+    def addTask(self, name, timestep):
+        if timestep <= 0:
+            raise ValueError('Timestep for {} must be greater than 0, got {}'.format(name, timestep))
+
+        # Lining the first deadline up with the wall clock, then converting it to the monotonic clock
+        wall_now, monotonic_now = time.time(), time.monotonic()
+        wall_start = math.ceil(wall_now / timestep) * timestep
+        self.tasks[name] = ScheduledTask(name, timestep, monotonic_now + (wall_start - wall_now))
+
+    def removeTask(self, name):
+        self.tasks.pop(name, None)
+
+    def waitForDueTasks(self, stopping=None, idle=1.0):
+
+        # Sleeps until the earliest deadline and returns a ScheduledTick for every task
+        #...that is due. Tasks that share a timestep come back together in one list. If
+        #...'stopping' (a threading.Event or anything with its wait()) is set, returns [] right away.
+        #...With no tasks at all (e.g. every block is only read on request), waits 'idle' seconds
+        #...and returns [], so the caller still gets to look for requests.
+
+        if not self.tasks:
+            if stopping is None:
+                time.sleep(idle)
+            else:
+                stopping.wait(idle)
+            return []
+
+        while True:
+            now = time.monotonic()
+            earliest = min(task.deadline for task in self.tasks.values())
+            if earliest <= now:
+                break
+            if stopping is None:
+                time.sleep(earliest - now)     # time.sleep() can wake up a little early, so check again
+            elif stopping.wait(earliest - now):
+                return []
+
+        due = []
+        for task in self.tasks.values():
+            if task.deadline > now:
+                continue
+
+            scheduled = task.deadline
+            missed = int((now - scheduled) // task.timestep)   # Deadlines after this one that have also passed
+
+            task.tick_number += missed + 1
+            task.ticks += 1
+            task.missed_ticks += missed
+            due.append(ScheduledTick(task.name, scheduled, missed))
+
+        return due
+
+    def finishTick(self, names):
+        # Called once the work for the given tasks is done. Anything still running when
+        #...its next deadline came up counts as an overrun. Returns the names of those tasks.
+        now = time.monotonic()
+        overrun = []
+        for name in names:
+            task = self.tasks.get(name)
+            if task is not None and now > task.deadline:
+                task.overruns += 1
+                overrun.append(name)
+        return overrun
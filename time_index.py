@@ -0,0 +1,241 @@
+"""
+--------------------------------------------------------------------------------------
+ORCA Time Index
+
+A small sidecar file next to every .csv data file ('<file>.csv.idx') that maps each
+minute of the file to the byte offset of its first row. MeterCsvWriter adds to it as it
+writes, so the index is never more than one flush behind the data.
+
+    [ records ]  one per minute that has data: start of the minute as float64, then the
+                 byte offset of its first row as uint64 (both little-endian)
+
+With it, pulling a few minutes out of a day of data is one binary search and one read of
+just those bytes, and a range spanning months only opens the files for those days, so
+queries over a year of data come back in milliseconds:
+
+    python time_index.py Galena_1 "2020-06-01 12:00" "2020-06-01 12:10"
+    python time_index.py Galena_1 1590969600 1591574400 --directory ./data > week.csv
+    python time_index.py Galena_1 "2020-06-01" "2020-06-02" --backfill
+
+Files written before the index existed (or whose index was lost) are still read
+correctly, just by scanning the part the index doesn't cover. 'python time_index.py
+--rebuild <file.csv> ...' indexes them. Compressed files (see file_compressor.py) keep
+their index and are only decompressed up to the end of the range. The binary .orca
+files don't need an index, see binary_data_store.readTimeSlice(). '--backfill' merges in
+the rows backfilled from the meter's historical log (see historical_backfill.py).
+--------------------------------------------------------------------------------------
+"""
+
+import argparse
+import csv
+import datetime
+import io
+import os
+import sys
+import time
+import numpy as np
+from file_compressor import openData, findDataFile, uncompressedPath
+
+
+INDEX_EXTENSION = '.idx'
+INDEX_DTYPE = np.dtype([('bucket', '<f8'), ('offset', '<u8')])
+DEFAULT_INTERVAL = 60     # Seconds covered by one index record
+
+
+def indexPath(data_path):
+    return uncompressedPath(data_path) + INDEX_EXTENSION     # A compressed file keeps the index of the original
+
+
+class TimeIndexWriter:
+
+    # Used by csv_data_writer.MeterCsvWriter. add() is called for every row with the row's byte
+    #...offset in the data file, flush() once those rows have been written to it.
+
+    def __init__(self, data_path, interval=DEFAULT_INTERVAL, new_file=False):
+        self.interval = interval
+        self._file = open(indexPath(data_path), 'wb' if new_file else 'ab')     # A new data file starts a new index
+        self._last_bucket = None
+        self._pending = []     # Records for rows that haven't been flushed to the data file yet
+
+    def add(self, timestamp, offset):
+        bucket = timestamp - timestamp % self.interval
+        if bucket != self._last_bucket:
+            self._pending.append((bucket, offset))
+            self._last_bucket = bucket
+
+    def flush(self, fsync=False):
+        if self._pending:
+            self._file.write(np.array(self._pending, dtype=INDEX_DTYPE).tobytes())
+            self._pending = []
+            self._file.flush()
+            if fsync:
+                os.fsync(self._file.fileno())
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+def loadIndex(data_path):
+    # The index records of a data file, or an empty array if it has no index
+    try:
+        with open(indexPath(data_path), 'rb') as index_file:
+            data = index_file.read()
+    except OSError:
+        return np.zeros(0, dtype=INDEX_DTYPE)
+    whole_records = len(data) // INDEX_DTYPE.itemsize     # Dropping a torn record left by a power cut
+    return np.frombuffer(data[:whole_records * INDEX_DTYPE.itemsize], dtype=INDEX_DTYPE)
+
+
+def buildIndex(data_path, interval=DEFAULT_INTERVAL):
+    # Writes a fresh index for an existing .csv data file. Returns the number of records.
+    index = TimeIndexWriter(data_path, interval, new_file=True)
+    with openData(data_path, 'rb') as data_file:
+        offset = len(data_file.readline())     # Skipping the column headers
+        for line in data_file:
+            try:
+                index.add(float(line.split(b',', 1)[0]), offset)
+            except ValueError:
+                pass     # A torn last row
+            offset += len(line)
+    records = len(index._pending)
+    index.close()
+    return records
+
+
+def readRange(data_path, start, end):
+
+    # Returns (columns, rows) for the rows of one .csv data file with start <= timestamp < end,
+    #...in time order. Only the bytes between the index records around 'start' and 'end' are
+    #...read, unless the file isn't in time order (the backfilled rows are appended one gap at
+    #...a time, see historical_backfill.py): then all of it is read and the rows are sorted.
+
+    index = loadIndex(data_path)
+    in_order = not np.any(np.diff(index['bucket']) < 0)
+    if not in_order:
+        index = index[:0]
+
+    with openData(data_path, 'rb') as data_file:     # Compressed or not (see file_compressor.py)
+        header = data_file.readline()
+        columns = next(csv.reader([header.decode('utf-8')]))
+
+        first, last = len(header), None
+        if len(index):
+            before = np.searchsorted(index['bucket'], start, 'right') - 1        # Last minute starting at or before 'start'
+            if before >= 0:
+                before = np.searchsorted(index['bucket'], index['bucket'][before], 'left')     # A restart can index a minute twice
+                first = int(index['offset'][before])
+            after = np.searchsorted(index['bucket'], end, 'left')               # First minute starting at or after 'end'
+            if after < len(index):
+                last = int(index['offset'][after])
+
+        if data_file.seekable():
+            data_file.seek(first)
+        else:
+            data_file.read(first - len(header))
+        data = data_file.read() if last is None else data_file.read(last - first)
+
+    rows = []
+    for row in csv.reader(io.StringIO(data.decode('utf-8'))):
+        try:
+            timestamp = float(row[0])
+        except (ValueError, IndexError):
+            continue     # A torn last row
+        if start <= timestamp < end:
+            rows.append(row)
+    if not in_order:
+        rows.sort(key=lambda row: float(row[0]))
+    return columns, rows
+
+
+def _readPeriod(meter_name, period_start, start, end, directory, rotation):
+    # (columns, rows) of every .csv data file of 'meter_name' for one period, that has rows in the range
+    from csv_data_writer import dataFileName     # (csv_data_writer imports this module)
+
+    base_name = dataFileName(meter_name, period_start, rotation, extension='')
+    files = []
+    suffix = 0     # A numbered file is started when the columns change during the day
+    while True:
+        path = os.path.join(directory, base_name + ('_{}'.format(suffix) if suffix else '') + '.csv')
+        if findDataFile(path) is None:
+            break
+        columns, rows = readRange(path, start, end)
+        if rows:
+            files.append((columns, rows))
+        suffix += 1
+    return files
+
+
+def _mergeBackfill(files, backfill_files):
+    # Adds the rows backfilled from a meter's historical log (see historical_backfill.py) to
+    #...the live rows with the same columns, in time order. The live rows get a provenance flag of 0.
+    from historical_backfill import PROVENANCE_COLUMN
+
+    merged = [(columns + [PROVENANCE_COLUMN], [row + ['0'] for row in rows]) for columns, rows in files]
+    for columns, rows in backfill_files:
+        for merged_columns, merged_rows in merged:
+            if merged_columns == columns:
+                merged_rows.extend(rows)
+                merged_rows.sort(key=lambda row: float(row[0]))
+                break
+        else:
+            merged.append((columns, rows))     # E.g. a day the meter couldn't be reached at all
+    return merged
+
+
+def queryTimeRange(meter_name, start, end, directory='./data', rotation='day', backfill=False):
+
+    # Yields (columns, rows) for every .csv data file of 'meter_name' that overlaps
+    #...start <= timestamp < end (Unix timestamps), oldest first. Only those files are opened.
+    #...With 'backfill', the rows backfilled from the meter's historical log are merged in.
+
+    from csv_data_writer import periodBounds     # (csv_data_writer imports this module)
+
+    period_timestamp = start
+    while period_timestamp < end:
+        period_start, period_end = periodBounds(period_timestamp, rotation)
+        files = _readPeriod(meter_name, period_start, start, end, directory, rotation)
+        if backfill:
+            from historical_backfill import backfillStream
+            files = _mergeBackfill(files, _readPeriod(backfillStream(meter_name), period_start, start, end,
+                                                      directory, rotation))
+        for columns, rows in files:
+            yield columns, rows
+
+        period_timestamp = period_end
+
+
+def parseTime(text):
+    # A Unix timestamp, or a local date and time like '2020-06-01 12:00'
+    try:
+        return float(text)
+    except ValueError:
+        return time.mktime(datetime.datetime.fromisoformat(text).timetuple())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print the rows of an ORCA meter between two times as .csv')
+    parser.add_argument('meter', nargs='?', help='Meter (or stream) name, as in the data file names')
+    parser.add_argument('start', nargs='?', help="Unix timestamp or local time, e.g. '2020-06-01 12:00'")
+    parser.add_argument('end', nargs='?', help='Unix timestamp or local time (not included)')
+    parser.add_argument('--directory', default='./data', help='Data directory (default: ./data)')
+    parser.add_argument('--rotation', default='day', choices=('day', 'hour'), help='FILE_ROTATION of the data files')
+    parser.add_argument('--backfill', action='store_true', help="Merge in the rows backfilled from the meter's historical log")
+    parser.add_argument('--rebuild', nargs='+', metavar='FILE', help='Rebuild the index of these .csv files instead')
+    arguments = parser.parse_args()
+
+    if arguments.rebuild:
+        for path in arguments.rebuild:
+            print('{}: {} index records'.format(path, buildIndex(path)))
+        sys.exit()
+    if not (arguments.meter and arguments.start and arguments.end):
+        parser.error('meter, start and end are required')
+
+    writer = csv.writer(sys.stdout, lineterminator='\n')
+    last_columns = None
+    for columns, rows in queryTimeRange(arguments.meter, parseTime(arguments.start), parseTime(arguments.end),
+                                        arguments.directory, arguments.rotation, arguments.backfill):
+        if columns != last_columns:     # The settings (and so the columns) may have changed between days
+            writer.writerow(columns)
+            last_columns = columns
+        writer.writerows(rows)
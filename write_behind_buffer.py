@@ -0,0 +1,222 @@
+"""
+--------------------------------------------------------------------------------------
+ORCA Write-Behind Buffer
+
+Keeps samples in a bounded in-memory ring buffer and lets a background thread write
+them to the data files in large batches, so the poll loop never waits on the SD card
+and the card sees a few big writes instead of a small append per meter per tick.
+
+Every batch goes through a spool file first:
+    1. The whole batch is appended to the spool file in one write (padded to whole
+       4 KiB blocks) and fsync'd.
+    2. The rows are handed to the meters' data writers, which are then fsync'd.
+    3. The spool file is emptied.
+On startup anything left in the spool (a batch that was interrupted by a power cut)
+is written to the data files again, so at most the samples still waiting in memory,
+less than one batch, are lost. Rows of an interrupted batch that had already reached
+the data files may show up twice.
+
+The background thread owns the data writers: it also rotates and flushes them, so
+nothing else may call them while the buffer is running. To add, close or replace writers
+while it runs (e.g. after the settings were reloaded), hand the change to runAfterQueued(). Buffer fill levels and write
+stall times are logged every 'report_interval' seconds.
+--------------------------------------------------------------------------------------
+"""
+
+import collections
+import json
+import os
+import threading
+import time
+
+
+SPOOL_BLOCK_SIZE = 4096
+
+
+class WriteBehindBuffer:
+
+    def __init__(self, data_writers, capacity=10000, batch_size=500, max_delay=30.0,
+                 spool_path='./data/.spool', report_interval=300.0, stall_warning=2.0, logger=None):
+        self.data_writers = data_writers     # meter name -> list of writers (see csv_data_writer.py)
+        self.capacity = capacity
+        self.batch_size = batch_size         # Rows that trigger a write
+        self.max_delay = max_delay           # Seconds a row may wait before a smaller batch is written anyway
+        self.spool_path = spool_path
+        self.report_interval = report_interval
+        self.stall_warning = stall_warning   # Batches that take longer than this many seconds are logged right away
+        self.logger = logger
+
+        self._ring = collections.deque(maxlen=capacity)
+        self._condition = threading.Condition()
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, name='orca-write-behind', daemon=True)
+        self._spool_file = None
+        self._put_count = 0       # Rows put() so far, including dropped ones
+        self._callbacks = []      # (put count, function) waiting for runAfterQueued()
+
+        # Statistics since the last report
+        self.dropped = 0
+        self.peak_fill = 0
+        self.batches = 0
+        self.rows_written = 0
+        self.max_stall = 0.0
+        self.total_stall = 0.0
+        self._last_report = time.monotonic()
+
+    def start(self):
+        if self.spool_path is not None:
+            self._recoverSpool()
+            self._spool_file = open(self.spool_path, 'ab')
+        self._thread.start()
+
+    def put(self, meter_name, row, timestamp):
+        # Never blocks. If the ring is full the oldest sample is dropped and counted.
+        with self._condition:
+            if len(self._ring) == self.capacity:
+                self.dropped += 1
+            self._ring.append((meter_name, timestamp, row))
+            self._put_count += 1
+            self.peak_fill = max(self.peak_fill, len(self._ring))
+            if len(self._ring) >= self.batch_size:
+                self._condition.notify()
+
+    def runAfterQueued(self, function):
+        # Has the background thread call 'function()' once every row put() so far has been
+        #...written, and before any row put() after this call is. Doesn't wait for it.
+        with self._condition:
+            self._callbacks.append((self._put_count, function))
+            self._condition.notify()
+
+    def close(self):
+        # Writes out everything still in the ring and stops the background thread
+        with self._condition:
+            self._closing = True
+            self._condition.notify()
+        if self._thread.is_alive():
+            self._thread.join()
+        if self._spool_file is not None:
+            self._spool_file.close()
+            self._spool_file = None
+
+    def _run(self):
+        last_write = time.monotonic()
+        while True:
+            with self._condition:
+                # Waking up at least once a second so the writers get rotated on time
+                self._condition.wait_for(lambda: self._closing or self._callbacks or len(self._ring) >= self.batch_size,
+                                         timeout=1.0)
+                closing = self._closing
+                due = (closing or self._callbacks or len(self._ring) >= self.batch_size
+                       or (self._ring and time.monotonic() - last_write >= self.max_delay))
+                batch = [self._ring.popleft() for _ in range(len(self._ring))] if due else []
+                first_row = self._put_count - len(batch)     # put() count of the first row in the batch
+                callbacks, self._callbacks = self._callbacks, []
+
+            try:
+                written = 0
+                for put_count, function in callbacks:     # Splitting the batch where each callback was queued
+                    split = min(max(put_count - first_row, written), len(batch))
+                    if split > written:
+                        self._writeBatch(batch[written:split])
+                        written = split
+                    try:
+                        function()
+                    except Exception:
+                        if self.logger is not None:
+                            self.logger.error('Write-behind buffer callback failed', exc_info=True)
+                if written < len(batch):
+                    self._writeBatch(batch[written:])
+                if batch:
+                    last_write = time.monotonic()
+                for meter_writers in list(self.data_writers.values()):
+                    for data_writer in meter_writers:
+                        data_writer.maintain()
+                self._report()
+            except Exception:
+                if self.logger is not None:
+                    self.logger.error('Write-behind buffer failed to write a batch', exc_info=True)
+
+            if closing:
+                return
+
+    def _writeBatch(self, batch):
+        started = time.monotonic()
+
+        if self._spool_file is not None:
+            lines = ''.join(json.dumps(sample) + '\n' for sample in batch).encode('utf-8')
+            lines += b' ' * (-len(lines) % SPOOL_BLOCK_SIZE)     # Whitespace padding is skipped on recovery
+            self._spool_file.write(lines)
+            self._spool_file.flush()
+            os.fsync(self._spool_file.fileno())
+
+        self._writeRows(batch)
+
+        if self._spool_file is not None:
+            self._spool_file.truncate(0)     # The batch is safely in the data files now
+            os.fsync(self._spool_file.fileno())
+
+        stall = time.monotonic() - started
+        self.batches += 1
+        self.rows_written += len(batch)
+        self.total_stall += stall
+        self.max_stall = max(self.max_stall, stall)
+
+        if stall >= self.stall_warning and self.logger is not None:
+            self.logger.warning('Writing a batch of {} rows took {:.2f} s'.format(len(batch), stall))
+
+    def _writeRows(self, samples):
+        touched = set()
+        for meter_name, timestamp, row in samples:
+            for data_writer in self.data_writers.get(meter_name, ()):
+                data_writer.writeRow(row, timestamp)
+            touched.add(meter_name)
+        for meter_name in touched:
+            for data_writer in self.data_writers.get(meter_name, ()):
+                data_writer.sync()
+
+    def _recoverSpool(self):
+        if not os.path.exists(self.spool_path) or os.path.getsize(self.spool_path) == 0:
+            return
+
+        samples = []
+        with open(self.spool_path, 'rb') as spool_file:
+            for line in spool_file.read().decode('utf-8').splitlines():
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    samples.append(json.loads(line))
+                except ValueError:
+                    break     # A torn write at the very end of the spool, nothing after it is usable
+
+        self._writeRows(samples)
+        os.truncate(self.spool_path, 0)
+
+        if self.logger is not None:
+            self.logger.warning('Recovered {} rows from an interrupted write ({})'.format(len(samples), self.spool_path))
+
+    def _report(self):
+        now = time.monotonic()
+        if now - self._last_report < self.report_interval:
+            return
+
+        with self._condition:
+            fill = len(self._ring)
+            peak_fill, dropped = self.peak_fill, self.dropped
+            self.peak_fill, self.dropped = fill, 0
+
+        if self.logger is not None:
+            average_stall = self.total_stall / self.batches if self.batches else 0.0
+            message = ('Write buffer: {} of {} rows in use (peak {:.0%}), {} batches / {} rows written, '
+                       'write stall avg {:.3f} s max {:.3f} s, {} rows dropped').format(fill, self.capacity,
+                                                                                       peak_fill / self.capacity,
+                                                                                       self.batches, self.rows_written,
+                                                                                       average_stall, self.max_stall,
+                                                                                       dropped)
+            if dropped:
+                self.logger.warning(message)
+            else:
+                self.logger.info(message)
+
+        self.batches, self.rows_written, self.max_stall, self.total_stall = 0, 0, 0.0, 0.0
+        self._last_report = now